@@ -0,0 +1,102 @@
+# bench_inference.py
+
+import os
+import sys
+import glob
+import time
+import argparse
+import statistics
+from PIL import Image
+import inference
+
+FIXTURE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "temp")
+
+# === Load fixture images ===
+def load_images(directory, limit):
+    images = []
+    for path in sorted(glob.glob(os.path.join(directory, "*"))):
+        try:
+            images.append(Image.open(path).convert("RGB"))
+        except Exception as e:
+            print(f"⚠️ Skipping {os.path.basename(path)}: {e}")
+        if len(images) >= limit:
+            break
+    return images
+
+# === Time one batched stage ===
+# Returns (images/sec, median milliseconds per batch call)
+def measure(fn, images, batch_size, repeat, backend):
+    fn(images[:batch_size], batch_size=batch_size, backend=backend)  # warm-up
+    latencies = []
+    for _ in range(repeat):
+        for start in range(0, len(images), batch_size):
+            began = time.perf_counter()
+            fn(images[start:start + batch_size], batch_size=batch_size, backend=backend)
+            latencies.append(time.perf_counter() - began)
+    return len(images) * repeat / sum(latencies), statistics.median(latencies) * 1000
+
+# === Parity with the eager PyTorch reference ===
+# Mean / worst mask IoU and the share of images where person detection agrees
+def parity(backend, images, reference_masks, reference_persons):
+    masks = inference.segment_images(images, backend=backend)
+    ious = [inference.mask_iou(mask, reference) for mask, reference in zip(masks, reference_masks)]
+    persons = inference.detect_persons(images, backend=backend)
+    agreement = sum(a == b for a, b in zip(persons, reference_persons)) / len(images)
+    return statistics.mean(ious), min(ious), agreement
+
+# "onnx:static" -> load_backend("onnx", quantize="static")
+def load_spec(spec, segment_model):
+    name, _, quantize = spec.partition(":")
+    return inference.load_backend(name, segment_model, quantize or None)
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare inference backends: images/sec, batch latency and mask parity")
+    parser.add_argument("--images", default=FIXTURE_DIR, help="directory of sample images")
+    parser.add_argument("--limit", type=int, default=16, help="number of images to benchmark")
+    parser.add_argument("--batch-sizes", default="1,2,4,8", help="comma-separated batch sizes")
+    parser.add_argument("--repeat", type=int, default=2)
+    parser.add_argument("--backends", default="torch,onnx,onnx:dynamic",
+                        help="comma-separated backend[:quantization] specs, e.g. torch,onnx,onnx:static")
+    parser.add_argument("--segment-model", default=inference.SEGMENT_MODEL, choices=sorted(inference.SEGMENT_MODELS))
+    parser.add_argument("--threads", type=int, default=None, help="intra-op threads per backend (default: all cores)")
+    parser.add_argument("--min-iou", type=float, default=0.9, help="fail when a backend's mean mask IoU is below this")
+    args = parser.parse_args()
+
+    images = load_images(args.images, args.limit)
+    if not images:
+        print(f"🚫 No images found in {args.images}")
+        return
+    print(f"🖼️  {len(images)} images, segment model={args.segment_model}, threads={args.threads or 'default'}")
+
+    # The reference is always eager PyTorch with the full ResNet-101 model
+    default = inference.get_backend()
+    if isinstance(default, inference.TorchBackend) and inference.SEGMENT_MODEL == "resnet101":
+        reference = default
+    else:
+        reference = inference.TorchBackend("resnet101")
+    reference_masks = inference.segment_images(images, backend=reference)
+    reference_persons = inference.detect_persons(images, backend=reference)
+
+    failed = []
+    for spec in args.backends.split(","):
+        backend = reference if spec == "torch" and args.segment_model == "resnet101" else load_spec(spec, args.segment_model)
+        if args.threads:
+            backend.set_num_threads(args.threads)
+
+        mean_iou, min_iou, agreement = parity(backend, images, reference_masks, reference_persons)
+        print(f"\n⚙️  {spec}: mask IoU mean={mean_iou:.3f} min={min_iou:.3f}, detection agreement={agreement:.0%}")
+        if mean_iou < args.min_iou:
+            failed.append(spec)
+
+        print(f"{'batch':>6} {'detect img/s':>14} {'detect ms':>10} {'segment img/s':>14} {'segment ms':>11}")
+        for batch_size in (int(b) for b in args.batch_sizes.split(",")):
+            detect, detect_ms = measure(inference.detect_persons, images, batch_size, args.repeat, backend)
+            segment, segment_ms = measure(inference.segment_images, images, batch_size, args.repeat, backend)
+            print(f"{batch_size:>6} {detect:>14.2f} {detect_ms:>10.1f} {segment:>14.2f} {segment_ms:>11.1f}")
+
+    if failed:
+        print(f"\n❌ Mean mask IoU below {args.min_iou} for: {', '.join(failed)}")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+# bench_layflats.py
+
+import os
+import io
+import glob
+import time
+import argparse
+import tempfile
+import statistics
+import numpy as np
+from PIL import Image, ImageDraw
+from image_cache import ImageCache
+import generate_layflats
+
+FIXTURE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "temp")
+
+def load_images(directory, limit):
+    images = []
+    for path in sorted(glob.glob(os.path.join(directory, "*")))[:limit]:
+        try:
+            image = Image.open(path)
+            image.thumbnail((1024, 1024))
+            images.append(image.convert("RGB"))
+        except Exception as e:
+            print(f"⚠️ Skipping {os.path.basename(path)}: {e}")
+    return images
+
+# === Synthetic cutouts ===
+# Each fixture photo becomes an RGBA cutout the way remove_background stores
+# them: an elliptical alpha (a stand-in for the segmentation mask) with a
+# margin around it, lossless WebP, and the tight alpha box as `trim`. The
+# cutouts are placed in a fresh image cache under made-up URLs so the
+# benchmark never touches the network.
+def make_cutout(image, margin=0.03):
+    width, height = image.size
+    mask = Image.new("L", image.size, 0)
+    inset_x, inset_y = width // 6, height // 10
+    ImageDraw.Draw(mask).ellipse((inset_x, inset_y, width - inset_x, height - inset_y), fill=255)
+    left, top, right, bottom = mask.getbbox()
+    pad = int(round(margin * max(right - left, bottom - top)))
+    box = (max(0, left - pad), max(0, top - pad), min(width, right + pad), min(height, bottom + pad))
+    cutout = image.convert("RGBA")
+    cutout.putalpha(mask)
+    output = io.BytesIO()
+    cutout.crop(box).save(output, format="WEBP", lossless=True, quality=50, method=4)
+    trim = [left - box[0], top - box[1], right - left, bottom - top]
+    return output.getvalue(), trim
+
+def build_catalog(cache_dir, images, products):
+    cache = ImageCache(cache_dir)
+    catalog = []
+    encoded = [make_cutout(image) for image in images]
+    for product in range(products):
+        data, trim = encoded[product % len(encoded)]
+        url = f"https://bench.invalid/transparent/BENCH-{product:06d}.webp"
+        cache.store(url, data)
+        catalog.append({"url": url, "trim": trim})
+    cache.close()
+    return catalog
+
+# Outfits of 3-6 products drawn from a Zipf-ish popularity, so a few products
+# show up in many outfits the way bestsellers do
+def sample_outfits(catalog, count, seed=0):
+    rng = np.random.default_rng(seed)
+    weights = 1.0 / np.arange(1, len(catalog) + 1) ** 0.8
+    weights /= weights.sum()
+    outfits = []
+    for i in range(count):
+        size = min(len(catalog), int(rng.integers(3, 7)))
+        picks = rng.choice(len(catalog), size, replace=False, p=weights)
+        outfits.append({"name": f"bench-{i:05d}", "items": [catalog[p] for p in picks]})
+    return outfits
+
+# === Time one configuration ===
+def measure(outfits, workers, cache_dir, output_dir, decode_cache_mb):
+    began = time.perf_counter()
+    results, cache_stats = generate_layflats.render_all(
+        outfits, workers, output_dir, cache_dir=cache_dir, decode_cache_mb=decode_cache_mb
+    )
+    elapsed = time.perf_counter() - began
+    errors = [error for _, _, error, _ in results if error]
+    if errors:
+        raise RuntimeError(f"{len(errors)} layflats failed, e.g. {errors[0]}")
+    render_ms = statistics.median(seconds for *_, seconds in results) * 1000
+    lookups = cache_stats["hits"] + cache_stats["decoded"]
+    return len(results) / elapsed, render_ms, cache_stats["hits"] / lookups if lookups else 0.0
+
+def main():
+    parser = argparse.ArgumentParser(description="Layflats/sec for the batch compositor, by worker count and decode cache")
+    parser.add_argument("--images", default=FIXTURE_DIR, help="directory of sample images turned into cutouts")
+    parser.add_argument("--products", type=int, default=200, help="distinct cutouts outfits are drawn from")
+    parser.add_argument("--outfits", type=int, default=400)
+    parser.add_argument("--workers", default=f"1,{generate_layflats.LAYFLAT_WORKERS}", help="comma-separated worker counts")
+    parser.add_argument("--decode-cache-mb", type=int, default=generate_layflats.DECODE_CACHE_MB)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    images = load_images(args.images, args.products)
+    if not images:
+        print(f"🚫 No images found in {args.images}")
+        return
+    with tempfile.TemporaryDirectory() as work_dir:
+        cache_dir = os.path.join(work_dir, "cache")
+        output_dir = os.path.join(work_dir, "layflats")
+        os.makedirs(output_dir)
+        catalog = build_catalog(cache_dir, images, args.products)
+        outfits = sample_outfits(catalog, args.outfits, args.seed)
+        print(f"🧩 {len(outfits)} outfits from {len(catalog)} cutouts ({len(images)} distinct photos), "
+              f"{generate_layflats.CANVAS_WIDTH}x{generate_layflats.CANVAS_HEIGHT} {generate_layflats.LAYFLAT_FORMAT}")
+
+        print(f"{'workers':>8} {'decode cache':>13} {'layflats/s':>11} {'render ms':>10} {'reused':>7}")
+        for workers in (int(w) for w in args.workers.split(",")):
+            for cache_mb in (0, args.decode_cache_mb):
+                rate, render_ms, reused = measure(outfits, workers, cache_dir, output_dir, cache_mb)
+                label = f"{cache_mb} MB" if cache_mb else "off"
+                print(f"{workers:>8} {label:>13} {rate:>11.1f} {render_ms:>10.1f} {reused:>7.0%}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,641 @@
+# bench_pipeline.py
+
+import os
+import io
+import re
+import csv
+import sys
+import json
+import time
+import base64
+import random
+import shutil
+import sqlite3
+import asyncio
+import hashlib
+import argparse
+import tempfile
+import mimetypes
+import threading
+import subprocess
+from collections import Counter
+import numpy as np
+import psycopg2
+from psycopg2.extensions import parse_dsn
+from aiohttp import web
+
+PIPELINE_DIR = os.path.dirname(os.path.abspath(__file__))
+FIXTURE_DIR = os.path.join(PIPELINE_DIR, "..", "temp")
+RESULTS_PATH = os.getenv("BENCH_RESULTS_PATH", os.path.join(PIPELINE_DIR, ".cache", "bench_pipeline.jsonl"))
+BENCH_SCHEMA = "bench_pipeline"
+
+# Stage name -> (script, job_state stage, arguments)
+STAGES = {
+    "label": ("label_with_gpt.py", "label", []),
+    "download": ("download_images.py", "download", []),
+    "background": ("remove_background.py", "transparent", ["--pipeline"]),
+    "embed": ("vectorize_and_index.py", "embed", [])
+}
+SKU_PATTERN = re.compile(r"BENCH-\d{6}")
+ITEMS = ["t-shirt", "jeans", "blazer", "dress", "hoodie", "skirt", "trench coat", "cardigan"]
+COLORS = ["black", "white", "camel", "navy", "light wash", "olive", "cream", "burgundy"]
+MATERIALS = ["cotton", "wool knit", "linen", "denim", "silk", "nylon blend"]
+
+# === Local stand-ins ===
+# One aiohttp server, on its own thread and event loop, plays every external
+# service the stages talk to:
+#   - OpenAI chat completions and embeddings, with latency, 429 (Retry-After)
+#     and 500 injection
+#   - Supabase Storage uploads and public object URLs (kept in memory)
+#   - an image host serving the fixtures in temp/
+#   - the catalog CSV that label_with_gpt streams
+# Every request is recorded as (endpoint, status, began, ended, SKUs it
+# touched), which the harness turns into per-product latencies and API calls.
+class FakeServices:
+    def __init__(self, fixtures, catalog_csv, api_latency_ms=200, api_jitter_ms=50, rate_limit_rate=0.0,
+                 error_rate=0.0, storage_latency_ms=20, image_latency_ms=10, embedding_dim=1536, seed=0):
+        self.fixtures = fixtures
+        self.catalog_csv = catalog_csv
+        self.api_latency_ms = api_latency_ms
+        self.api_jitter_ms = api_jitter_ms
+        self.rate_limit_rate = rate_limit_rate
+        self.error_rate = error_rate
+        self.storage_latency_ms = storage_latency_ms
+        self.image_latency_ms = image_latency_ms
+        self.embedding_dim = embedding_dim
+        self.rng = random.Random(seed)
+        self.objects = {}
+        self.events = []
+        self.events_lock = threading.Lock()
+        self.loop = None
+        self.base_url = None
+
+    def start(self):
+        ready = threading.Event()
+        self.thread = threading.Thread(target=self._serve, args=(ready,), daemon=True)
+        self.thread.start()
+        ready.wait()
+        return self.base_url
+
+    def _serve(self, ready):
+        self.loop = asyncio.new_event_loop()
+        app = web.Application(client_max_size=64 * 1024 ** 2)
+        app.add_routes([
+            web.post("/v1/chat/completions", self.chat),
+            web.post("/v1/embeddings", self.embeddings),
+            web.post("/storage/v1/object/{bucket}/{path:.+}", self.upload),
+            web.put("/storage/v1/object/{bucket}/{path:.+}", self.upload),
+            web.get("/storage/v1/object/public/{bucket}/{path:.+}", self.public_object),
+            web.get("/images/{name}", self.image),
+            web.get("/catalog.csv", self.catalog)
+        ])
+        self.runner = web.AppRunner(app, access_log=None)
+        self.loop.run_until_complete(self.runner.setup())
+        site = web.TCPSite(self.runner, "127.0.0.1", 0)
+        self.loop.run_until_complete(site.start())
+        port = site._server.sockets[0].getsockname()[1]
+        self.base_url = f"http://127.0.0.1:{port}"
+        ready.set()
+        self.loop.run_forever()
+
+    def stop(self):
+        asyncio.run_coroutine_threadsafe(self.runner.cleanup(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+    def record(self, endpoint, status, began, skus):
+        with self.events_lock:
+            self.events.append((endpoint, status, began, time.time(), skus))
+
+    def take_events(self):
+        with self.events_lock:
+            events, self.events = self.events, []
+        return events
+
+    async def delay(self, latency_ms, jitter_ms=0):
+        await asyncio.sleep(max(0.0, latency_ms + self.rng.uniform(-jitter_ms, jitter_ms)) / 1000)
+
+    # Latency first, then maybe an injected failure in OpenAI's error shape
+    async def api_fault(self):
+        await self.delay(self.api_latency_ms, self.api_jitter_ms)
+        draw = self.rng.random()
+        if draw < self.rate_limit_rate:
+            return web.json_response(
+                {"error": {"message": "Rate limit reached (injected)", "type": "requests", "code": "rate_limit_exceeded"}},
+                status=429, headers={"retry-after-ms": "250", "retry-after": "1"}
+            )
+        if draw < self.rate_limit_rate + self.error_rate:
+            return web.json_response({"error": {"message": "Internal error (injected)", "type": "server_error"}}, status=500)
+        return None
+
+    # Answers with one label object per numbered product in the prompt
+    async def chat(self, request):
+        began = time.time()
+        payload = await request.json()
+        prompt = payload["messages"][-1]["content"]
+        skus = SKU_PATTERN.findall(prompt)
+        fault = await self.api_fault()
+        if fault is not None:
+            self.record("chat", fault.status, began, skus)
+            return fault
+        titles = re.findall(r"^(\d+)\. Title: (.*)$", prompt, re.M)
+        labels = [
+            {
+                "index": int(number),
+                "description_ai": f"{title.strip()} in a relaxed fit.",
+                "style_details": ["relaxed fit", "ribbed", "cropped"],
+                "items_detected": {"type": "t-shirt", "color": "black", "material": "cotton", "style": "oversized"},
+                "metadata": {"neckline": "crew", "length": "regular"}
+            }
+            for number, title in titles
+        ]
+        prompt_tokens = len(prompt) // 4
+        completion_tokens = 120 * len(labels)
+        self.record("chat", 200, began, skus)
+        return web.json_response({
+            "id": f"chatcmpl-bench-{int(began * 1000)}",
+            "object": "chat.completion",
+            "created": int(began),
+            "model": payload.get("model"),
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": json.dumps(labels)}, "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                      "total_tokens": prompt_tokens + completion_tokens}
+        })
+
+    # Deterministic unit vectors seeded by the input text; base64 when the
+    # client asks for it (the openai package does by default)
+    async def embeddings(self, request):
+        began = time.time()
+        payload = await request.json()
+        texts = payload["input"] if isinstance(payload["input"], list) else [payload["input"]]
+        skus = [sku for text in texts for sku in SKU_PATTERN.findall(str(text))]
+        fault = await self.api_fault()
+        if fault is not None:
+            self.record("embeddings", fault.status, began, skus)
+            return fault
+        data = []
+        for i, text in enumerate(texts):
+            seed = int.from_bytes(hashlib.sha256(str(text).encode("utf-8")).digest()[:8], "little")
+            vector = np.random.default_rng(seed).standard_normal(self.embedding_dim).astype(np.float32)
+            vector /= np.linalg.norm(vector)
+            if payload.get("encoding_format") == "base64":
+                embedding = base64.b64encode(vector.tobytes()).decode("ascii")
+            else:
+                embedding = vector.tolist()
+            data.append({"object": "embedding", "index": i, "embedding": embedding})
+        tokens = sum(len(str(text)) // 4 + 1 for text in texts)
+        self.record("embeddings", 200, began, skus)
+        return web.json_response({
+            "object": "list", "data": data, "model": payload.get("model"),
+            "usage": {"prompt_tokens": tokens, "total_tokens": tokens}
+        })
+
+    # Raw bodies (download_images) and multipart forms (supabase-py) alike
+    async def upload(self, request):
+        began = time.time()
+        path = f"{request.match_info['bucket']}/{request.match_info['path']}"
+        if request.content_type.startswith("multipart/"):
+            body, content_type = b"", None
+            reader = await request.multipart()
+            async for part in reader:
+                if part.filename:
+                    body = await part.read(decode=False)
+                    content_type = part.headers.get("Content-Type")
+                    break
+        else:
+            body, content_type = await request.read(), request.content_type
+        await self.delay(self.storage_latency_ms)
+        self.objects[path] = (body, content_type or mimetypes.guess_type(path)[0] or "application/octet-stream")
+        self.record("storage_upload", 200, began, SKU_PATTERN.findall(path))
+        return web.json_response({"Key": path, "Id": hashlib.md5(path.encode()).hexdigest()})
+
+    async def public_object(self, request):
+        began = time.time()
+        path = f"{request.match_info['bucket']}/{request.match_info['path']}"
+        stored = self.objects.get(path)
+        self.record("storage_get", 200 if stored else 404, began, SKU_PATTERN.findall(path))
+        if stored is None:
+            return web.Response(status=404)
+        return web.Response(body=stored[0], content_type=stored[1])
+
+    # The SKU rides along in the query string so downloads can be attributed
+    async def image(self, request):
+        began = time.time()
+        fixture = self.fixtures.get(request.match_info["name"])
+        await self.delay(self.image_latency_ms)
+        self.record("image", 200 if fixture else 404, began, SKU_PATTERN.findall(request.query_string))
+        if fixture is None:
+            return web.Response(status=404)
+        return web.Response(body=fixture[0], content_type=fixture[1])
+
+    async def catalog(self, request):
+        self.record("catalog_csv", 200, time.time(), [])
+        return web.Response(body=self.catalog_csv.encode("utf-8"), content_type="text/csv")
+
+# === Fixtures and synthetic catalog ===
+def load_fixtures(directory):
+    fixtures = {}
+    for name in sorted(os.listdir(directory)):
+        content_type = mimetypes.guess_type(name)[0]
+        if content_type and content_type.startswith("image/"):
+            with open(os.path.join(directory, name), "rb") as f:
+                fixtures[name] = (f.read(), content_type)
+    return fixtures
+
+def synthetic_rows(count, fixture_names, base_url, seed=0):
+    rng = random.Random(seed)
+    rows = []
+    for i in range(count):
+        sku = f"BENCH-{i:06d}"
+        item, color, material = rng.choice(ITEMS), rng.choice(COLORS), rng.choice(MATERIALS)
+        images = [f"{base_url}/images/{rng.choice(fixture_names)}?sku={sku}" for _ in range(3)]
+        rows.append({
+            "parent_sku": sku,
+            "color_sku": f"{sku}-C",
+            "size_sku": f"{sku}-S",
+            "image_url": images[0],
+            "additional_images": json.dumps(images[1:]),
+            "page_url": f"{base_url}/products/{sku}",
+            "title": f"{color.title()} {material} {item} {sku}",
+            "description": f"A {color} {item} in {material}. " + " ".join(rng.choice(MATERIALS) for _ in range(rng.randint(10, 40))),
+            "category": item,
+            "gender": rng.choice(["women", "men", "unisex"]),
+            "age_group": "adult",
+            "price": f"{rng.lognormvariate(4, 0.6):.2f}",
+            "original_price": "",
+            "stock_availability": str(rng.randint(0, 50)),
+            "brand": f"Brand {rng.randint(1, 40)}",
+            "currency": "USD",
+            "color": color,
+            "size": rng.choice(["XS", "S", "M", "L", "XL"])
+        })
+    return rows
+
+def catalog_csv(rows):
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=list(rows[0]))
+    writer.writeheader()
+    writer.writerows(rows)
+    return buffer.getvalue()
+
+# === Local Postgres ===
+# Everything lives in its own schema, reached through search_path, so the
+# benchmark never touches a database's real tables. Embeddings are stored as
+# real[] so pgvector is not needed locally.
+def reset_schema(dsn, schema):
+    conn = psycopg2.connect(dsn)
+    with conn.cursor() as cursor:
+        cursor.execute(f"DROP SCHEMA IF EXISTS {schema} CASCADE")
+        cursor.execute(f"CREATE SCHEMA {schema}")
+        cursor.execute(f"SET search_path TO {schema}")
+        cursor.execute("""
+            CREATE TABLE product_catalog (
+                id BIGSERIAL PRIMARY KEY,
+                parent_sku TEXT UNIQUE,
+                color_sku TEXT, size_sku TEXT, image_url TEXT, additional_images TEXT[], page_url TEXT,
+                title TEXT, description TEXT, category TEXT, gender TEXT, age_group TEXT,
+                price NUMERIC, original_price NUMERIC, stock_availability INTEGER,
+                brand TEXT, currency TEXT, color TEXT, size TEXT,
+                description_ai TEXT, style_details JSONB, items_detected JSONB, metadata JSONB,
+                hosted_image_url TEXT, transparent_image_url TEXT, transparent_image_meta JSONB
+            )
+        """)
+        cursor.execute("""
+            CREATE TABLE product_embeddings (
+                product_id BIGINT PRIMARY KEY,
+                metadata JSONB,
+                embedding REAL[],
+                content_hash TEXT
+            )
+        """)
+    conn.commit()
+    conn.close()
+
+# Without the label stage, the catalog is loaded as if labeling had run
+def seed_catalog(dsn, schema, rows):
+    conn = psycopg2.connect(dsn, options=f"-c search_path={schema}")
+    with conn.cursor() as cursor:
+        for row in rows:
+            cursor.execute("""
+                INSERT INTO product_catalog (parent_sku, image_url, additional_images, title, description,
+                                             category, brand, color, price, description_ai)
+                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+            """, (row["parent_sku"], row["image_url"], json.loads(row["additional_images"]), row["title"],
+                  row["description"], row["category"], row["brand"], row["color"], row["price"], row["description"]))
+    conn.commit()
+    conn.close()
+
+def product_ids(dsn, schema):
+    conn = psycopg2.connect(dsn, options=f"-c search_path={schema}")
+    with conn.cursor() as cursor:
+        cursor.execute("SELECT parent_sku, id FROM product_catalog")
+        ids = {sku: str(product_id) for sku, product_id in cursor.fetchall()}
+    conn.close()
+    return ids
+
+# Stage scripts run in `workdir` (so .cache/, failed_rows.txt and job state
+# are fresh per run) with every service pointed at the stand-ins. Values set
+# here win over the repo's .env, which load_dotenv never overrides.
+def stage_env(dsn, schema, base_url, workdir):
+    db = parse_dsn(dsn)
+    env = dict(os.environ)
+    env.update({
+        "SUPABASE_DB_HOST": db.get("host", "localhost"),
+        "SUPABASE_DB_NAME": db.get("dbname", "postgres"),
+        "SUPABASE_DB_USER": db.get("user", "postgres"),
+        "SUPABASE_DB_PASSWORD": db.get("password", ""),
+        "SUPABASE_DB_PORT": db.get("port", "5432"),
+        "SUPABASE_DB_SSLMODE": db.get("sslmode", "disable"),
+        "PGOPTIONS": f"-c search_path={schema},public",
+        "SUPABASE_URL": base_url,
+        "SUPABASE_KEY": "bench.bench.bench",
+        "SUPABASE_SERVICE_KEY": "bench.bench.bench",
+        "SUPABASE_STORAGE_BUCKET": "bench",
+        "OPENAI_API_KEY": "sk-bench",
+        "OPENAI_BASE_URL": f"{base_url}/v1",
+        "CATALOG_CSV_URL": f"{base_url}/catalog.csv",
+        "JOB_STATE_PATH": os.path.join(workdir, ".cache", "job_state.sqlite3"),
+        "METRICS_DIR": os.path.join(workdir, ".cache", "metrics"),
+        "METRICS_FORMAT": "json",
+        "PYTHONUNBUFFERED": "1"
+    })
+    return env
+
+# === Measure one stage ===
+def percentile(values, q):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))]
+
+# === Memory ===
+# ru_maxrss from wait4 is useless here: the kernel carries the harness's own
+# high-water mark across fork/exec. Instead /proc is sampled while the stage
+# runs: VmHWM of the stage process, and the summed RSS of its whole process
+# tree (inference workers included). Linux only; zeros elsewhere.
+def proc_status_kb(pid, field):
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1])
+    except (OSError, ValueError):
+        pass
+    return 0
+
+def process_tree(pid):
+    pids, pending = [], [pid]
+    while pending:
+        current = pending.pop()
+        pids.append(current)
+        try:
+            for task in os.listdir(f"/proc/{current}/task"):
+                with open(f"/proc/{current}/task/{task}/children") as f:
+                    pending.extend(int(child) for child in f.read().split())
+        except OSError:
+            pass
+    return pids
+
+class MemorySampler:
+    def __init__(self, pid, interval=0.05):
+        self.pid = pid
+        self.interval = interval
+        self.peak_kb = 0
+        self.peak_tree_kb = 0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._sample, daemon=True)
+        self.thread.start()
+
+    def _sample(self):
+        while not self.stopped.is_set():
+            self.peak_kb = max(self.peak_kb, proc_status_kb(self.pid, "VmHWM"))
+            tree = sum(proc_status_kb(pid, "VmRSS") for pid in process_tree(self.pid))
+            self.peak_tree_kb = max(self.peak_tree_kb, tree)
+            self.stopped.wait(self.interval)
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+# Per-step latencies and billed OpenAI usage from the metrics snapshot the
+# stage writes when it exits (see metrics.py)
+def stage_metrics(workdir, job_stage):
+    path = os.path.join(workdir, ".cache", "metrics", f"{job_stage}.json")
+    if not os.path.exists(path):
+        return {}, {}
+    with open(path) as f:
+        snapshot = json.load(f)
+    steps = {
+        histogram["labels"]["step"]: {"count": histogram["count"], "p50": histogram["p50"], "p95": histogram["p95"]}
+        for histogram in snapshot["histograms"]
+        if histogram["name"] == "pipeline_step_seconds" and histogram["labels"].get("stage") == job_stage
+    }
+    usage = {"tokens": 0, "cost_usd": 0.0}
+    for counter in snapshot["counters"]:
+        if counter["name"] == "openai_tokens_total":
+            usage["tokens"] += counter["value"]
+        elif counter["name"] == "openai_cost_usd_total":
+            usage["cost_usd"] = round(usage["cost_usd"] + counter["value"], 6)
+    return steps, usage
+
+def finished_items(workdir, job_stage, since):
+    path = os.path.join(workdir, ".cache", "job_state.sqlite3")
+    if not os.path.exists(path):
+        return {}, 0
+    db = sqlite3.connect(path)
+    rows = db.execute("SELECT item_key, status, updated_at FROM items WHERE stage = ? AND updated_at >= ?",
+                      (job_stage, since)).fetchall()
+    db.close()
+    done = {key: updated_at for key, status, updated_at in rows if status == "done"}
+    failed = sum(1 for _, status, _ in rows if status == "failed")
+    return done, failed
+
+# Runs one stage script to completion and reports:
+#   - rows/sec: products the stage marked done, over its wall time
+#   - p50/p95 latency: per product, from the stage's first request that
+#     touched it (API call, image fetch or upload) to its job-state "done"
+#   - peak RSS of the stage process, and of its whole process tree
+#   - requests per endpoint, per finished product, and injected failures
+#   - per-step latencies and billed tokens, from the stage's own metrics
+def run_stage(name, services, env, workdir, dsn, schema):
+    script, job_stage, arguments = STAGES[name]
+    log_path = os.path.join(workdir, f"{name}.log")
+    services.take_events()
+    began = time.time()
+    with open(log_path, "w") as log:
+        process = subprocess.Popen([sys.executable, os.path.join(PIPELINE_DIR, script), *arguments],
+                                   cwd=workdir, env=env, stdout=log, stderr=subprocess.STDOUT)
+        memory = MemorySampler(process.pid)
+        # Reaped only after the sampler's last look, so /proc/<pid> is still there
+        os.waitid(os.P_PID, process.pid, os.WEXITED | os.WNOWAIT)
+        memory.stop()
+        process.wait()
+    seconds = time.time() - began
+    events = services.take_events()
+
+    done, failed = finished_items(workdir, job_stage, began)
+    steps, usage = stage_metrics(workdir, job_stage)
+    ids = {} if name == "label" else product_ids(dsn, schema)
+    first_touch = {}
+    for _, _, event_began, _, skus in events:
+        for sku in skus:
+            key = sku if name == "label" else ids.get(sku)
+            if key is not None and event_began < first_touch.get(key, float("inf")):
+                first_touch[key] = event_began
+    latencies = [done[key] - first_touch[key] for key in done if key in first_touch]
+
+    calls = Counter(endpoint for endpoint, _, _, _, _ in events)
+    faults = Counter(f"{endpoint}:{code}" for endpoint, code, _, _, _ in events if code >= 400)
+    products = len(done)
+    result = {
+        "exit_code": process.returncode,
+        "seconds": round(seconds, 2),
+        "products": products,
+        "failed": failed,
+        "rows_per_sec": round(products / seconds, 2) if seconds else None,
+        "p50_seconds": round(percentile(latencies, 0.5), 3) if latencies else None,
+        "p95_seconds": round(percentile(latencies, 0.95), 3) if latencies else None,
+        "peak_rss_mb": round(memory.peak_kb / 1024, 1),
+        "peak_tree_rss_mb": round(memory.peak_tree_kb / 1024, 1),
+        "calls": dict(calls),
+        "calls_per_product": {endpoint: round(count / products, 3) for endpoint, count in calls.items()} if products else {},
+        "faults": dict(faults),
+        "steps": steps,
+        "openai_usage": usage
+    }
+    if process.returncode != 0:
+        with open(log_path) as f:
+            result["log_tail"] = f.read()[-2000:]
+    return result
+
+# === Stored results ===
+# One JSON line per run; a run is compared with the latest earlier run that
+# used the same settings
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=PIPELINE_DIR, text=True,
+                                       stderr=subprocess.DEVNULL).strip()
+    except Exception:
+        return None
+
+def load_results(path):
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def save_result(path, record):
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(path, "a") as f:
+        f.write(json.dumps(record) + "\n")
+
+def delta(current, previous):
+    if current is None or not previous:
+        return ""
+    return f" ({(current - previous) / previous:+.0%})"
+
+def print_report(record, previous):
+    baseline = f"vs {previous['commit'] or '?'} at {previous['timestamp']}" if previous else "no earlier run with these settings"
+    print(f"\n📊 {record['settings']['products']} products, commit {record['commit'] or '?'} ({baseline})")
+    print(f"{'stage':>10} {'exit':>5} {'rows/s':>16} {'p50 s':>8} {'p95 s':>16} {'RSS MB':>16} {'API calls/product':>20}")
+    for name, stage in record["stages"].items():
+        before = (previous or {}).get("stages", {}).get(name, {})
+        if before.get("exit_code") != 0:
+            before = {}
+        api_calls = sum(stage["calls_per_product"].get(endpoint, 0) for endpoint in ("chat", "embeddings"))
+        rate = f"{stage['rows_per_sec']}{delta(stage['rows_per_sec'], before.get('rows_per_sec'))}"
+        p95 = f"{stage['p95_seconds']}{delta(stage['p95_seconds'], before.get('p95_seconds'))}"
+        rss = f"{stage['peak_rss_mb']}{delta(stage['peak_rss_mb'], before.get('peak_rss_mb'))}"
+        print(f"{name:>10} {stage['exit_code']:>5} {rate:>16} {str(stage['p50_seconds']):>8} {p95:>16} {rss:>16} {api_calls:>20.3f}")
+        if stage.get("steps"):
+            steps = ", ".join(f"{step} {timing['p50']:.3f}/{timing['p95']:.3f}s" for step, timing in sorted(stage["steps"].items()))
+            print(f"{'':>10} step p50/p95: {steps}")
+        if stage.get("openai_usage", {}).get("tokens"):
+            print(f"{'':>10} billed: {stage['openai_usage']['tokens']:,} tokens, ${stage['openai_usage']['cost_usd']:.4f}")
+        if stage["faults"]:
+            print(f"{'':>10} injected/failed requests: {stage['faults']}")
+        if stage["exit_code"] != 0:
+            print(f"{'':>10} ❌ exited with {stage['exit_code']}; last output:\n{stage.get('log_tail', '')}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline pipeline benchmark against local OpenAI, Storage, image and Postgres stand-ins")
+    parser.add_argument("--dsn", default=os.getenv("BENCH_DATABASE_URL"),
+                        help="local Postgres to use (tables are created in their own schema), e.g. postgresql://localhost/postgres")
+    parser.add_argument("--products", type=int, default=200)
+    parser.add_argument("--stages", default="label,download,background,embed", help="comma-separated stages, run in this order")
+    parser.add_argument("--fixtures", default=FIXTURE_DIR, help="directory of images served by the fake image host")
+    parser.add_argument("--api-latency-ms", type=float, default=200)
+    parser.add_argument("--api-jitter-ms", type=float, default=50)
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="share of OpenAI requests answered with 429")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of OpenAI requests answered with 500")
+    parser.add_argument("--storage-latency-ms", type=float, default=20)
+    parser.add_argument("--image-latency-ms", type=float, default=10)
+    parser.add_argument("--embedding-dim", type=int, default=1536)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--results", default=RESULTS_PATH, help="JSON lines file that runs are appended to")
+    parser.add_argument("--name", default=None, help="label stored with this run")
+    parser.add_argument("--keep", action="store_true", help="keep the work directory, logs and bench schema")
+    args = parser.parse_args()
+    if not args.dsn:
+        parser.error("--dsn (or BENCH_DATABASE_URL) is required: a local Postgres the benchmark may create a schema in")
+    stages = [name.strip() for name in args.stages.split(",") if name.strip()]
+    unknown = set(stages) - set(STAGES)
+    if unknown:
+        parser.error(f"unknown stages: {', '.join(sorted(unknown))}")
+
+    fixtures = load_fixtures(args.fixtures)
+    if not fixtures:
+        parser.error(f"no images found in {args.fixtures}")
+    services = FakeServices(
+        fixtures, catalog_csv=None,
+        api_latency_ms=args.api_latency_ms, api_jitter_ms=args.api_jitter_ms,
+        rate_limit_rate=args.rate_limit_rate, error_rate=args.error_rate,
+        storage_latency_ms=args.storage_latency_ms, image_latency_ms=args.image_latency_ms,
+        embedding_dim=args.embedding_dim, seed=args.seed
+    )
+    base_url = services.start()
+    rows = synthetic_rows(args.products, sorted(fixtures), base_url, args.seed)
+    services.catalog_csv = catalog_csv(rows)
+
+    workdir = tempfile.mkdtemp(prefix="bench_pipeline_")
+    reset_schema(args.dsn, BENCH_SCHEMA)
+    if "label" not in stages:
+        seed_catalog(args.dsn, BENCH_SCHEMA, rows)
+    env = stage_env(args.dsn, BENCH_SCHEMA, base_url, workdir)
+    print(f"🧪 {args.products} products, {len(fixtures)} fixture images, stand-ins at {base_url}, work dir {workdir}")
+
+    results = {}
+    try:
+        for name in stages:
+            print(f"▶️  {name}...", flush=True)
+            results[name] = run_stage(name, services, env, workdir, args.dsn, BENCH_SCHEMA)
+            print(f"   {results[name]['products']} products in {results[name]['seconds']}s", flush=True)
+    finally:
+        services.stop()
+        if args.keep:
+            print(f"📂 Kept {workdir} and schema {BENCH_SCHEMA}")
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+            conn = psycopg2.connect(args.dsn)
+            with conn.cursor() as cursor:
+                cursor.execute(f"DROP SCHEMA IF EXISTS {BENCH_SCHEMA} CASCADE")
+            conn.commit()
+            conn.close()
+
+    settings = {key: value for key, value in vars(args).items() if key not in ("dsn", "results", "name", "keep", "fixtures")}
+    record = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "commit": git_commit(),
+        "name": args.name,
+        "settings": settings,
+        "stages": results
+    }
+    previous = next((run for run in reversed(load_results(args.results)) if run["settings"] == settings), None)
+    save_result(args.results, record)
+    print_report(record, previous)
+    print(f"\n💾 Appended to {args.results}")
+
+if __name__ == "__main__":
+    main()
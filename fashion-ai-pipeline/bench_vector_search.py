@@ -0,0 +1,119 @@
+# bench_vector_search.py
+
+import time
+import argparse
+import tempfile
+import numpy as np
+import vector_search
+from vector_search import VectorIndex, FILTER_COLUMNS
+
+# === Synthetic catalog ===
+# Clustered unit vectors (real embeddings are far from uniform) with
+# Zipf-ish category/brand/color metadata and log-normal prices
+def synthetic_index(directory, rows, dim, dtype, seed=0):
+    rng = np.random.default_rng(seed)
+    centers = vector_search.normalize(rng.standard_normal((max(1, rows // 500), dim)))
+    vocab = {"category": 40, "brand": 2000, "color": 24}
+    index = VectorIndex.create(directory, dim, dtype)
+    chunk = 20_000
+    for start in range(0, rows, chunk):
+        count = min(chunk, rows - start)
+        vectors = centers[rng.integers(0, len(centers), count)] + 0.6 * rng.standard_normal((count, dim)) / np.sqrt(dim)
+        values = {column: rng.zipf(1.3, count) % size for column, size in vocab.items()}
+        ids = range(start + 1, start + count + 1)
+        batch = [
+            (product_id, vectors[i], {"parent_sku": f"SKU{product_id}", **{c: f"{c}-{values[c][i]}" for c in FILTER_COLUMNS}},
+             f"{product_id:064x}")
+            for i, product_id in enumerate(ids)
+        ]
+        prices = dict(zip(ids, rng.lognormal(4, 0.6, count).round(2)))
+        index.append(batch, prices)
+    return index
+
+# Queries are perturbed copies of indexed vectors, so every query has true
+# near neighbours the way a "more like this" lookup does
+def sample_queries(index, count, noise, seed=1):
+    rng = np.random.default_rng(seed)
+    rows = rng.choice(np.flatnonzero(index.alive), count, replace=False)
+    queries = np.asarray(index.vectors[rows], dtype=np.float32)
+    return vector_search.normalize(queries + noise * rng.standard_normal(queries.shape) / np.sqrt(index.dim))
+
+# Most common value of each filter column, so filtered runs still match rows
+def common_filters(index, price_range):
+    filters = {}
+    for column in ("category", "color"):
+        codes = index.codes[column][index.codes[column] >= 0]
+        if len(codes):
+            filters[column] = index.vocab[column][np.bincount(codes).argmax()]
+    filters["price"] = price_range
+    return filters
+
+# === Measure ===
+# One query at a time for latency percentiles, then the whole set as one
+# batch for throughput. Returns (p50 ms, p99 ms, batched queries/sec, results).
+def measure(index, queries, k, filters, **options):
+    index.search(queries[:1], k=k, filters=filters, **options)  # warm-up
+    latencies = []
+    found = []
+    for query in queries:
+        began = time.perf_counter()
+        ids, _ = index.search(query, k=k, filters=filters, **options)
+        latencies.append(time.perf_counter() - began)
+        found.append(ids[0])
+    began = time.perf_counter()
+    index.search(queries, k=k, filters=filters, **options)
+    batched = len(queries) / (time.perf_counter() - began)
+    p50, p99 = np.percentile(latencies, [50, 99]) * 1000
+    return p50, p99, batched, np.array(found)
+
+# Share of the exact top-k ids that were returned
+def recall(found, truth):
+    hits = total = 0
+    for got, expected in zip(found, truth):
+        expected = expected[expected >= 0]
+        hits += len(np.intersect1d(got, expected))
+        total += len(expected)
+    return hits / total if total else 1.0
+
+def main():
+    parser = argparse.ArgumentParser(description="Vector search latency (p50/p99) and recall against brute force")
+    parser.add_argument("--dir", default=None, help="benchmark an existing index instead of a synthetic one")
+    parser.add_argument("--rows", type=int, default=200_000, help="synthetic catalog size")
+    parser.add_argument("--dim", type=int, default=1536)
+    parser.add_argument("--dtype", default=vector_search.VECTOR_DTYPE, choices=["float16", "float32"])
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--noise", type=float, default=0.5, help="query perturbation relative to a unit vector")
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--nlist", type=int, default=None, help="IVF lists (default: sqrt(rows))")
+    parser.add_argument("--nprobes", default="1,4,8,16,32", help="comma-separated IVF nprobe values")
+    parser.add_argument("--max-price", type=float, default=80.0, help="price cap for the filtered run")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as scratch:
+        if args.dir:
+            index = VectorIndex(args.dir)
+            source = args.dir
+        else:
+            began = time.perf_counter()
+            index = synthetic_index(scratch, args.rows, args.dim, args.dtype)
+            source = f"synthetic, built in {time.perf_counter() - began:.1f}s"
+        print(f"🧮 {len(index)} rows × {index.dim} {index.dtype.name} ({source})")
+
+        if index.centroids is None:
+            began = time.perf_counter()
+            index.train_ivf(args.nlist)
+            print(f"🗂️  Trained {len(index.centroids)} IVF lists in {time.perf_counter() - began:.1f}s")
+
+        queries = sample_queries(index, min(args.queries, len(index)), args.noise)
+        filtered = common_filters(index, (None, args.max_price))
+        print(f"🔎 Filtered run keeps {int(index.filter_mask(filtered).sum())} rows: {filtered}\n")
+        print(f"{'filter':>10} {'mode':>12} {'p50 ms':>8} {'p99 ms':>8} {'batch q/s':>10} {'recall@' + str(args.k):>10}")
+        for label, filters in (("none", None), ("filtered", filtered)):
+            p50, p99, batched, truth = measure(index, queries, args.k, filters, exact=True)
+            print(f"{label:>10} {'brute force':>12} {p50:>8.2f} {p99:>8.2f} {batched:>10.1f} {1.0:>10.3f}")
+            for nprobe in (int(n) for n in args.nprobes.split(",")):
+                p50, p99, batched, found = measure(index, queries, args.k, filters, nprobe=nprobe)
+                print(f"{label:>10} {f'ivf/{nprobe}':>12} {p50:>8.2f} {p99:>8.2f} {batched:>10.1f} {recall(found, truth):>10.3f}")
+
+if __name__ == "__main__":
+    main()
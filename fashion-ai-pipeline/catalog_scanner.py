@@ -0,0 +1,82 @@
+# catalog_scanner.py
+
+from psycopg2 import sql
+
+# === Scan Settings ===
+DEFAULT_PAGE_SIZE = 500
+FETCH_SIZE = 100  # rows pulled per round trip from the server-side cursor
+
+# === Keyset-paginated catalog scan ===
+# Streams rows ordered by id, one page at a time. Each page is a fresh
+# `WHERE id > last_id ORDER BY id LIMIT n` query, so its cost does not grow
+# with the scan position, and rows inserted or updated by other workers are
+# neither skipped nor repeated the way OFFSET pages are.
+#
+# `where` is a per-stage SQL predicate (e.g. "transparent_image_url IS NULL")
+# that limits the scan to rows the stage still has to process. Rows are
+# yielded as tuples of (id, *columns).
+#
+# Pages are read through a WITH HOLD server-side cursor that is committed as
+# soon as it is declared, so callers can keep committing or rolling back their
+# own writes on the same connection while iterating.
+#
+# `key` names the unique, ordered column to page on, for tables keyed by
+# something other than id (e.g. product_embeddings.product_id).
+def scan_catalog(conn, columns, where=None, params=(), page_size=DEFAULT_PAGE_SIZE,
+                 start_after=None, table="product_catalog", key="id"):
+    projection = sql.SQL(", ").join(sql.Identifier(c) for c in [key, *columns])
+    predicate = sql.SQL(where) if where else sql.SQL("TRUE")
+    query = sql.SQL("""
+        SELECT {projection}
+        FROM {table}
+        WHERE ({predicate}) AND (%s IS NULL OR {key} > %s)
+        ORDER BY {key}
+        LIMIT %s
+    """).format(projection=projection, table=sql.Identifier(table), predicate=predicate, key=sql.Identifier(key))
+
+    last_id = start_after
+    page = 0
+    while True:
+        page_rows = 0
+        with conn.cursor(name=f"catalog_scan_{table}_{page}", withhold=True) as cur:
+            cur.itersize = min(FETCH_SIZE, page_size)
+            cur.execute(query, (*params, last_id, last_id, page_size))
+            conn.commit()
+            for row in cur:
+                page_rows += 1
+                last_id = row[0]
+                yield row
+        conn.commit()
+
+        if page_rows < page_size:
+            break
+        page += 1
+
+# === Page helper ===
+# Groups a row stream into lists of at most `size` rows
+def iter_pages(rows, size):
+    page = []
+    for row in rows:
+        page.append(row)
+        if len(page) >= size:
+            yield page
+            page = []
+    if page:
+        yield page
+
+# Async counterpart for rows handed between pipeline stages: up to `size`
+# queued items, waiting only for the first. Returns None once the stage
+# before has finished; the sentinel is put back for sibling consumers.
+async def take_batch(queue, size):
+    item = await queue.get()
+    if item is None:
+        await queue.put(None)
+        return None
+    batch = [item]
+    while len(batch) < size and not queue.empty():
+        item = queue.get_nowait()
+        if item is None:
+            await queue.put(None)
+            break
+        batch.append(item)
+    return batch
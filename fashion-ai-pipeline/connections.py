@@ -0,0 +1,58 @@
+# connections.py
+
+import os
+import threading
+import psycopg2
+from dotenv import load_dotenv
+
+# === Load ENV ===
+load_dotenv()
+DB_HOST = os.getenv("SUPABASE_DB_HOST")
+DB_NAME = os.getenv("SUPABASE_DB_NAME")
+DB_USER = os.getenv("SUPABASE_DB_USER")
+DB_PASSWORD = os.getenv("SUPABASE_DB_PASSWORD")
+DB_PORT = int(os.getenv("SUPABASE_DB_PORT", 5432))
+DB_SSLMODE = os.getenv("SUPABASE_DB_SSLMODE", "require")  # "disable" for a local Postgres (bench_pipeline.py)
+SUPABASE_URL = os.getenv("SUPABASE_URL")
+SUPABASE_KEY = os.getenv("SUPABASE_KEY")
+
+# === Lazily opened clients ===
+# Nothing connects at import time: a stage module can be imported (and a run
+# with nothing to do can finish) without touching the network. Postgres
+# connections are keyed by name, one per stage, so stages running side by
+# side in one process never commit or roll back each other's writes.
+_lock = threading.Lock()
+_connections = {}
+_supabase = None
+
+def get_conn(name="default"):
+    with _lock:
+        conn = _connections.get(name)
+        if conn is None or conn.closed:
+            conn = _connections[name] = psycopg2.connect(
+                host=DB_HOST,
+                dbname=DB_NAME,
+                user=DB_USER,
+                password=DB_PASSWORD,
+                port=DB_PORT,
+                sslmode=DB_SSLMODE
+            )
+        return conn
+
+def get_supabase():
+    global _supabase
+    with _lock:
+        if _supabase is None:
+            from supabase import create_client
+            _supabase = create_client(SUPABASE_URL, SUPABASE_KEY)
+        return _supabase
+
+def close_conn(name="default"):
+    with _lock:
+        conn = _connections.pop(name, None)
+    if conn is not None and not conn.closed:
+        conn.close()
+
+def close_all():
+    for name in list(_connections):
+        close_conn(name)
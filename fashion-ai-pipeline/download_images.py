@@ -1,28 +1,132 @@
 import os
 import asyncio
+import argparse
+import tempfile
+import mimetypes
+from collections import defaultdict
+from urllib.parse import urlsplit
 import aiohttp
 from dotenv import load_dotenv
-from supabase import create_client, Client
+import metrics
+from work_claims import WorkSource
+from connections import get_conn, close_conn
+from image_hashes import DuplicateIndex, hash_image_file, keys_match
+from job_state import JobState, Watermark, add_job_args, item_ids
+from write_buffer import WriteBehindBuffer, install_shutdown_handlers
 
 # === Load ENV ===
 load_dotenv()
 SUPABASE_URL = os.getenv("SUPABASE_URL")
 SUPABASE_KEY = os.getenv("SUPABASE_KEY")
 BUCKET_NAME = os.getenv("SUPABASE_STORAGE_BUCKET")
-BATCH_SIZE = 50
+SCAN_PAGE_SIZE = 500
+STAGE = "download"
 
-supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
+# === Transfer Settings ===
+CONCURRENCY = int(os.getenv("DOWNLOAD_CONCURRENCY", 32))  # products in flight
+PER_HOST_LIMIT = int(os.getenv("DOWNLOAD_PER_HOST_LIMIT", 8))  # concurrent downloads per image host
+CHUNK_SIZE = 256 * 1024
+SPOOL_MAX_BYTES = 2 * 1024 * 1024  # bodies larger than this spill from memory to a temp file
+DOWNLOAD_TIMEOUT = aiohttp.ClientTimeout(total=None, sock_connect=10, sock_read=10)
+UPLOAD_TIMEOUT = aiohttp.ClientTimeout(total=None, sock_connect=10, sock_read=60)
+PROGRESS_EVERY = 500
 
-# === Fetch a batch of rows ===
-async def fetch_batch(offset):
-    response = supabase.table("product_catalog") \
-        .select("id, parent_sku, image_url, hosted_image_url") \
-        .range(offset, offset + BATCH_SIZE - 1) \
-        .execute()
-    return response.data or []
+# === Job state ===
+# The Postgres connection is opened on first use (see connections.py)
+job_state = JobState()
+
+# === Near-duplicate originals ===
+# Variants that share a photo under different URLs point at one upload; the
+# colour signature keeps colourways shot on the same template apart
+original_index = DuplicateIndex("originals", match_color=True)
+savings = {"originals_reused": 0, "upload_bytes_saved": 0}
+# Uploads in progress by key, so near-duplicates in flight at the same time
+# wait for the first one instead of uploading too
+in_flight_uploads = {}
+
+def image_key(body):
+    try:
+        body.seek(0)
+        return hash_image_file(body)
+    except Exception:
+        return None  # not decodable here (e.g. HEIC); uploaded without dedupe
+
+# === Stream rows that still need a hosted image ===
+def iter_pending_products(source, start_after=None, only_ids=None):
+    where = "hosted_image_url IS NULL AND image_url IS NOT NULL"
+    params = ()
+    if only_ids is not None:
+        where += " AND id = ANY(%s)"
+        params = (only_ids,)
+    rows = source.rows(
+        get_conn(STAGE),
+        ["parent_sku", "image_url", "hosted_image_url"],
+        where=where,
+        params=params,
+        page_size=SCAN_PAGE_SIZE,
+        start_after=start_after
+    )
+    for row_id, parent_sku, image_url, hosted_image_url in rows:
+        yield {
+            "id": row_id,
+            "parent_sku": parent_sku,
+            "image_url": image_url,
+            "hosted_image_url": hosted_image_url
+        }
+
+# URL of an already uploaded near-duplicate of `key`, waiting for one that is
+# still uploading; None if there is none or its upload failed
+async def find_uploaded(key):
+    reused = original_index.find(key)
+    if reused:
+        return reused["url"]
+    for other, upload in list(in_flight_uploads.items()):
+        if keys_match(key, other):
+            return await asyncio.shield(upload)
+    return None
+
+# === Download ===
+# Streams the response into `body` chunk by chunk; returns its Content-Type.
+# Each image host gets at most PER_HOST_LIMIT concurrent downloads.
+async def download_to(session, host_slots, url, body):
+    async with host_slots[urlsplit(url).hostname]:
+        async with session.get(url, timeout=DOWNLOAD_TIMEOUT) as resp:
+            if resp.status != 200:
+                raise Exception(f"HTTP {resp.status}")
+            async for chunk in resp.content.iter_chunked(CHUNK_SIZE):
+                body.write(chunk)
+            return resp.headers.get("Content-Type", "")
+
+# === Upload to Supabase Storage ===
+# Storage's REST endpoint on the shared session, streamed from `body`, so
+# uploads never block the event loop
+async def upload_from(session, file_path, body, size, content_type):
+    body.seek(0)
+
+    async def chunks():
+        while True:
+            chunk = body.read(CHUNK_SIZE)
+            if not chunk:
+                return
+            yield chunk
+
+    headers = {
+        "Authorization": f"Bearer {SUPABASE_KEY}",
+        "apikey": SUPABASE_KEY,
+        "Content-Type": content_type,
+        "Content-Length": str(size),
+        "x-upsert": "true"
+    }
+    url = f"{SUPABASE_URL}/storage/v1/object/{BUCKET_NAME}/{file_path}"
+    async with session.post(url, data=chunks(), headers=headers, timeout=UPLOAD_TIMEOUT) as resp:
+        if resp.status >= 300:
+            raise Exception(f"Upload HTTP {resp.status}: {await resp.text()}")
 
 # === Process one product ===
-async def process_product(session, product):
+# Returns the hosted URL when it was queued for write-back (its job state is
+# then recorded by the buffer's flush callback), otherwise None.
+async def process_product(session, host_slots, product, url_buffer):
+    loop = asyncio.get_running_loop()
     parent_sku = product.get("parent_sku")
     image_url = product.get("image_url")
     hosted_image_url = product.get("hosted_image_url")
@@ -30,55 +134,152 @@ async def process_product(session, product):
 
     if not parent_sku or not image_url or not row_id:
         print(f"⚠️  Skipping row due to missing fields")
-        return
+        if row_id:
+            job_state.mark_skipped(STAGE, row_id, "missing fields")
+        return None
 
     if hosted_image_url:
         print(f"⏩ Already uploaded: {parent_sku}")
-        return
+        job_state.mark_done(STAGE, row_id)
+        return None
 
     try:
-        async with session.get(image_url, timeout=10) as resp:
-            if resp.status != 200:
-                raise Exception(f"HTTP {resp.status}")
-            content = await resp.read()
+        with tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_BYTES) as body:
+            with metrics.step(STAGE, "fetch"):
+                content_type = await download_to(session, host_slots, image_url, body)
+            size = body.tell()
 
-        # Extract file extension safely
-        extension = image_url.split("?")[0].split(".")[-1].split("/")[-1]
-        file_path = f"originals/{parent_sku}.{extension}"
+            key = await loop.run_in_executor(None, image_key, body)
+            reused_url = await find_uploaded(key) if key else None
+            if reused_url:
+                await loop.run_in_executor(None, url_buffer.add, row_id, reused_url)
+                savings["originals_reused"] += 1
+                savings["upload_bytes_saved"] += size
+                print(f"♻️ {parent_sku} is a near-duplicate of an uploaded image: {reused_url}")
+                return reused_url
 
-        # Upload to Supabase Storage
-        supabase.storage.from_(BUCKET_NAME).upload(
-            path=file_path,
-            file=content,
-            file_options={"content-type": f"image/{extension}"}
-        )
+            # Extract file extension safely
+            extension = image_url.split("?")[0].split(".")[-1].split("/")[-1]
+            file_path = f"originals/{parent_sku}.{extension}"
+            if not content_type.startswith("image/"):
+                content_type = mimetypes.guess_type(file_path)[0] or f"image/{extension}"
 
-        public_url = f"{SUPABASE_URL}/storage/v1/object/public/{BUCKET_NAME}/{file_path}"
+            public_url = f"{SUPABASE_URL}/storage/v1/object/public/{BUCKET_NAME}/{file_path}"
+            upload = loop.create_future()
+            if key:
+                in_flight_uploads[key] = upload
+            try:
+                with metrics.step(STAGE, "upload"):
+                    await upload_from(session, file_path, body, size, content_type)
+                if key:
+                    original_index.add(key, {"url": public_url})
+                upload.set_result(public_url)
+            finally:
+                if not upload.done():
+                    upload.set_result(None)
+                in_flight_uploads.pop(key, None)
 
-        # Update Supabase row
-        supabase.table("product_catalog").update({
-            "hosted_image_url": public_url
-        }).eq("id", row_id).execute()
+        # Queue the row update for batched write-back; a full buffer flushes
+        # off the event loop
+        await loop.run_in_executor(None, url_buffer.add, row_id, public_url)
 
         print(f"✅ Uploaded {parent_sku}: {public_url}")
+        return public_url
 
     except Exception as e:
         print(f"❌ Failed {parent_sku}: {e}")
+        job_state.mark_failed(STAGE, row_id, e)
+    return None
 
 # === Main runner ===
-async def main():
-    offset = 0
-    while True:
-        batch = await fetch_batch(offset)
-        if not batch:
-            break
+# Products are fed continuously: a new one starts as soon as any of the
+# CONCURRENCY in-flight products finishes, with no per-batch barrier.
+async def main(resume=False, retry_failed=False, concurrency=CONCURRENCY, shard=None, claim=False):
+    source = WorkSource(STAGE, shard=shard, claim=claim)
+    checkpoint_stage = source.checkpoint_stage
+    start_after = job_state.get_checkpoint(checkpoint_stage) if resume and source.checkpoints else None
+    only_ids = item_ids(job_state.failed_keys(STAGE)) if retry_failed else None
+    checkpoints = only_ids is None and source.checkpoints
+    if only_ids is not None:
+        print(f"🔁 Retrying {len(only_ids)} failed products")
+    elif start_after is not None:
+        print(f"⏯️ Resuming after id {start_after}")
+
+    install_shutdown_handlers()
+    loop = asyncio.get_running_loop()
+    watermark = Watermark(start_after)
+
+    # Products count as done, and the checkpoint moves past them, only once
+    # their URL has been flushed to product_catalog
+    def finish(*row_ids):
+        for row_id in row_ids:
+            watermark.finish(row_id)
+        source.release(*row_ids)
+        if checkpoints:
+            job_state.set_checkpoint(checkpoint_stage, watermark.value)
+
+    def on_flush(row_ids):
+        job_state.mark_done(STAGE, *row_ids)
+        finish(*row_ids)
+
+    url_buffer = WriteBehindBuffer(["hosted_image_url"], on_flush=on_flush, stage=STAGE)
+    slots = asyncio.Semaphore(concurrency)
+    host_slots = defaultdict(lambda: asyncio.Semaphore(PER_HOST_LIMIT))
+
+    async def run(session, product):
+        try:
+            queued = await process_product(session, host_slots, product, url_buffer)
+        except Exception as e:
+            print(f"❌ Failed {product.get('parent_sku')}: {e}")
+            job_state.mark_failed(STAGE, product["id"], e)
+            queued = False
+        finally:
+            slots.release()
+        if not queued:
+            finish(product["id"])
+
+    connector = aiohttp.TCPConnector(limit=concurrency * 2, limit_per_host=0)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        in_flight = set()
+        metrics.watch("pipeline_queue_depth", lambda: len(in_flight), stage=STAGE, queue="in_flight")
+        products = iter_pending_products(source, start_after, only_ids)
+        started = 0
+        while True:
+            await slots.acquire()
+            product = await loop.run_in_executor(None, next, products, None)
+            if product is None:
+                slots.release()
+                break
+            watermark.start(product["id"])
+            task = asyncio.create_task(run(session, product))
+            in_flight.add(task)
+            task.add_done_callback(in_flight.discard)
+            started += 1
+            if started % PROGRESS_EVERY == 0:
+                print(f"\n🚚 Started {started} products")
+        await asyncio.gather(*in_flight)
 
-        print(f"\n🚚 Processing batch {offset} → {offset + BATCH_SIZE - 1}")
-        async with aiohttp.ClientSession() as session:
-            tasks = [process_product(session, product) for product in batch]
-            await asyncio.gather(*tasks)
+    await loop.run_in_executor(None, url_buffer.close)
+    source.close()
+    print(f"♻️ Near-duplicate savings: {savings}")
+    original_index.close()
 
-        offset += BATCH_SIZE
+    # A completed scan starts from the top next time
+    if checkpoints:
+        job_state.set_checkpoint(checkpoint_stage, None)
+    print(f"📊 {STAGE}: {job_state.summary(STAGE)}")
+    job_state.close()
+    close_conn(STAGE)
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    parser = add_job_args(argparse.ArgumentParser())
+    parser.add_argument("--concurrency", type=int, default=CONCURRENCY, help="products downloading/uploading at once")
+    args = parser.parse_args()
+    metrics.start(STAGE)
+    asyncio.run(main(
+        resume=args.resume,
+        retry_failed=args.retry_failed,
+        concurrency=args.concurrency,
+        shard=args.shard,
+        claim=args.claim
+    ))
@@ -0,0 +1,356 @@
+# generate_layflats.py
+
+import os
+import io
+import json
+import time
+import hashlib
+import argparse
+import statistics
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+from PIL import Image
+from dotenv import load_dotenv
+import metrics
+from connections import get_conn, get_supabase, close_conn
+from image_cache import ImageCache, IMAGE_CACHE_DIR
+from job_state import JobState
+
+# === Load ENV ===
+load_dotenv()
+
+SUPABASE_URL = os.getenv("SUPABASE_URL")
+SUPABASE_BUCKET = os.getenv("SUPABASE_STORAGE_BUCKET")
+
+# === Layflat Settings ===
+CANVAS_WIDTH = int(os.getenv("LAYFLAT_WIDTH", 1200))
+CANVAS_HEIGHT = int(os.getenv("LAYFLAT_HEIGHT", 1500))
+PADDING = int(os.getenv("LAYFLAT_PADDING", 48))  # around the canvas edge and between items
+BACKGROUND = tuple(int(c) for c in os.getenv("LAYFLAT_BACKGROUND", "245,243,240").split(","))
+LAYFLAT_FORMAT = os.getenv("LAYFLAT_FORMAT", "webp")  # webp | jpeg | png
+LAYFLAT_QUALITY = int(os.getenv("LAYFLAT_QUALITY", 90))
+LAYFLAT_WEBP_METHOD = int(os.getenv("LAYFLAT_WEBP_METHOD", 2))  # 0 (fast) - 6 (smallest); 4 is ~2x slower for ~1% smaller
+LAYFLAT_CONTENT_TYPES = {"webp": "image/webp", "jpeg": "image/jpeg", "png": "image/png"}
+if LAYFLAT_FORMAT not in LAYFLAT_CONTENT_TYPES:
+    raise ValueError(f"LAYFLAT_FORMAT must be one of {sorted(LAYFLAT_CONTENT_TYPES)}, got {LAYFLAT_FORMAT!r}")
+
+# === Parallelism Settings ===
+LAYFLAT_WORKERS = int(os.getenv("LAYFLAT_WORKERS", os.cpu_count() or 1))
+OUTFITS_PER_TASK = int(os.getenv("LAYFLAT_OUTFITS_PER_TASK", 16))
+DECODE_CACHE_MB = int(os.getenv("LAYFLAT_DECODE_CACHE_MB", 512))  # decoded cutouts kept by each worker
+
+# Items are laid out top to bottom, left to right in this order; categories
+# match on the first keyword found in product_catalog.category
+CATEGORY_ORDER = [
+    ("outerwear", ("coat", "jacket", "blazer", "parka", "gilet")),
+    ("tops", ("top", "shirt", "blouse", "sweater", "knit", "cardigan", "hoodie", "tee", "vest")),
+    ("dresses", ("dress", "jumpsuit", "romper")),
+    ("bottoms", ("pant", "trouser", "jean", "skirt", "short", "legging")),
+    ("shoes", ("shoe", "sneaker", "trainer", "boot", "heel", "sandal", "loafer", "flat")),
+    ("bags", ("bag", "tote", "clutch", "backpack")),
+    ("accessories", ())
+]
+
+# === Job state ===
+# Items are keyed by layflat name
+STAGE = "layflat"
+job_state = JobState()
+
+def category_rank(category):
+    category = (category or "").lower()
+    for rank, (_, keywords) in enumerate(CATEGORY_ORDER):
+        if any(keyword in category for keyword in keywords):
+            return rank
+    return len(CATEGORY_ORDER) - 1
+
+# Deterministic name for an outfit without one, from its product ids
+def outfit_name(product_ids):
+    return "outfit-" + hashlib.sha1(",".join(map(str, product_ids)).encode()).hexdigest()[:12]
+
+# === Layout ===
+# Justified rows: items keep their order and are split into rows with about
+# the same total aspect ratio; each row is scaled to fill the canvas width,
+# then everything is scaled down to fit the height and centred. Every row
+# count is tried and the one that covers the most canvas wins, so the layout
+# depends only on the item sizes and the canvas. Returns (x, y, w, h) per item.
+def split_rows(aspects, count):
+    rows, start = [], 0
+    remaining = sum(aspects)
+    for row in range(count):
+        if row == count - 1:
+            rows.append(list(range(start, len(aspects))))
+            break
+        target = remaining / (count - row)
+        end, width = start, 0.0
+        # Leave at least one item for each remaining row
+        while end < len(aspects) - (count - row - 1) and (end == start or width + aspects[end] / 2 <= target):
+            width += aspects[end]
+            end += 1
+        rows.append(list(range(start, end)))
+        remaining -= width
+        start = end
+    return rows
+
+def plan_layout(sizes, width=CANVAS_WIDTH, height=CANVAS_HEIGHT, padding=PADDING):
+    if not sizes:
+        return []
+    aspects = [w / h for w, h in sizes]
+    best = None
+    for count in range(1, len(sizes) + 1):
+        rows = split_rows(aspects, count)
+        heights = [
+            (width - padding * (len(row) + 1)) / sum(aspects[i] for i in row)
+            for row in rows
+        ]
+        available = height - padding * (len(rows) + 1)
+        if available <= 0 or min(heights) <= 0:
+            continue
+        scale = min(1.0, available / sum(heights))
+        coverage = sum((h * scale) ** 2 * aspects[i] for row, h in zip(rows, heights) for i in row)
+        if best is None or coverage > best[0]:
+            best = (coverage, rows, [h * scale for h in heights])
+    if best is None:
+        raise ValueError(f"{len(sizes)} items do not fit a {width}x{height} canvas with padding {padding}")
+
+    _, rows, heights = best
+    boxes = [None] * len(sizes)
+    y = (height - sum(heights) - padding * (len(rows) - 1)) / 2
+    for row, row_height in zip(rows, heights):
+        row_width = sum(aspects[i] * row_height for i in row) + padding * (len(row) - 1)
+        x = (width - row_width) / 2
+        for i in row:
+            item_width = aspects[i] * row_height
+            boxes[i] = (int(round(x)), int(round(y)), max(1, int(round(item_width))), max(1, int(round(row_height))))
+            x += item_width + padding
+        y += row_height + padding
+    return boxes
+
+# === Decoded cutouts (one cache per worker process) ===
+# Cutout bytes come through the on-disk image cache; decoded cutouts are kept
+# trimmed to their alpha box and premultiplied ("RGBa"), so an outfit that
+# reuses a product skips the fetch, decode and trim. Least recently used ones
+# are dropped past `max_bytes`.
+class DecodedCutouts:
+    def __init__(self, image_cache, max_bytes=DECODE_CACHE_MB * 1024 ** 2):
+        self.image_cache = image_cache
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self.stats = {"hits": 0, "decoded": 0}
+
+    def get(self, url, trim=None):
+        cutout = self.entries.get(url)
+        if cutout is not None:
+            self.entries.move_to_end(url)
+            self.stats["hits"] += 1
+            return cutout
+        cutout = self.decode(url, trim)
+        self.stats["decoded"] += 1
+        size = cutout.width * cutout.height * 4
+        if size <= self.max_bytes:
+            self.entries[url] = cutout
+            self.total_bytes += size
+            while self.total_bytes > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.total_bytes -= evicted.width * evicted.height * 4
+        return cutout
+
+    # The stored `trim` box (see remove_background.encode_cutout) is used when
+    # it fits; cutouts uploaded before it existed are trimmed to their alpha
+    def decode(self, url, trim=None):
+        with metrics.step(STAGE, "fetch"):
+            content = self.image_cache.fetch(url)
+        with metrics.step(STAGE, "decode"):
+            image = Image.open(content)
+            image = image.convert("RGBA") if image.mode != "RGBA" else image
+            if trim and trim[0] + trim[2] <= image.width and trim[1] + trim[3] <= image.height:
+                box = (trim[0], trim[1], trim[0] + trim[2], trim[1] + trim[3])
+            else:
+                box = image.getchannel("A").getbbox()
+            if box is None:
+                raise ValueError(f"Cutout {url} is fully transparent")
+            return image.crop(box).convert("RGBa")
+
+# === Compositing ===
+# Cutouts are premultiplied, so "over" is src + dst * (255 - alpha) / 255,
+# done for a whole item at once in 16-bit integers (at most 255 * 255)
+def blend_over(canvas, cutout, box):
+    x, y, w, h = box
+    resized = cutout.resize((w, h), Image.BILINEAR, reducing_gap=2.0) if cutout.size != (w, h) else cutout
+    src = np.asarray(resized)
+    region = canvas[y:y + h, x:x + w]
+    src = src[:region.shape[0], :region.shape[1]]
+    inverse = 255 - src[..., 3:4].astype(np.uint16)
+    region[...] = src[..., :3] + (region.astype(np.uint16) * inverse + 127) // 255
+
+def encode_layflat(canvas, fmt=LAYFLAT_FORMAT, quality=LAYFLAT_QUALITY, method=LAYFLAT_WEBP_METHOD):
+    output = io.BytesIO()
+    image = Image.fromarray(canvas)
+    if fmt == "webp":
+        image.save(output, format="WEBP", quality=quality, method=method)
+    elif fmt == "jpeg":
+        image.save(output, format="JPEG", quality=quality, optimize=True)
+    else:
+        image.save(output, format="PNG", compress_level=3)
+    return output.getvalue()
+
+# `items` are {"url", "trim"} dicts already in layout order
+def render_layflat(items, cutouts, width=CANVAS_WIDTH, height=CANVAS_HEIGHT, padding=PADDING, background=BACKGROUND):
+    images = [cutouts.get(item["url"], item.get("trim")) for item in items]
+    with metrics.step(STAGE, "composite"):
+        boxes = plan_layout([image.size for image in images], width, height, padding)
+        canvas = np.empty((height, width, 3), dtype=np.uint8)
+        canvas[...] = background
+        for image, box in zip(images, boxes):
+            blend_over(canvas, image, box)
+    with metrics.step(STAGE, "encode"):
+        return encode_layflat(canvas)
+
+def save_layflat(name, data, output_dir=None):
+    file_name = f"{name}.{LAYFLAT_FORMAT}"
+    if output_dir:
+        path = os.path.join(output_dir, file_name)
+        with open(path, "wb") as f:
+            f.write(data)
+        return path
+    file_path = f"layflats/{file_name}"
+    with metrics.step(STAGE, "upload"):
+        get_supabase().storage.from_(SUPABASE_BUCKET).upload(
+            path=file_path,
+            file=data,
+            file_options={"content-type": LAYFLAT_CONTENT_TYPES[LAYFLAT_FORMAT]},
+            upsert=True
+        )
+    return f"{SUPABASE_URL}/storage/v1/object/public/{SUPABASE_BUCKET}/{file_path}"
+
+# === Worker processes ===
+# Each worker opens its own image cache handle (SQLite must not cross fork)
+# and keeps its decoded cutouts for the whole run
+cutouts = None
+
+def init_layflat_worker(cache_dir=IMAGE_CACHE_DIR, decode_cache_mb=DECODE_CACHE_MB):
+    global cutouts
+    metrics.reset()
+    cutouts = DecodedCutouts(ImageCache(cache_dir), decode_cache_mb * 1024 ** 2)
+
+# Renders a chunk of outfits; returns (name, location, error, seconds) per
+# outfit, the worker's decode cache stats so far, and its metrics
+def render_outfits(outfits, output_dir=None):
+    results = []
+    for outfit in outfits:
+        began = time.perf_counter()
+        try:
+            data = render_layflat(outfit["items"], cutouts)
+            results.append((outfit["name"], save_layflat(outfit["name"], data, output_dir), None,
+                            time.perf_counter() - began))
+        except Exception as e:
+            results.append((outfit["name"], None, str(e), time.perf_counter() - began))
+    return results, (os.getpid(), dict(cutouts.stats)), metrics.drain()
+
+# Outfits sharing products are put in the same chunk, so one worker decodes
+# each shared cutout once
+def chunk_outfits(outfits, size=OUTFITS_PER_TASK):
+    ordered = sorted(outfits, key=lambda outfit: sorted(item["url"] for item in outfit["items"]))
+    return [ordered[start:start + size] for start in range(0, len(ordered), size)]
+
+def render_all(outfits, workers=LAYFLAT_WORKERS, output_dir=None, cache_dir=IMAGE_CACHE_DIR,
+               decode_cache_mb=DECODE_CACHE_MB, outfits_per_task=OUTFITS_PER_TASK, on_result=None):
+    results, cache_stats = [], {}
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_layflat_worker,
+                             initargs=(cache_dir, decode_cache_mb)) as pool:
+        futures = [pool.submit(render_outfits, chunk, output_dir) for chunk in chunk_outfits(outfits, outfits_per_task)]
+        for future in as_completed(futures):
+            chunk_results, (pid, stats), worker_metrics = future.result()
+            metrics.merge(worker_metrics)
+            cache_stats[pid] = stats
+            results.extend(chunk_results)
+            if on_result:
+                for result in chunk_results:
+                    on_result(*result)
+    totals = {"hits": sum(s["hits"] for s in cache_stats.values()), "decoded": sum(s["decoded"] for s in cache_stats.values())}
+    return results, totals
+
+# === Outfits ===
+# One JSON object per line: {"name": optional, "products": [product_catalog ids]}
+def read_outfits(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def fetch_cutouts(product_ids):
+    conn = get_conn(STAGE)
+    with conn.cursor() as cursor:
+        cursor.execute("""
+            SELECT id, parent_sku, category, transparent_image_url, transparent_image_meta
+            FROM product_catalog
+            WHERE id = ANY(%s) AND transparent_image_url IS NOT NULL
+        """, (list(product_ids),))
+        rows = cursor.fetchall()
+    conn.commit()
+    return {row[0]: row[1:] for row in rows}
+
+# Resolves product ids to cutout items in layout order; products without a
+# cutout are left out with a warning
+def build_outfits(specs):
+    products = fetch_cutouts({int(pid) for spec in specs for pid in spec["products"]})
+    outfits = []
+    for spec in specs:
+        product_ids = [int(pid) for pid in spec["products"]]
+        name = spec.get("name") or outfit_name(product_ids)
+        missing = [pid for pid in product_ids if pid not in products]
+        if missing:
+            print(f"⚠️ [{name}] No cutout yet for products {missing}")
+        present = [pid for pid in product_ids if pid in products]
+        if not present:
+            job_state.mark_skipped(STAGE, name, "no cutouts")
+            continue
+        present.sort(key=lambda pid: (category_rank(products[pid][1]), product_ids.index(pid)))
+        items = []
+        for pid in present:
+            _, _, url, meta = products[pid]
+            meta = json.loads(meta) if isinstance(meta, str) else (meta or {})
+            items.append({"url": url, "trim": meta.get("trim")})
+        outfits.append({"name": name, "items": items})
+    return outfits
+
+# === Main ===
+def main(specs, workers=LAYFLAT_WORKERS, output_dir=None):
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
+    outfits = build_outfits(specs)
+    print(f"🧩 Rendering {len(outfits)} layflats on {workers} workers")
+
+    def on_result(name, location, error, seconds):
+        if error:
+            print(f"❌ [{name}] {error}", flush=True)
+            job_state.mark_failed(STAGE, name, error)
+        else:
+            print(f"🖼️  [{name}] {location} ({seconds * 1000:.0f} ms)", flush=True)
+            job_state.mark_done(STAGE, name)
+
+    began = time.perf_counter()
+    results, cache_stats = render_all(outfits, workers, output_dir, on_result=on_result)
+    elapsed = time.perf_counter() - began
+    rendered = sum(1 for _, location, _, _ in results if location)
+    print(f"⚡ {rendered} layflats in {elapsed:.1f}s — {rendered / elapsed if elapsed else 0:.1f}/s")
+    print(f"🧠 Decoded cutouts: {cache_stats['decoded']} decoded, {cache_stats['hits']} reused")
+    if results:
+        print(f"⏱️ Median render {statistics.median(seconds for *_, seconds in results) * 1000:.0f} ms")
+    print(f"📊 {STAGE}: {job_state.summary(STAGE)}")
+    job_state.close()
+    close_conn(STAGE)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compose layflat images of outfits from transparent cutouts")
+    parser.add_argument("--outfits", help="JSON lines file of {\"name\": ..., \"products\": [ids]}")
+    parser.add_argument("--outfit", action="append", default=[], help="comma-separated product ids; may be repeated")
+    parser.add_argument("--workers", type=int, default=LAYFLAT_WORKERS, help="compositing processes")
+    parser.add_argument("--output-dir", help="write files here instead of uploading to Supabase Storage")
+    args = parser.parse_args()
+
+    specs = read_outfits(args.outfits) if args.outfits else []
+    specs += [{"products": [pid for pid in outfit.split(",") if pid.strip()]} for outfit in args.outfit]
+    if not specs:
+        parser.error("give --outfits or at least one --outfit")
+    metrics.start(STAGE)
+    main(specs, workers=args.workers, output_dir=args.output_dir)
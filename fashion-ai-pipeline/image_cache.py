@@ -0,0 +1,221 @@
+# image_cache.py
+
+import os
+import mmap
+import time
+import sqlite3
+import hashlib
+import threading
+import requests
+
+# === Cache Settings ===
+IMAGE_CACHE_DIR = os.getenv("IMAGE_CACHE_DIR", ".cache/images")
+IMAGE_CACHE_MAX_BYTES = int(os.getenv("IMAGE_CACHE_MAX_BYTES", 20 * 1024 ** 3))
+IMAGE_CACHE_MAX_AGE = float(os.getenv("IMAGE_CACHE_MAX_AGE", 7 * 24 * 3600))  # seconds before revalidating
+FETCH_TIMEOUT = 10
+EVICT_TARGET = 0.9  # evict down to this fraction of the size limit
+
+# === Content-addressed image cache ===
+# Blobs are stored once per sha256 of their content under blobs/ab/abcdef...,
+# so the same photo behind several URLs is stored once. An SQLite index maps
+# each URL to its blob plus the ETag / Last-Modified it was served with;
+# entries older than `max_age` are revalidated with a conditional GET, and a
+# URL is never requested twice in one run. Least-recently-used blobs are
+# evicted once the cache exceeds `max_bytes`.
+#
+# One directory is shared by every process of a run (forked inference
+# workers, the layflat pool), so the cache size lives in the index too: the
+# `totals` row is kept in step with `blobs` by triggers, in the same
+# transaction as each insert or delete, and eviction re-reads it under
+# SQLite's write lock so only one process evicts for a given overshoot.
+class ImageCache:
+    def __init__(self, directory=IMAGE_CACHE_DIR, max_bytes=IMAGE_CACHE_MAX_BYTES, max_age=IMAGE_CACHE_MAX_AGE):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        os.makedirs(os.path.join(directory, "blobs"), exist_ok=True)
+        self.lock = threading.Lock()
+        self.http = requests.Session()
+        self.seen_this_run = {}
+        self.stats = {"hits": 0, "revalidated": 0, "fetched": 0, "bytes_fetched": 0, "evicted": 0}
+
+        self.db = sqlite3.connect(os.path.join(directory, "index.sqlite3"), check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS urls (
+                url TEXT PRIMARY KEY,
+                sha TEXT NOT NULL,
+                etag TEXT,
+                last_modified TEXT,
+                validated_at REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS blobs (
+                sha TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                last_used REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS blobs_last_used ON blobs (last_used);
+            CREATE TABLE IF NOT EXISTS totals (
+                name TEXT PRIMARY KEY,
+                value INTEGER NOT NULL
+            );
+            CREATE TRIGGER IF NOT EXISTS blobs_added AFTER INSERT ON blobs BEGIN
+                UPDATE totals SET value = value + NEW.size WHERE name = 'bytes';
+            END;
+            CREATE TRIGGER IF NOT EXISTS blobs_removed AFTER DELETE ON blobs BEGIN
+                UPDATE totals SET value = value - OLD.size WHERE name = 'bytes';
+            END;
+        """)
+        # Caches created before the totals row existed start from a full count
+        self.db.execute("INSERT OR IGNORE INTO totals (name, value) SELECT 'bytes', COALESCE(SUM(size), 0) FROM blobs")
+        self.db.commit()
+
+    # Bytes stored by every process sharing this directory
+    @property
+    def total_bytes(self):
+        with self.lock:
+            return self._total_bytes()
+
+    def _total_bytes(self):
+        row = self.db.execute("SELECT value FROM totals WHERE name = 'bytes'").fetchone()
+        return row[0] if row else 0
+
+    def blob_path(self, sha):
+        return os.path.join(self.directory, "blobs", sha[:2], sha)
+
+    # Read-only memory map of a blob; usable anywhere bytes or a file object are
+    # expected (Image.open accepts it directly)
+    def open_blob(self, sha):
+        with open(self.blob_path(sha), "rb") as f:
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def _store_blob(self, content):
+        sha = hashlib.sha256(content).hexdigest()
+        path = self.blob_path(sha)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(content)
+            os.replace(tmp_path, path)
+        with self.lock:
+            self.db.execute(
+                "INSERT OR IGNORE INTO blobs (sha, size, last_used) VALUES (?, ?, ?)", (sha, len(content), time.time())
+            )
+            self.db.commit()
+        return sha
+
+    def _touch(self, sha, revalidated_url=None):
+        now = time.time()
+        with self.lock:
+            if revalidated_url:
+                self.db.execute("UPDATE urls SET validated_at = ? WHERE url = ?", (now, revalidated_url))
+            self.db.execute("UPDATE blobs SET last_used = ? WHERE sha = ?", (now, sha))
+            self.db.commit()
+
+    def _record(self, url, sha, etag, last_modified):
+        with self.lock:
+            self.db.execute("""
+                INSERT OR REPLACE INTO urls (url, sha, etag, last_modified, validated_at)
+                VALUES (?, ?, ?, ?, ?)
+            """, (url, sha, etag, last_modified, time.time()))
+            self.db.commit()
+
+    # Returns (sha, headers): headers is None when the cached blob is fresh,
+    # conditional-request headers when it is stale, and {} when nothing usable
+    # is cached (sha is then None)
+    def lookup(self, url):
+        sha = self.seen_this_run.get(url)
+        if sha and os.path.exists(self.blob_path(sha)):
+            self.stats["hits"] += 1
+            return sha, None
+
+        with self.lock:
+            entry = self.db.execute(
+                "SELECT sha, etag, last_modified, validated_at FROM urls WHERE url = ?", (url,)
+            ).fetchone()
+        if not entry or not os.path.exists(self.blob_path(entry[0])):
+            return None, {}
+
+        sha, etag, last_modified, validated_at = entry
+        if time.time() - validated_at < self.max_age:
+            self.stats["hits"] += 1
+            self._touch(sha)
+            self.seen_this_run[url] = sha
+            return sha, None
+
+        headers = {}
+        if etag:
+            headers["If-None-Match"] = etag
+        if last_modified:
+            headers["If-Modified-Since"] = last_modified
+        return sha, headers
+
+    # The server answered 304 for a stale entry
+    def revalidated(self, url, sha):
+        self.stats["revalidated"] += 1
+        self._touch(sha, revalidated_url=url)
+        self.seen_this_run[url] = sha
+        return sha
+
+    def store(self, url, content, etag=None, last_modified=None):
+        if not content:
+            raise ValueError(f"Empty response body from {url}")
+        sha = self._store_blob(content)
+        self._record(url, sha, etag, last_modified)
+        self.seen_this_run[url] = sha
+        self.stats["fetched"] += 1
+        self.stats["bytes_fetched"] += len(content)
+        if self.total_bytes > self.max_bytes:
+            self.evict()
+        return sha
+
+    # Returns an mmap of the image at `url`, fetching it only when it is not
+    # cached, is stale and has changed, or its blob was evicted
+    def fetch(self, url):
+        sha, headers = self.lookup(url)
+        if headers is None:
+            return self.open_blob(sha)
+
+        response = self.http.get(url, headers=headers, timeout=FETCH_TIMEOUT)
+        if sha and response.status_code == 304:
+            return self.open_blob(self.revalidated(url, sha))
+
+        response.raise_for_status()
+        sha = self.store(url, response.content, response.headers.get("ETag"), response.headers.get("Last-Modified"))
+        return self.open_blob(sha)
+
+    # BEGIN IMMEDIATE takes the write lock before the size is read, so a
+    # process that waited on another's eviction sees the reduced total
+    def evict(self):
+        target = int(self.max_bytes * EVICT_TARGET)
+        removed = []
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                total = self._total_bytes()
+                if total > target:
+                    for sha, size in self.db.execute("SELECT sha, size FROM blobs ORDER BY last_used"):
+                        if total <= target:
+                            break
+                        total -= size
+                        removed.append(sha)
+                    self.db.executemany("DELETE FROM blobs WHERE sha = ?", [(sha,) for sha in removed])
+                    self.db.executemany("DELETE FROM urls WHERE sha = ?", [(sha,) for sha in removed])
+                    for sha in removed:
+                        try:
+                            os.remove(self.blob_path(sha))
+                        except FileNotFoundError:
+                            pass
+                self.db.commit()
+            except Exception:
+                self.db.rollback()
+                raise
+        self.stats["evicted"] += len(removed)
+        return len(removed)
+
+    def close(self):
+        self.http.close()
+        with self.lock:
+            self.db.close()
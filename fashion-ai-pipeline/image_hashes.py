@@ -0,0 +1,275 @@
+# image_hashes.py
+
+import os
+import json
+import sqlite3
+import threading
+import numpy as np
+from io import BytesIO
+from PIL import Image
+
+# === Dedupe Settings ===
+DEDUPE_INDEX_PATH = os.getenv("DEDUPE_INDEX_PATH", ".cache/image_hashes.sqlite3")
+PHASH_MAX_DISTANCE = int(os.getenv("PHASH_MAX_DISTANCE", 4))  # bits out of 64
+DHASH_MAX_DISTANCE = int(os.getenv("DHASH_MAX_DISTANCE", 8))  # second opinion, filters pHash collisions
+COLOR_MAX_DIFFERENCE = int(os.getenv("COLOR_MAX_DIFFERENCE", 12))  # per cell and channel, out of 255
+PHASH_SIZE = 32  # DCT input side; the hash keeps the 8x8 lowest frequencies
+COLOR_GRID = 4  # colour signature: mean R, G, B over a COLOR_GRID x COLOR_GRID grid
+MERGE_EVERY = 4096  # codes kept in the unsorted tail before it is merged into the lookup tables
+
+POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+def _dct_matrix(n):
+    k = np.arange(n)[:, None]
+    i = np.arange(n)[None, :]
+    matrix = np.cos(np.pi * (2 * i + 1) * k / (2 * n)) * np.sqrt(2 / n)
+    matrix[0] /= np.sqrt(2)
+    return matrix.astype(np.float32)
+
+DCT = _dct_matrix(PHASH_SIZE)
+
+# (N, 64) bools -> N uint64 codes, first bit most significant
+def _pack(bits):
+    return np.packbits(bits, axis=1).view(">u8").ravel().astype(np.uint64)
+
+def hamming(a, b):
+    return POPCOUNT[np.ascontiguousarray(np.bitwise_xor(a, b), dtype=np.uint64).view(np.uint8)].reshape(-1, 8).sum(axis=1)
+
+# === Perceptual hashes ===
+# pHash (sign of the low-frequency DCT against its median) and dHash
+# (horizontal gradient signs), computed for a whole batch at once. Returns two
+# uint64 arrays.
+def hash_images(images):
+    if not images:
+        return np.zeros(0, dtype=np.uint64), np.zeros(0, dtype=np.uint64)
+    gray = [image if image.mode == "L" else image.convert("L") for image in images]
+
+    pixels = np.stack([np.asarray(g.resize((PHASH_SIZE, PHASH_SIZE), Image.BILINEAR), dtype=np.float32) for g in gray])
+    low = (DCT @ pixels @ DCT.T)[:, :8, :8].reshape(len(images), 64)
+    median = np.median(low[:, 1:], axis=1, keepdims=True)  # the DC term would dominate the median
+    phashes = _pack(low > median)
+
+    gradients = np.stack([np.asarray(g.resize((9, 8), Image.BILINEAR), dtype=np.int16) for g in gray])
+    dhashes = _pack((gradients[:, :, 1:] > gradients[:, :, :-1]).reshape(len(images), 64))
+    return phashes, dhashes
+
+# === Colour signatures ===
+# Both hashes are luma only, so a colour variant shot on the same template (or
+# a hue-rotated copy) hashes the same as the original. Anything that reuses
+# another image's result as its own (an uploaded original, a cutout) also
+# compares these coarse per-channel means; re-encoding and resizing move them
+# by a few levels, a different colourway by far more. Returns one
+# COLOR_GRID * COLOR_GRID * 3 byte string per image.
+def color_signatures(images):
+    return [
+        np.asarray((image if image.mode == "RGB" else image.convert("RGB")).resize((COLOR_GRID, COLOR_GRID), Image.BOX),
+                   dtype=np.uint8).tobytes()
+        for image in images
+    ]
+
+def colors_match(a, b, max_difference=COLOR_MAX_DIFFERENCE):
+    if a is None or b is None or len(a) != len(b):
+        return False
+    return int(np.abs(np.frombuffer(a, np.uint8).astype(np.int16) - np.frombuffer(b, np.uint8)).max()) <= max_difference
+
+# (phash, dhash, colour signature) keys for a batch of images
+def image_keys(images):
+    phashes, dhashes = hash_images(images)
+    return list(zip(map(int, phashes), map(int, dhashes), color_signatures(images)))
+
+# Key of an encoded image file object; JPEGs are decoded straight at 1/8 scale
+def hash_image_file(file):
+    image = Image.open(file)
+    image.draft("RGB", (PHASH_SIZE * 2, PHASH_SIZE * 2))
+    return image_keys([image])[0]
+
+def hash_image_bytes(content):
+    return hash_image_file(BytesIO(content))
+
+# Whether two (phash, dhash, colour) keys are near-duplicates; with
+# `match_color`, only when their colour signatures agree too
+def keys_match(a, b, max_distance=PHASH_MAX_DISTANCE, second_max_distance=DHASH_MAX_DISTANCE, match_color=True):
+    if bin(a[0] ^ b[0]).count("1") > max_distance or bin(a[1] ^ b[1]).count("1") > second_max_distance:
+        return False
+    return not match_color or colors_match(a[2], b[2])
+
+# === Multi-index Hamming search ===
+# Codes are split into max_distance + 1 chunks: by the pigeonhole principle a
+# code within max_distance bits of the query matches it exactly on at least
+# one chunk, so each chunk is a sorted table probed with searchsorted and only
+# those candidates get a full Hamming check. Recent additions sit in a small
+# unsorted tail that is scanned directly until it is merged. With
+# `match_color`, candidates must also have a matching colour signature;
+# entries added without one never match.
+class HammingIndex:
+    def __init__(self, max_distance=PHASH_MAX_DISTANCE, second_max_distance=DHASH_MAX_DISTANCE, match_color=False,
+                 color_max_difference=COLOR_MAX_DIFFERENCE):
+        self.max_distance = max_distance
+        self.second_max_distance = second_max_distance
+        self.match_color = match_color
+        self.color_max_difference = color_max_difference
+        self.colors = np.zeros((0, COLOR_GRID * COLOR_GRID * 3), dtype=np.uint8)
+        self.has_color = np.zeros(0, dtype=bool)
+        bounds = np.linspace(0, 64, max_distance + 2).astype(int)
+        self.chunks = [(np.uint64(start), np.uint64((1 << (end - start)) - 1)) for start, end in zip(bounds, bounds[1:])]
+        self.codes = np.zeros(0, dtype=np.uint64)
+        self.second = np.zeros(0, dtype=np.uint64)
+        self.tables = [(np.zeros(0, dtype=np.uint64), np.zeros(0, dtype=np.int64)) for _ in self.chunks]
+        self.merged = 0
+
+    def __len__(self):
+        return len(self.codes)
+
+    def add_many(self, codes, second, colors=None):
+        self.codes = np.concatenate([self.codes, np.asarray(codes, dtype=np.uint64)])
+        self.second = np.concatenate([self.second, np.asarray(second, dtype=np.uint64)])
+        if self.match_color:
+            rows, valid = self._color_rows(colors, len(codes))
+            self.colors = np.concatenate([self.colors, rows])
+            self.has_color = np.concatenate([self.has_color, valid])
+        if len(self.codes) - self.merged >= MERGE_EVERY:
+            self.merge()
+
+    def merge(self):
+        ids = np.arange(len(self.codes))
+        tables = []
+        for shift, mask in self.chunks:
+            keys = (self.codes >> shift) & mask
+            order = np.argsort(keys, kind="stable")
+            tables.append((keys[order], ids[order]))
+        self.tables = tables
+        self.merged = len(self.codes)
+
+    def _color_rows(self, colors, count):
+        rows = np.zeros((count, self.colors.shape[1]), dtype=np.uint8)
+        valid = np.zeros(count, dtype=bool)
+        for i, color in enumerate(colors if colors is not None else [None] * count):
+            if color is not None and len(color) == rows.shape[1]:
+                rows[i] = np.frombuffer(color, np.uint8)
+                valid[i] = True
+        return rows, valid
+
+    # Position of the closest match for each query, or -1
+    def search(self, codes, second, colors=None):
+        codes = np.asarray(codes, dtype=np.uint64)
+        second = np.asarray(second, dtype=np.uint64)
+        if self.match_color:
+            query_colors, query_valid = self._color_rows(colors, len(codes))
+        found = np.full(len(codes), -1, dtype=np.int64)
+        if not len(self.codes) or not len(codes):
+            return found
+
+        spans = []
+        for (shift, mask), (keys, _) in zip(self.chunks, self.tables):
+            query_keys = (codes >> shift) & mask
+            spans.append((np.searchsorted(keys, query_keys, "left"), np.searchsorted(keys, query_keys, "right")))
+        tail = np.arange(self.merged, len(self.codes))
+
+        for q in range(len(codes)):
+            candidates = [ids[lo[q]:hi[q]] for (lo, hi), (_, ids) in zip(spans, self.tables)]
+            candidates = np.unique(np.concatenate(candidates + [tail]))
+            if not len(candidates):
+                continue
+            distances = hamming(self.codes[candidates], codes[q])
+            close = (distances <= self.max_distance) & (hamming(self.second[candidates], second[q]) <= self.second_max_distance)
+            if self.match_color:
+                if not query_valid[q]:
+                    continue
+                color_distances = np.abs(self.colors[candidates].astype(np.int16) - query_colors[q]).max(axis=1)
+                close &= self.has_color[candidates] & (color_distances <= self.color_max_difference)
+            if close.any():
+                found[q] = candidates[close][np.argmin(distances[close])]
+        return found
+
+# === Persistent near-duplicate index ===
+# Maps perceptual hashes to the result already produced for that image (e.g.
+# an uploaded URL) under a namespace per stage. Entries live in SQLite so they
+# carry over between runs and between processes; each lookup first pulls in
+# rows other processes have added since. Indexes whose results stand in for
+# the image itself set `match_color`, so colour variants do not match (rows
+# stored before colour signatures existed then never match).
+class DuplicateIndex:
+    def __init__(self, namespace, path=DEDUPE_INDEX_PATH, max_distance=PHASH_MAX_DISTANCE, match_color=False):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.namespace = namespace
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS image_hashes (
+                namespace TEXT NOT NULL,
+                phash INTEGER NOT NULL,
+                dhash INTEGER NOT NULL,
+                result TEXT NOT NULL
+            )
+        """)
+        columns = {row[1] for row in self.db.execute("PRAGMA table_info(image_hashes)")}
+        if "color" not in columns:
+            self.db.execute("ALTER TABLE image_hashes ADD COLUMN color BLOB")
+        self.db.execute("CREATE INDEX IF NOT EXISTS image_hashes_namespace ON image_hashes (namespace)")
+        self.db.commit()
+        self.index = HammingIndex(max_distance, match_color=match_color)
+        self.rowids = np.zeros(0, dtype=np.int64)
+        self.last_rowid = 0
+        self.stats = {"lookups": 0, "hits": 0}
+
+    # SQLite integers are signed; hashes round-trip through int64
+    def refresh(self):
+        rows = self.db.execute(
+            "SELECT rowid, phash, dhash, color FROM image_hashes WHERE namespace = ? AND rowid > ? ORDER BY rowid",
+            (self.namespace, self.last_rowid)
+        ).fetchall()
+        if rows:
+            table = np.array([row[:3] for row in rows], dtype=np.int64)
+            self.index.add_many(table[:, 1].view(np.uint64), table[:, 2].view(np.uint64), [row[3] for row in rows])
+            self.rowids = np.concatenate([self.rowids, table[:, 0]])
+            self.last_rowid = int(table[-1, 0])
+
+    # One stored result (or None) per (phash, dhash, colour) key
+    def find_many(self, keys):
+        if not keys:
+            return []
+        with self.lock:
+            self.refresh()
+            phashes = np.array([key[0] for key in keys], dtype=np.uint64)
+            dhashes = np.array([key[1] for key in keys], dtype=np.uint64)
+            positions = self.index.search(phashes, dhashes, [key[2] for key in keys])
+            results = []
+            for position in positions:
+                if position < 0:
+                    results.append(None)
+                    continue
+                (result,) = self.db.execute(
+                    "SELECT result FROM image_hashes WHERE rowid = ?", (int(self.rowids[position]),)
+                ).fetchone()
+                results.append(json.loads(result))
+            self.stats["lookups"] += len(keys)
+            self.stats["hits"] += sum(result is not None for result in results)
+        return results
+
+    def find(self, key):
+        return self.find_many([key])[0]
+
+    def add_many(self, entries):
+        rows = [
+            (self.namespace, int(np.uint64(phash).view(np.int64)), int(np.uint64(dhash).view(np.int64)), color,
+             json.dumps(result))
+            for (phash, dhash, color), result in entries
+        ]
+        if not rows:
+            return
+        with self.lock:
+            self.db.executemany(
+                "INSERT INTO image_hashes (namespace, phash, dhash, color, result) VALUES (?, ?, ?, ?, ?)", rows
+            )
+            self.db.commit()
+
+    def add(self, key, result):
+        self.add_many([(key, result)])
+
+    def close(self):
+        with self.lock:
+            self.db.close()
@@ -0,0 +1,154 @@
+# inference.py
+
+import os
+import cv2
+import torch
+import numpy as np
+import supervision as sv
+from PIL import Image
+from ultralytics import YOLO
+from torchvision.models.segmentation import deeplabv3_resnet101, deeplabv3_mobilenet_v3_large
+
+# === Inference Settings ===
+INFERENCE_BACKEND = os.getenv("INFERENCE_BACKEND", "torch")  # torch | onnx
+SEGMENT_MODEL = os.getenv("SEGMENT_MODEL", "resnet101")  # resnet101 | mobilenet_v3
+ONNX_QUANTIZE = os.getenv("ONNX_QUANTIZE") or None  # dynamic | static (int8), onnx backend only
+DETECTOR_WEIGHTS = "yolov8n.pt"
+DETECT_BATCH_SIZE = int(os.getenv("DETECT_BATCH_SIZE", 16))
+DETECT_SIZE = 640  # YOLOv8 input side; screening images need no more than this
+SEGMENT_BATCH_SIZE = int(os.getenv("SEGMENT_BATCH_SIZE", 4))
+SEGMENT_SIZE = 520  # shorter side fed to DeepLabV3, as torchvision's Resize(520)
+PAD_MULTIPLE = 64  # resized images are padded up to a multiple of this to share a bucket
+PERSON_CLASS_ID = 0
+
+MEAN = np.array([0.485, 0.456, 0.406], dtype=np.float32)
+STD = np.array([0.229, 0.224, 0.225], dtype=np.float32)
+
+SEGMENT_MODELS = {
+    "resnet101": deeplabv3_resnet101,
+    "mobilenet_v3": deeplabv3_mobilenet_v3_large,
+}
+
+# Pretrained DeepLabV3 in eval mode, without the auxiliary head (only used in
+# training; its output was computed and thrown away)
+def load_segmenter(name):
+    segmenter = SEGMENT_MODELS[name](pretrained=True).eval()
+    segmenter.aux_classifier = None
+    return segmenter
+
+# === Size buckets ===
+# Each image is resized so its shorter side is SEGMENT_SIZE, then padded up to
+# a multiple of PAD_MULTIPLE; images that land on the same padded shape are
+# segmented together. Catalog shots mostly share a handful of aspect ratios,
+# so buckets fill up quickly.
+def bucket_by_size(images):
+    buckets = {}
+    for index, image in enumerate(images):
+        width, height = image.size
+        scale = SEGMENT_SIZE / min(width, height)
+        resized = (max(1, round(width * scale)), max(1, round(height * scale)))
+        padded = (-(-resized[1] // PAD_MULTIPLE) * PAD_MULTIPLE, -(-resized[0] // PAD_MULTIPLE) * PAD_MULTIPLE)
+        buckets.setdefault(padded, []).append((index, resized))
+    return buckets
+
+# Normalized CHW float32 array, padded with zeros (the mean colour after normalization)
+def prepare_segment_input(image, resized, padded_shape):
+    array = np.asarray(image.resize(resized, Image.BILINEAR), dtype=np.float32) / 255.0
+    array = (array - MEAN) / STD
+    tensor = np.zeros((3, *padded_shape), dtype=np.float32)
+    tensor[:, :resized[1], :resized[0]] = array.transpose(2, 0, 1)
+    return tensor
+
+# Intersection over union of two 0/255 masks; 1.0 when both are empty
+def mask_iou(a, b):
+    a, b = a > 0, b > 0
+    union = np.logical_or(a, b).sum()
+    return float(np.logical_and(a, b).sum() / union) if union else 1.0
+
+# === Eager PyTorch backend ===
+# Backends expose `detect(images)` -> one bool per PIL image and
+# `segment(batch)` -> (N, H, W) uint8 class ids for a normalized NCHW batch.
+class TorchBackend:
+    name = "torch"
+
+    def __init__(self, segment_model=SEGMENT_MODEL):
+        self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+        self.detector = YOLO(DETECTOR_WEIGHTS)
+        self.segmenter = load_segmenter(segment_model).to(self.device)
+
+    def set_num_threads(self, threads):
+        torch.set_num_threads(threads)
+
+    # PIL images go to ultralytics as-is; it does its own single BGR copy
+    # while letterboxing
+    def detect(self, images):
+        flags = []
+        for result in self.detector(list(images), imgsz=DETECT_SIZE, verbose=False):
+            detections = sv.Detections.from_ultralytics(result)
+            flags.append(bool((detections.class_id == PERSON_CLASS_ID).any()))
+        return flags
+
+    def segment(self, batch):
+        with torch.inference_mode():
+            output = self.segmenter(torch.from_numpy(batch).to(self.device))["out"]
+        return output.argmax(1).byte().cpu().numpy()
+
+# `name` is "torch" or "onnx"; `quantize` ("dynamic" / "static") applies to onnx
+def load_backend(name=INFERENCE_BACKEND, segment_model=SEGMENT_MODEL, quantize=ONNX_QUANTIZE):
+    if name == "torch":
+        return TorchBackend(segment_model)
+    if name == "onnx":
+        from onnx_backend import OnnxBackend
+        return OnnxBackend(segment_model, quantize)
+    raise ValueError(f"Unknown inference backend: {name}")
+
+# === Setup models for person detection and background removal ===
+# Loaded on first use, so importing this module (or a run with nothing to
+# process) does not pay for reading the weights
+default_backend = None
+num_threads = None
+
+def get_backend():
+    global default_backend
+    if default_backend is None:
+        default_backend = load_backend()
+        if num_threads:
+            default_backend.set_num_threads(num_threads)
+    return default_backend
+
+# Device the default backend runs on, known without loading it
+def default_device():
+    if INFERENCE_BACKEND == "torch" and torch.cuda.is_available():
+        return torch.device("cuda")
+    return torch.device("cpu")
+
+def set_num_threads(threads):
+    global num_threads
+    num_threads = threads
+    if default_backend is not None:
+        default_backend.set_num_threads(threads)
+
+# === Batched person detection ===
+# One detector forward pass per chunk of images; returns one bool per image
+def detect_persons(images, batch_size=DETECT_BATCH_SIZE, backend=None):
+    backend = backend or get_backend()
+    flags = []
+    for start in range(0, len(images), batch_size):
+        flags.extend(backend.detect(images[start:start + batch_size]))
+    return flags
+
+# === Batched segmentation ===
+# One DeepLabV3 forward pass per bucket chunk. Returns one uint8 mask (0/255)
+# per image at the image's original resolution.
+def segment_images(images, batch_size=SEGMENT_BATCH_SIZE, backend=None):
+    backend = backend or get_backend()
+    masks = [None] * len(images)
+    for padded_shape, members in bucket_by_size(images).items():
+        for start in range(0, len(members), batch_size):
+            chunk = members[start:start + batch_size]
+            batch = np.stack([prepare_segment_input(images[i], resized, padded_shape) for i, resized in chunk])
+            predictions = backend.segment(batch)
+            for (i, resized), prediction in zip(chunk, predictions):
+                mask = (prediction[:resized[1], :resized[0]] != 0).astype(np.uint8) * 255
+                masks[i] = cv2.resize(mask, images[i].size)
+    return masks
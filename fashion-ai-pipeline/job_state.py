@@ -0,0 +1,155 @@
+# job_state.py
+
+import os
+import time
+import sqlite3
+import argparse
+import threading
+from collections import deque
+import metrics
+
+# === State Settings ===
+JOB_STATE_PATH = os.getenv("JOB_STATE_PATH", ".cache/job_state.sqlite3")
+
+# === CLI flags shared by every stage ===
+# "--shard 2/4" runs the third of four static slices of the catalog
+def parse_shard(value):
+    try:
+        index, count = (int(part) for part in value.split("/"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected INDEX/COUNT, got {value!r}")
+    if not 0 <= index < count:
+        raise argparse.ArgumentTypeError(f"shard index must be in [0, {count})")
+    return index, count
+
+def add_job_args(parser):
+    parser.add_argument("--resume", action="store_true", help="continue from the last checkpoint of this stage")
+    parser.add_argument("--retry-failed", action="store_true", help="replay only items that failed in earlier runs")
+    parser.add_argument("--shard", type=parse_shard, help="only process the INDEX/COUNT static slice of the catalog")
+    parser.add_argument("--claim", action="store_true", help="lease batches from a shared table so any number of workers can run")
+    return parser
+
+# === Durable per-item, per-stage status ===
+# SQLite in WAL mode: one row per (stage, item) with status, attempt count and
+# last error, plus one checkpoint per stage. Safe to share across threads.
+class JobState:
+    def __init__(self, path=JOB_STATE_PATH):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS items (
+                stage TEXT NOT NULL,
+                item_key TEXT NOT NULL,
+                status TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                last_error TEXT,
+                updated_at REAL NOT NULL,
+                PRIMARY KEY (stage, item_key)
+            );
+            CREATE INDEX IF NOT EXISTS items_stage_status ON items (stage, status);
+            CREATE TABLE IF NOT EXISTS checkpoints (
+                stage TEXT PRIMARY KEY,
+                position TEXT,
+                updated_at REAL NOT NULL
+            );
+        """)
+        self.db.commit()
+
+    def _record(self, stage, keys, status, error=None):
+        now = time.time()
+        with self.lock:
+            self.db.executemany("""
+                INSERT INTO items (stage, item_key, status, attempts, last_error, updated_at)
+                VALUES (?, ?, ?, 1, ?, ?)
+                ON CONFLICT (stage, item_key) DO UPDATE SET
+                    status = excluded.status,
+                    attempts = items.attempts + 1,
+                    last_error = excluded.last_error,
+                    updated_at = excluded.updated_at
+            """, [(stage, str(key), status, error, now) for key in keys])
+            self.db.commit()
+        metrics.item(stage, status, len(keys))
+
+    def mark_done(self, stage, *keys):
+        self._record(stage, keys, "done")
+
+    def mark_skipped(self, stage, key, reason=None):
+        self._record(stage, [key], "skipped", reason)
+
+    def mark_failed(self, stage, key, error):
+        self._record(stage, [key], "failed", str(error)[:1000])
+
+    def failed_keys(self, stage):
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT item_key FROM items WHERE stage = ? AND status = 'failed' ORDER BY item_key", (stage,)
+            ).fetchall()
+        return [key for (key,) in rows]
+
+    # Items a poller should leave alone: skipped ones, and failed ones unless
+    # failures are being retried and the item has attempts left
+    def settled_keys(self, stage, retry_failed=False, max_attempts=None):
+        retryable = "status = 'failed' AND attempts < ?" if retry_failed else "FALSE"
+        params = (stage, max_attempts if max_attempts is not None else 2 ** 62) if retry_failed else (stage,)
+        with self.lock:
+            rows = self.db.execute(
+                f"SELECT item_key FROM items WHERE stage = ? AND status IN ('skipped', 'failed') AND NOT ({retryable})",
+                params
+            ).fetchall()
+        return {key for (key,) in rows}
+
+    def get_checkpoint(self, stage):
+        with self.lock:
+            row = self.db.execute("SELECT position FROM checkpoints WHERE stage = ?", (stage,)).fetchone()
+        return row[0] if row else None
+
+    def set_checkpoint(self, stage, position):
+        with self.lock:
+            self.db.execute("""
+                INSERT INTO checkpoints (stage, position, updated_at) VALUES (?, ?, ?)
+                ON CONFLICT (stage) DO UPDATE SET position = excluded.position, updated_at = excluded.updated_at
+            """, (stage, None if position is None else str(position), time.time()))
+            self.db.commit()
+
+    def summary(self, stage):
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT status, COUNT(*) FROM items WHERE stage = ? GROUP BY status", (stage,)
+            ).fetchall()
+        return dict(rows)
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+# === Completion watermark ===
+# Items are started in ascending order but may finish out of order; the
+# watermark is the highest position below which everything has finished,
+# which is the only safe place to resume from.
+class Watermark:
+    def __init__(self, start=None):
+        self.value = start
+        self.pending = deque()
+        self.finished = set()
+        self.lock = threading.Lock()
+
+    def start(self, position):
+        with self.lock:
+            self.pending.append(position)
+
+    def finish(self, position):
+        with self.lock:
+            self.finished.add(position)
+            while self.pending and self.pending[0] in self.finished:
+                self.value = self.pending.popleft()
+                self.finished.discard(self.value)
+            return self.value
+
+# Keys are stored as text; numeric catalog ids go back to ints for id = ANY(%s)
+def item_ids(keys):
+    return [int(key) if key.isdigit() else key for key in keys]
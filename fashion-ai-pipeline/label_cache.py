@@ -0,0 +1,87 @@
+# label_cache.py
+
+import os
+import json
+import time
+import sqlite3
+import hashlib
+
+# === Cache Settings ===
+LABEL_CACHE_PATH = os.getenv("LABEL_CACHE_PATH", ".cache/labels.sqlite3")
+LABEL_CACHE_MAX_ENTRIES = int(os.getenv("LABEL_CACHE_MAX_ENTRIES", 500_000))
+EVICT_EVERY = 1_000  # puts between eviction checks
+
+# === Cache key ===
+# Title and description must already be clean_text-normalized. `namespace`
+# (model + prompt version) keeps labels from an older prompt from being reused.
+def label_key(title, description, namespace=""):
+    payload = "\x1f".join([namespace, title or "", description or ""])
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+# === Content-addressed label store with LRU eviction ===
+class LabelCache:
+    def __init__(self, path=LABEL_CACHE_PATH, max_entries=LABEL_CACHE_MAX_ENTRIES):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.max_entries = max_entries
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS labels (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL,
+                last_used REAL NOT NULL
+            )
+        """)
+        self.db.execute("CREATE INDEX IF NOT EXISTS labels_last_used ON labels (last_used)")
+        self.db.commit()
+        self.puts_since_evict = 0
+        self.stats = {"hits": 0, "misses": 0}
+
+    def get_many(self, keys):
+        keys = list(set(keys))
+        found = {}
+        for start in range(0, len(keys), 500):
+            chunk = keys[start:start + 500]
+            placeholders = ",".join("?" * len(chunk))
+            rows = self.db.execute(
+                f"SELECT key, value FROM labels WHERE key IN ({placeholders})", chunk
+            ).fetchall()
+            found.update((key, json.loads(value)) for key, value in rows)
+        if found:
+            now = time.time()
+            self.db.executemany("UPDATE labels SET last_used = ? WHERE key = ?", [(now, key) for key in found])
+            self.db.commit()
+        self.stats["hits"] += len(found)
+        self.stats["misses"] += len(keys) - len(found)
+        return found
+
+    def put_many(self, labels):
+        if not labels:
+            return
+        now = time.time()
+        self.db.executemany(
+            "INSERT OR REPLACE INTO labels (key, value, last_used) VALUES (?, ?, ?)",
+            [(key, json.dumps(value), now) for key, value in labels.items()]
+        )
+        self.db.commit()
+        self.puts_since_evict += len(labels)
+        if self.puts_since_evict >= EVICT_EVERY:
+            self.evict()
+
+    def evict(self):
+        self.puts_since_evict = 0
+        (count,) = self.db.execute("SELECT COUNT(*) FROM labels").fetchone()
+        excess = count - self.max_entries
+        if excess > 0:
+            self.db.execute(
+                "DELETE FROM labels WHERE key IN (SELECT key FROM labels ORDER BY last_used LIMIT ?)",
+                (excess,)
+            )
+            self.db.commit()
+        return max(excess, 0)
+
+    def close(self):
+        self.db.close()
@@ -1,4 +1,6 @@
 import os
+import io
+import argparse
 import csv
 import time
 import json
@@ -6,12 +8,16 @@ import unicodedata
 import requests
 import aiohttp
 import asyncio
-import psycopg2
 from urllib.parse import urlparse
 from dotenv import load_dotenv
+import metrics
+from connections import get_conn, close_conn
+from rate_limiter import RateLimiter, RateLimited, TransientError, parse_retry_after
+from label_cache import LabelCache, label_key
+from job_state import JobState, Watermark, add_job_args
+from work_claims import WorkSource
 
 start_time = time.time()
-print("\n🚀 Script started", flush=True)
 
 # === Helpers ===
 def clean_text(text):
@@ -20,95 +26,197 @@ def clean_text(text):
 # === Load ENV ===
 load_dotenv()
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
+OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL", "https://api.openai.com/v1").rstrip("/")
 
-DB_HOST = os.getenv("SUPABASE_DB_HOST")
-DB_NAME = os.getenv("SUPABASE_DB_NAME")
-DB_USER = os.getenv("SUPABASE_DB_USER")
-DB_PASSWORD = os.getenv("SUPABASE_DB_PASSWORD")
-DB_PORT = int(os.getenv("SUPABASE_DB_PORT", 5432))
-
-# === Connect to Supabase Postgres ===
-conn = psycopg2.connect(
-    host=DB_HOST,
-    dbname=DB_NAME,
-    user=DB_USER,
-    password=DB_PASSWORD,
-    port=DB_PORT,
-    sslmode="require"
-)
-cursor = conn.cursor()
-
-# === Download and Parse CSV ===
-catalog_url = "https://storage.googleapis.com/product_catalog_my_ae/product_catalog.csv"
-print(f"📦 Downloading catalog from {catalog_url}...", flush=True)
-csv_response = requests.get(catalog_url)
-csv_response.raise_for_status()
-csv_content = csv_response.text
-print("✅ Catalog loaded into memory", flush=True)
-
-csv_reader = csv.DictReader(csv_content.splitlines())
-rows = list(csv_reader)
-for row in rows:
-    for k in list(row.keys()):
-        if k is None:
-            continue
-        row[k.strip().lower().replace(" ", "_")] = row.pop(k)
+# === Streaming CSV Settings ===
+catalog_url = os.getenv("CATALOG_CSV_URL", "https://storage.googleapis.com/product_catalog_my_ae/product_catalog.csv")
+BATCH_SIZE = 125  # ~125 products × 250 tokens ≈ 31,250 tokens per batch
+LABEL_CONCURRENCY = 6  # concurrent batches; sized to use the 800k TPM limit
+QUEUE_DEPTH = LABEL_CONCURRENCY * 2  # batches buffered ahead of the workers
+
+progress = {"processed": 0, "rows_read": 0, "rows_skipped": 0, "bytes_read": 0, "bytes_total": None}
+
+def normalize_header(name):
+    return name.strip().lower().replace(" ", "_")
+
+# === Stream and Parse CSV ===
+# Rows are parsed straight off the HTTP response, so memory stays flat and
+# labeling starts as soon as the first batch has arrived.
+def iter_catalog_rows(url):
+    with requests.get(url, stream=True, timeout=(10, 60)) as resp:
+        resp.raise_for_status()
+        resp.raw.decode_content = True
+        # Otherwise urllib3 closes the stream at EOF, before TextIOWrapper
+        # has handed out the buffered rows
+        resp.raw.auto_close = False
+        content_length = resp.headers.get("Content-Length")
+        progress["bytes_total"] = int(content_length) if content_length else None
+
+        reader = csv.reader(io.TextIOWrapper(resp.raw, encoding="utf-8-sig", newline=""))
+        header = next(reader, None)
+        if header is None:
+            return
+        fields = [normalize_header(name) for name in header]
+        for values in reader:
+            progress["bytes_read"] = resp.raw.tell()
+            progress["rows_read"] += 1
+            yield dict(zip(fields, values))
+
+# === Bulk ingestion ===
+# Labeled rows are streamed with COPY into a temp staging table and merged into
+# product_catalog with one INSERT ... ON CONFLICT per flush.
+CATALOG_COLUMNS = [
+    "parent_sku", "color_sku", "size_sku", "image_url", "additional_images", "page_url",
+    "title", "description", "category", "gender", "age_group",
+    "price", "original_price", "stock_availability", "brand", "currency", "color", "size",
+    "description_ai", "style_details", "items_detected", "metadata"
+]
+STAGING_TABLE = "product_catalog_staging"
+
+# The Postgres connection is opened on first use (see connections.py); the
+# staging table lives on it, so it is created once the connection exists.
+# Same column types as product_catalog, without its id sequence or constraints
+def ensure_staging_table():
+    conn = get_conn(STAGE)
+    with conn.cursor() as cursor:
+        cursor.execute(f"""
+            CREATE TEMP TABLE IF NOT EXISTS {STAGING_TABLE}
+            ON COMMIT DELETE ROWS
+            AS SELECT {", ".join(CATALOG_COLUMNS)} FROM product_catalog
+            WITH NO DATA
+        """)
+    conn.commit()
 
-# === Fetch already-inserted SKUs ===
-cursor.execute('SELECT parent_sku FROM "product_catalog"')
-existing_skus = set(r[0] for r in cursor.fetchall())
+# Escapes one value for COPY's text format; None becomes \N
+def copy_value(value):
+    if value is None:
+        return "\\N"
+    if isinstance(value, list):
+        value = "{" + ",".join(
+            '"' + str(item).replace("\\", "\\\\").replace('"', '\\"') + '"' for item in value
+        ) + "}"
+    return (
+        str(value)
+        .replace("\\", "\\\\")
+        .replace("\t", "\\t")
+        .replace("\n", "\\n")
+        .replace("\r", "\\r")
+    )
+
+def copy_rows(values):
+    buffer = io.StringIO()
+    for row in values:
+        buffer.write("\t".join(copy_value(value) for value in row))
+        buffer.write("\n")
+    buffer.seek(0)
+    with get_conn(STAGE).cursor() as cursor:
+        cursor.copy_expert(
+            f"COPY {STAGING_TABLE} ({', '.join(CATALOG_COLUMNS)}) FROM STDIN",
+            buffer
+        )
+
+# Returns the parent_skus that were actually inserted
+def merge_staged_rows():
+    columns = ", ".join(CATALOG_COLUMNS)
+    with get_conn(STAGE).cursor() as cursor:
+        cursor.execute(f"""
+            INSERT INTO product_catalog ({columns})
+            SELECT DISTINCT ON (parent_sku) {columns}
+            FROM {STAGING_TABLE}
+            ORDER BY parent_sku
+            ON CONFLICT (parent_sku) DO NOTHING
+            RETURNING parent_sku
+        """)
+        return [sku for (sku,) in cursor.fetchall()]
+
+# === Already-inserted SKUs ===
+# Set-based lookup for one batch instead of loading every parent_sku up front
+def fetch_existing_skus(skus):
+    conn = get_conn(STAGE)
+    with conn.cursor() as cursor:
+        cursor.execute(
+            "SELECT DISTINCT parent_sku FROM product_catalog WHERE parent_sku = ANY(%s)",
+            (list(set(skus)),)
+        )
+        existing = {sku for (sku,) in cursor.fetchall()}
+    conn.commit()
+    return existing
 
 # === Error Log ===
 failed_log = open("failed_rows.txt", "a")
 
+# === Job state ===
+# Items are keyed by parent_sku; the checkpoint is a CSV row number
+STAGE = "label"
+job_state = JobState()
+watermark = Watermark()
+
+# === Label cache ===
+# Bump LABEL_PROMPT_VERSION whenever the prompt changes so old labels are not reused
+LABEL_MODEL = "gpt-4o-mini"
+LABEL_PROMPT_VERSION = "v2"
+LABEL_FIELDS = ("description_ai", "style_details", "items_detected", "metadata")
+label_cache = LabelCache()
+
+# === Shared OpenAI rate limiter ===
+OPENAI_TPM_LIMIT = int(os.getenv("OPENAI_TPM_LIMIT", 800_000))
+OPENAI_RPM_LIMIT = int(os.getenv("OPENAI_RPM_LIMIT", 5_000))
+limiter = RateLimiter(tpm=OPENAI_TPM_LIMIT, rpm=OPENAI_RPM_LIMIT, max_retries=5, name=LABEL_MODEL)
+
 # === OpenAI async call with retry ===
-async def call_gpt(session, prompt, retries=5):
+async def call_gpt(session, prompt, expected_output_tokens=0):
     headers = {
         "Authorization": f"Bearer {OPENAI_API_KEY}",
         "Content-Type": "application/json"
     }
     data = {
-        "model": "gpt-4o-mini",
+        "model": LABEL_MODEL,
         "messages": [{"role": "user", "content": prompt}],
         "temperature": 0.2
     }
-    for attempt in range(retries):
-        async with session.post("https://api.openai.com/v1/chat/completions", headers=headers, json=data) as resp:
-            result = await resp.json()
-            if 'error' in result:
-                message = result['error']['message']
-                if 'Rate limit' in message or 'Request too large' in message:
-                    wait_time = 1 + attempt * 2
-                    print(f"⏳ Rate limit hit or request too large. Retrying in {wait_time}s...", flush=True)
-                    await asyncio.sleep(wait_time)
-                    continue
-                else:
-                    raise ValueError(f"Invalid response from OpenAI: {result}")
-            if 'choices' not in result:
-                raise ValueError(f"Invalid response from OpenAI: {result}")
-            content = result['choices'][0]['message']['content'].strip()
-            if content.startswith("```"):
-                content = content.replace("```json", "").replace("```", "").strip()
-            return json.loads(content)
-    raise ValueError(f"Failed after {retries} retries: {result}")
+    estimated_tokens = len(prompt) // 4 + expected_output_tokens
 
-# === Label and insert ===
-async def label_batch(session, batch, batch_start):
+    async def request():
+        try:
+            async with session.post(f"{OPENAI_BASE_URL}/chat/completions", headers=headers, json=data) as resp:
+                if resp.status == 429:
+                    body = await resp.text()
+                    raise RateLimited(f"HTTP 429: {body[:200]}", parse_retry_after(resp.headers), resp.headers)
+                if resp.status >= 500:
+                    raise TransientError(f"HTTP {resp.status}")
+                result = await resp.json(content_type=None)
+                response_headers = resp.headers
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            raise TransientError(str(e) or type(e).__name__) from e
+        if 'error' in result or 'choices' not in result:
+            raise ValueError(f"Invalid response from OpenAI: {result}")
+        return result, (result.get("usage") or {}).get("total_tokens"), response_headers
+
+    with metrics.step(STAGE, "llm_call"):
+        result = await limiter.run(request, estimated_tokens)
+    # Billed even when the content turns out to be unusable
+    metrics.record_usage(STAGE, LABEL_MODEL, result.get("usage"))
+    content = result['choices'][0]['message']['content'].strip()
+    if content.startswith("```"):
+        content = content.replace("```json", "").replace("```", "").strip()
+    return json.loads(content), result.get("usage") or {}
+
+# === Prompt ===
+def build_prompt(rows):
     batched_prompt_lines = []
-    for i, row in enumerate(batch):
-        row["title"] = clean_text(row.get("title"))
-        row["description"] = clean_text(row.get("description"))
+    for i, row in enumerate(rows):
         batched_prompt_lines.append(
             f"{i+1}. Title: {row['title']}\nDescription: {row['description']}"
         )
 
-    prompt = f"""
+    return f"""
 You are a fashion labeling assistant.
 
-You will be shown a list of {len(batch)} products, each with a catalog title and description. For each product, analyze ONLY the product being sold (as described in the title/description), and ignore any other items that may appear in an image.
+You will be shown a list of {len(rows)} products, each with a catalog title and description. For each product, analyze ONLY the product being sold (as described in the title/description), and ignore any other items that may appear in an image.
 
-Return an array of {len(batch)} JSON objects. Each object should be structured exactly like this:
+Return an array of {len(rows)} JSON objects. Each object should be structured exactly like this:
 
+- index: The number of the product in the list below (1–{len(rows)}), so each object can be matched to its product.
 - description_ai: A clean, rewritten version of the original description that is short, accurate, and clear. Remain neutral in descriptions and avoid styling tips, occasion suggestions, or subjective opinions. Do not include “ideal for” or “style with…” language.
 - style_details: A short list of 2–10 descriptive tags like ["boxy fit", "ribbed", "high neckline", "cropped", "wool knit"]. These help describe silhouette, material, finish, and construction.
 - items_detected: A single item object, parsed as:
@@ -122,21 +230,163 @@ Return an array of {len(batch)} JSON objects. Each object should be structured e
 
 Descriptions must remain neutral, accurate, and concise. Avoid styling tips, occasion suggestions, or subjective opinions. Do not include "ideal for" or "style with..." language. Make sure the output is structured JSON array only, with no other text.
 
-Here are the {len(batch)} products:
+Here are the {len(rows)} products:
 {chr(10).join(batched_prompt_lines)}
 """
 
+# === Adaptive batch size ===
+# Shrinks multiplicatively when a top-level request fails or comes back
+# misaligned and grows additively while requests succeed. The size is also
+# capped so the expected completion fits in the model's output limit, using
+# the observed completion tokens per row.
+class BatchSizer:
+    def __init__(self, initial=125, minimum=5, maximum=200, max_output_tokens=12_000):
+        self.size = initial
+        self.minimum = minimum
+        self.maximum = maximum
+        self.max_output_tokens = max_output_tokens
+        self.failure_rate = 0.0
+        self.output_tokens_per_row = None
+
+    def record(self, rows, failed, completion_tokens=None):
+        self.failure_rate = 0.8 * self.failure_rate + 0.2 * (1.0 if failed else 0.0)
+        if completion_tokens and rows and not failed:
+            per_row = completion_tokens / rows
+            if self.output_tokens_per_row is None:
+                self.output_tokens_per_row = per_row
+            else:
+                self.output_tokens_per_row = 0.8 * self.output_tokens_per_row + 0.2 * per_row
+
+        if failed:
+            size = int(self.size * 0.6)
+        else:
+            size = self.size + max(1, self.size // 10)
+        if self.output_tokens_per_row:
+            size = min(size, int(self.max_output_tokens / self.output_tokens_per_row))
+        self.size = max(self.minimum, min(self.maximum, size))
+
+sizer = BatchSizer(initial=BATCH_SIZE)
+
+# === Align results to rows ===
+# Maps each returned object to its row position via its 1-based "index" field.
+# Untagged results are only trusted positionally when none are tagged and the
+# count matches exactly.
+def align_results(results, count):
+    if not isinstance(results, list):
+        return {}
+    indexed, untagged = {}, []
+    for result in results:
+        if not isinstance(result, dict):
+            continue
+        try:
+            index = int(result.get("index"))
+        except (TypeError, ValueError):
+            untagged.append(result)
+            continue
+        if 1 <= index <= count and index - 1 not in indexed:
+            indexed[index - 1] = result
+    if not indexed and len(untagged) == count == len(results):
+        return dict(enumerate(untagged))
+    return indexed
+
+# === Adaptive bisection ===
+# Labels `rows` in one request. Rows missing from a failed or misaligned
+# response are retried as a smaller request (the missing subset, or each half
+# when nothing usable came back) until single rows succeed or are logged.
+# Returns {position in rows: result}.
+async def label_rows(session, rows, row_numbers, top_level=True):
+    labels, usage, error = {}, {}, None
     try:
-        results = await call_gpt(session, prompt)
+        results, usage = await call_gpt(session, build_prompt(rows), expected_output_tokens=len(rows) * 150)
+        labels = align_results(results, len(rows))
+        if len(labels) != len(rows):
+            error = ValueError(f"{len(rows) - len(labels)} of {len(rows)} results missing or misaligned")
     except Exception as e:
-        msg = f"GPT call failed for batch starting at row {batch_start+1}: {e}\n"
+        error = e
+
+    if top_level:
+        sizer.record(len(rows), error is not None, usage.get("completion_tokens"))
+    if error is None:
+        return labels
+
+    if len(rows) == 1:
+        msg = f"GPT call failed for row {row_numbers[0] + 1} ({rows[0].get('parent_sku')}): {error}\n"
         print(f"❌ {msg}", flush=True)
         failed_log.write(msg)
-        return
+        job_state.mark_failed(STAGE, rows[0].get("parent_sku"), error)
+        return labels
+
+    missing = [i for i in range(len(rows)) if i not in labels]
+    if len(missing) == len(rows):
+        mid = len(missing) // 2
+        groups = [missing[:mid], missing[mid:]]
+    else:
+        groups = [missing]
+    print(f"🔀 Retrying {len(missing)} of {len(rows)} rows as {[len(g) for g in groups]} after: {error}", flush=True)
+
+    sub_labels = await asyncio.gather(*(
+        label_rows(session, [rows[i] for i in group], [row_numbers[i] for i in group], top_level=False)
+        for group in groups
+    ))
+    for group, sub in zip(groups, sub_labels):
+        for position, result in sub.items():
+            labels[group[position]] = result
+    return labels
+
+# === Label through the cache ===
+# Cleans each row's title and description in place and returns
+# {position in rows: label fields}. Only texts that are neither cached nor
+# repeated within `rows` go to GPT; rows whose labeling failed are missing.
+async def label_texts(session, rows, row_numbers, description):
+    keys = []
+    for row in rows:
+        row["title"] = clean_text(row.get("title"))
+        row["description"] = clean_text(row.get("description"))
+        keys.append(label_key(row["title"], row["description"], namespace=f"{LABEL_MODEL}:{LABEL_PROMPT_VERSION}"))
+
+    labels = label_cache.get_many(keys)
+    unique = {}
+    for i, (key, row) in enumerate(zip(keys, rows)):
+        if key not in labels and key not in unique:
+            unique[key] = (row, row_numbers[i])
+    cached = sum(1 for key in keys if key in labels)
+    duplicates = len(rows) - cached - len(unique)
+    print(f"🧠 {description}: {cached} cached, {duplicates} duplicates, {len(unique)} sent to GPT", flush=True)
+
+    if unique:
+        unique_keys = list(unique)
+        results = await label_rows(
+            session,
+            [row for row, _ in unique.values()],
+            [row_number for _, row_number in unique.values()]
+        )
+        fresh = {
+            unique_keys[position]: {field: result.get(field) for field in LABEL_FIELDS}
+            for position, result in results.items()
+        }
+        label_cache.put_many(fresh)
+        labels.update(fresh)
+    return {i: labels[key] for i, key in enumerate(keys) if key in labels}
+
+# === Label and insert ===
+async def label_batch(session, batch, row_numbers):
+    batch_start = row_numbers[0]
+    existing = fetch_existing_skus(row.get("parent_sku") for row in batch)
+    if existing:
+        kept = [(row, n) for row, n in zip(batch, row_numbers) if row.get("parent_sku") not in existing]
+        print(f"⏩ Batch at row {batch_start+1}: {len(batch) - len(kept)} rows already in catalog", flush=True)
+        if not kept:
+            return
+        batch = [row for row, _ in kept]
+        row_numbers = [n for _, n in kept]
+    labels = await label_texts(session, batch, row_numbers, f"Batch at row {batch_start+1}")
 
     values_to_insert = []
-    for i, result in enumerate(results):
-        row = batch[i]
+    prepared_skus = []
+    for i, row in enumerate(batch):
+        result = labels.get(i)
+        if result is None:
+            continue
         try:
             values_to_insert.append((
                 row.get("parent_sku"),
@@ -162,65 +412,160 @@ Here are the {len(batch)} products:
                 json.dumps(result.get("items_detected")),
                 json.dumps(result.get("metadata"))
             ))
+            prepared_skus.append(row.get("parent_sku"))
         except Exception as e:
-            msg = f"Failed to prepare row {batch_start + i + 1}: {e}\n"
+            msg = f"Failed to prepare row {row_numbers[i] + 1}: {e}\n"
             print(f"❌ {msg}", flush=True)
             failed_log.write(msg)
+            job_state.mark_failed(STAGE, row.get("parent_sku"), e)
 
+    conn = get_conn(STAGE)
     try:
-        cursor.executemany("""
-            INSERT INTO product_catalog (
-                parent_sku, color_sku, size_sku, image_url, additional_images, page_url,
-                title, description, category, gender, age_group,
-                price, original_price, stock_availability, brand, currency, color, size,
-                description_ai, style_details, items_detected, metadata
-            ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-        """, values_to_insert)
-        conn.commit()
+        if values_to_insert:
+            with metrics.step(STAGE, "db_write"):
+                copy_rows(values_to_insert)
+                inserted = merge_staged_rows()
+                conn.commit()
+            job_state.mark_done(STAGE, *prepared_skus)
+            if len(inserted) < len(set(prepared_skus)):
+                print(f"⏩ {len(set(prepared_skus)) - len(inserted)} SKUs in batch at row {batch_start + 1} were already present", flush=True)
     except Exception as e:
         msg = f"Failed to insert batch at row {batch_start + 1}: {e}\n"
         print(f"❌ {msg}", flush=True)
         failed_log.write(msg)
         conn.rollback()
+        for sku in prepared_skus:
+            job_state.mark_failed(STAGE, sku, e)
 
+    progress["processed"] += len(batch)
+    processed = progress["processed"]
     elapsed = time.time() - start_time
-    processed = batch_start + len(batch)
-    total = len(rows)
-    avg_time_per_row = elapsed / processed
-    remaining = total - processed
-    eta_seconds = remaining * avg_time_per_row
-    eta_hours = int(eta_seconds // 3600)
-    eta_minutes = int((eta_seconds % 3600) // 60)
+    rate = processed / elapsed if elapsed else 0.0
+    if progress["bytes_total"]:
+        downloaded = f"{100 * progress['bytes_read'] / progress['bytes_total']:.0f}% of catalog streamed"
+    else:
+        downloaded = f"{progress['bytes_read'] / 1_000_000:.1f} MB of catalog streamed"
+    print(f"⏳ Processed {processed} rows in {elapsed:.2f}s — {rate:.1f} rows/s, {downloaded}{format_eta(processed, rate)}", flush=True)
+
+    # Live cost tracking, from the usage OpenAI reports on each response
+    cost_so_far = metrics.cost(STAGE)
+    cost_per_thousand = 1000 * cost_so_far / processed if processed else 0.0
+    print(f"💸 Cost so far: ${cost_so_far:.4f} for {metrics.tokens(STAGE):,} tokens "
+          f"| ${cost_per_thousand:.4f} per 1k rows", flush=True)
+    print(f"📐 Batch size {sizer.size} (failure rate {sizer.failure_rate:.0%})", flush=True)
 
-    # Live cost tracking (based on processed tokens)
-    tokens_so_far = processed * 250
-    cost_so_far = (tokens_so_far / 1_000_000) * 5
-    cost_per_million = (len(batch) * 250 / 1_000_000) * 5
+# Rows left, estimated from the share of the file streamed so far and the
+# share of streamed rows this run keeps (resume, retry and shard filters)
+def format_eta(processed, rate):
+    rows_read, bytes_read, bytes_total = progress["rows_read"], progress["bytes_read"], progress["bytes_total"]
+    if not (bytes_total and bytes_read and rows_read and rate):
+        return ""
+    kept = (rows_read - progress["rows_skipped"]) / rows_read
+    remaining = max(0.0, rows_read * bytes_total / bytes_read * kept - processed)
+    return f", ~{remaining:,.0f} rows left (ETA {remaining / rate / 60:.1f} min)"
 
-    print(f"⏳ Processed {processed} rows in {elapsed:.2f}s — ETA: {eta_hours}h {eta_minutes}m remaining", flush=True)
-    print(f"💸 Cost so far: ${cost_so_far:.2f} | Current cost per million tokens: ${cost_per_million:.2f}", flush=True)
+# === Producer: stream rows into batches ===
+# Runs in a worker thread; each put blocks until the bounded queue has room,
+# which throttles the download to the labeling rate. Batches are cut at the
+# sizer's current size. With `resume_after`, rows up to that CSV row number
+# are skipped; with `only_skus`, only those SKUs are labeled. With a sharded
+# `source`, only the SKUs in its slice are labeled.
+def produce_batches(loop, queue, workers, resume_after=None, only_skus=None, source=None):
+    def put(item):
+        asyncio.run_coroutine_threadsafe(queue.put(item), loop).result()
 
-# === Async semaphore wrapper ===
-semaphore = asyncio.Semaphore(6)  # increased concurrency to better utilize 800k TPM limit  # limit to 4 concurrent batches
+    try:
+        print(f"📦 Streaming catalog from {catalog_url}...", flush=True)
+        batch, row_numbers = [], []
+        for row_number, row in enumerate(iter_catalog_rows(catalog_url)):
+            if (
+                (resume_after is not None and row_number <= resume_after)
+                or (only_skus is not None and row.get("parent_sku") not in only_skus)
+                or (source is not None and not source.owns(row.get("parent_sku")))
+            ):
+                progress["rows_skipped"] += 1
+                continue
+            watermark.start(row_number)
+            batch.append(row)
+            row_numbers.append(row_number)
+            if len(batch) >= sizer.size:
+                put((batch, row_numbers))
+                batch, row_numbers = [], []
+        if batch:
+            put((batch, row_numbers))
+        print("✅ Catalog fully streamed", flush=True)
+    finally:
+        for _ in range(workers):
+            put(None)
 
-async def throttled_label_batch(session, batch, batch_start):
-    async with semaphore:
-        await label_batch(session, batch, batch_start)
+# === Consumer: label batches as they arrive ===
+async def label_worker(session, queue, checkpoint, checkpoint_stage=STAGE):
+    while True:
+        job = await queue.get()
+        if job is None:
+            return
+        batch, row_numbers = job
+        try:
+            await label_batch(session, batch, row_numbers)
+        except Exception as e:
+            msg = f"Labeling failed for batch starting at row {row_numbers[0] + 1}: {e}\n"
+            print(f"❌ {msg}", flush=True)
+            failed_log.write(msg)
+            for row in batch:
+                job_state.mark_failed(STAGE, row.get("parent_sku"), e)
+        for row_number in row_numbers:
+            watermark.finish(row_number)
+        if checkpoint:
+            job_state.set_checkpoint(checkpoint_stage, watermark.value)
 
 # === Main loop ===
-async def main():
-    batch_size = 125  # ~125 products × 250 tokens ≈ 31,250 tokens per batch
-    tasks = []
+# Labeling streams the CSV rather than product_catalog, so it has no leases to
+# claim; several workers split the file with static --shard slices instead
+async def main(resume=False, retry_failed=False, shard=None):
+    print("\n🚀 Script started", flush=True)
+    ensure_staging_table()
+    source = WorkSource(STAGE, shard=shard)
+    resume_after = None
+    only_skus = None
+    if retry_failed:
+        only_skus = set(job_state.failed_keys(STAGE))
+        print(f"🔁 Retrying {len(only_skus)} failed SKUs", flush=True)
+    elif resume:
+        checkpoint = job_state.get_checkpoint(source.checkpoint_stage)
+        resume_after = int(checkpoint) if checkpoint is not None else None
+        if resume_after is not None:
+            watermark.value = resume_after
+            print(f"⏯️ Resuming after CSV row {resume_after + 1}", flush=True)
+
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue(maxsize=QUEUE_DEPTH)
+    metrics.watch("pipeline_queue_depth", queue.qsize, stage=STAGE, queue="batches")
     async with aiohttp.ClientSession() as session:
-        for batch_start in range(0, len(rows), batch_size):
-            batch = [r for r in rows[batch_start:batch_start + batch_size] if r.get("parent_sku") not in existing_skus]
-            if batch:
-                tasks.append(throttled_label_batch(session, batch, batch_start))
-        await asyncio.gather(*tasks)
+        workers = [
+            asyncio.create_task(label_worker(session, queue, not retry_failed, source.checkpoint_stage))
+            for _ in range(LABEL_CONCURRENCY)
+        ]
+        producer = loop.run_in_executor(None, produce_batches, loop, queue, LABEL_CONCURRENCY, resume_after, only_skus, source)
+        await asyncio.gather(producer, *workers)
 
-    conn.close()
+    # A completed pass starts from the top next time
+    if not retry_failed:
+        job_state.set_checkpoint(source.checkpoint_stage, None)
+    print(f"📊 {STAGE}: {job_state.summary(STAGE)}", flush=True)
+    job_state.close()
+    close_conn(STAGE)
     failed_log.close()
+    label_cache.close()
+    stats = label_cache.stats
+    print(f"🧠 Label cache: {stats['hits']} hits, {stats['misses']} misses", flush=True)
+    print(f"💸 OpenAI usage: {metrics.tokens(STAGE, kind='prompt'):,} prompt + "
+          f"{metrics.tokens(STAGE, kind='completion'):,} completion tokens, ${metrics.cost(STAGE):.4f}", flush=True)
     print("✅ All rows processed.", flush=True)
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    parser = add_job_args(argparse.ArgumentParser())
+    args = parser.parse_args()
+    if args.claim:
+        parser.error("labeling reads the catalog CSV, not product_catalog; split it with --shard instead")
+    metrics.start(STAGE)
+    asyncio.run(main(resume=args.resume, retry_failed=args.retry_failed, shard=args.shard))
@@ -0,0 +1,367 @@
+# metrics.py
+
+import os
+import sys
+import json
+import time
+import bisect
+import atexit
+import socket
+import threading
+import multiprocessing
+from contextlib import contextmanager
+from collections import Counter
+
+# === Metrics Settings ===
+METRICS_DIR = os.getenv("METRICS_DIR", ".cache/metrics")
+METRICS_FORMAT = os.getenv("METRICS_FORMAT", "prom")  # prom (Prometheus textfile) | json | both | off
+METRICS_INTERVAL = float(os.getenv("METRICS_INTERVAL", 15))  # seconds between exports
+METRICS_INSTANCE = os.getenv("METRICS_INSTANCE")  # tells apart several workers of one stage on a host
+PROFILE_HZ = float(os.getenv("PROFILE_HZ", 0))  # stack samples per second; 0 leaves the profiler off
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+# USD per 1M tokens as (prompt, completion); update when OpenAI's pricing changes
+OPENAI_PRICES = {
+    "gpt-4o-mini": (0.15, 0.60),
+    "text-embedding-3-small": (0.02, 0.0)
+}
+
+HELP = {
+    "pipeline_step_seconds": ("histogram", "Time spent in one step of a stage"),
+    "pipeline_product_seconds": ("histogram", "Time from a product being queued to leaving the last stage"),
+    "pipeline_items_total": ("counter", "Items a stage finished, by status"),
+    "pipeline_queue_depth": ("gauge", "Items waiting in an in-process queue"),
+    "openai_requests_total": ("counter", "OpenAI requests by outcome"),
+    "openai_tokens_total": ("counter", "Tokens billed, from each response's usage field"),
+    "openai_cost_usd_total": ("counter", "Estimated spend from billed tokens and OPENAI_PRICES"),
+    "profiler_samples_total": ("counter", "Stack samples taken by the sampling profiler")
+}
+
+def label_key(labels):
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+# === Histogram ===
+# Fixed buckets, so observations are O(log buckets) and snapshots from worker
+# processes merge by adding counts. Quantiles are interpolated within a bucket.
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def merge(self, counts, total, count):
+        for i, n in enumerate(counts):
+            self.counts[i] += n
+        self.sum += total
+        self.count += count
+
+    def quantile(self, q):
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            if n and seen + n >= rank:
+                lower = self.buckets[i - 1] if i > 0 else 0.0
+                upper = self.buckets[i] if i < len(self.buckets) else self.buckets[-1]
+                return lower + (upper - lower) * (rank - seen) / n
+            seen += n
+        return self.buckets[-1]
+
+# === Registry ===
+# Counters, gauges and histograms keyed by (name, labels). Gauges may be
+# callables (e.g. a queue's qsize), read at export time. Thread-safe.
+class Registry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = Counter()
+        self.gauges = {}
+        self.histograms = {}
+
+    def inc(self, name, value=1, **labels):
+        with self.lock:
+            self.counters[(name, label_key(labels))] += value
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.gauges[(name, label_key(labels))] = value
+
+    def observe(self, name, value, **labels):
+        key = (name, label_key(labels))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+
+    def value(self, name, **labels):
+        with self.lock:
+            return self.counters.get((name, label_key(labels)), 0)
+
+    def total(self, name, **labels):
+        wanted = set(label_key(labels))
+        with self.lock:
+            return sum(value for (n, key), value in self.counters.items() if n == name and wanted <= set(key))
+
+    # Counters and histograms recorded since the last drain, for shipping
+    # from a worker process to its parent (see `merge`)
+    def drain(self):
+        with self.lock:
+            counters, self.counters = dict(self.counters), Counter()
+            histograms, self.histograms = self.histograms, {}
+        return {
+            "counters": list(counters.items()),
+            "histograms": [(key, h.counts, h.sum, h.count) for key, h in histograms.items()]
+        }
+
+    def merge(self, drained):
+        if not drained:
+            return
+        with self.lock:
+            for key, value in drained["counters"]:
+                self.counters[key] += value
+            for key, counts, total, count in drained["histograms"]:
+                histogram = self.histograms.get(key)
+                if histogram is None:
+                    histogram = self.histograms[key] = Histogram()
+                histogram.merge(counts, total, count)
+
+    def read_gauges(self):
+        with self.lock:
+            gauges = list(self.gauges.items())
+        values = []
+        for key, value in gauges:
+            try:
+                values.append((key, float(value() if callable(value) else value)))
+            except Exception:
+                continue
+        return values
+
+    def snapshot(self):
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted((key, h) for key, h in self.histograms.items())
+            histograms = [(key, h.buckets, list(h.counts), h.sum, h.count, h.quantile(0.5), h.quantile(0.95), h.quantile(0.99))
+                          for key, h in histograms]
+        return {
+            "counters": [{"name": name, "labels": dict(labels), "value": value} for (name, labels), value in counters],
+            "gauges": [{"name": name, "labels": dict(labels), "value": value} for (name, labels), value in sorted(self.read_gauges())],
+            "histograms": [
+                {"name": name, "labels": dict(labels), "count": count, "sum": round(total, 6),
+                 "p50": p50, "p95": p95, "p99": p99, "buckets": dict(zip([*map(str, buckets), "+Inf"], counts))}
+                for (name, labels), buckets, counts, total, count, p50, p95, p99 in histograms
+            ]
+        }
+
+registry = Registry()
+job_labels = {}
+
+# === Recording helpers ===
+def inc(name, value=1, **labels):
+    registry.inc(name, value, **labels)
+
+def set_gauge(name, value, **labels):
+    registry.set(name, value, **labels)
+
+# Queue depths and the like, read whenever metrics are exported
+def watch(name, read, **labels):
+    registry.set(name, read, **labels)
+
+def observe(name, value, **labels):
+    registry.observe(name, value, **labels)
+
+# Times one step of a stage: with step("transparent", "upload"): ...
+@contextmanager
+def step(stage, name):
+    began = time.perf_counter()
+    try:
+        yield
+    finally:
+        registry.observe("pipeline_step_seconds", time.perf_counter() - began, stage=stage, step=name)
+
+def item(stage, status, count=1):
+    registry.inc("pipeline_items_total", count, stage=stage, status=status)
+
+# Billed tokens and spend, from a response's usage
+# ({"prompt_tokens": ..., "completion_tokens": ..., "total_tokens": ...})
+def record_usage(stage, model, usage):
+    if not usage:
+        return
+    prompt = usage.get("prompt_tokens") or 0
+    completion = usage.get("completion_tokens") or 0
+    registry.inc("openai_tokens_total", prompt, stage=stage, model=model, kind="prompt")
+    registry.inc("openai_tokens_total", completion, stage=stage, model=model, kind="completion")
+    prompt_price, completion_price = OPENAI_PRICES.get(model, (0.0, 0.0))
+    registry.inc("openai_cost_usd_total", (prompt * prompt_price + completion * completion_price) / 1_000_000,
+                 stage=stage, model=model)
+
+def cost(stage=None):
+    return registry.total("openai_cost_usd_total", **({"stage": stage} if stage else {}))
+
+def tokens(stage=None, kind=None):
+    labels = {name: value for name, value in (("stage", stage), ("kind", kind)) if value}
+    return int(registry.total("openai_tokens_total", **labels))
+
+# Worker processes (inference pools) record into their own registry and hand
+# what they recorded back with their results
+def in_worker_process():
+    return multiprocessing.parent_process() is not None
+
+def drain():
+    return registry.drain() if in_worker_process() else None
+
+# For a forked worker: drops what it inherited from the parent (including a
+# lock some parent thread may have held at fork time)
+def reset():
+    global registry
+    registry = Registry()
+
+def merge(drained):
+    registry.merge(drained)
+
+# === Export ===
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def format_labels(labels, extra=()):
+    pairs = [*job_labels.items(), *labels, *extra]
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{escape(value)}"' for name, value in pairs) + "}"
+
+# Prometheus text exposition format, for node_exporter's textfile collector
+def prometheus():
+    lines = []
+    described = set()
+
+    def describe(name):
+        if name not in described:
+            described.add(name)
+            kind, text = HELP.get(name, ("untyped", name))
+            lines.append(f"# HELP {name} {text}")
+            lines.append(f"# TYPE {name} {kind}")
+
+    with registry.lock:
+        counters = sorted(registry.counters.items())
+        histograms = sorted((key, h.buckets, list(h.counts), h.sum, h.count) for key, h in registry.histograms.items())
+    for (name, labels), value in counters:
+        describe(name)
+        lines.append(f"{name}{format_labels(labels)} {value}")
+    for (name, labels), value in sorted(registry.read_gauges()):
+        describe(name)
+        lines.append(f"{name}{format_labels(labels)} {value}")
+    for (name, labels), buckets, counts, total, count in histograms:
+        describe(name)
+        cumulative = 0
+        for bound, n in zip([*map(str, buckets), "+Inf"], counts):
+            cumulative += n
+            lines.append(f"{name}_bucket{format_labels(labels, [('le', bound)])} {cumulative}")
+        lines.append(f"{name}_sum{format_labels(labels)} {total}")
+        lines.append(f"{name}_count{format_labels(labels)} {count}")
+    return "\n".join(lines) + "\n"
+
+def write_atomic(path, text):
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+class Exporter:
+    def __init__(self, job, directory=METRICS_DIR, fmt=METRICS_FORMAT, interval=METRICS_INTERVAL):
+        self.job = job
+        self.name = f"{job}-{METRICS_INSTANCE}" if METRICS_INSTANCE else job
+        self.directory = directory
+        self.fmt = fmt
+        self.interval = interval
+        self.started = time.time()
+        self.stopped = threading.Event()
+        os.makedirs(directory, exist_ok=True)
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def export(self):
+        try:
+            if self.fmt in ("prom", "both"):
+                write_atomic(os.path.join(self.directory, f"{self.name}.prom"), prometheus())
+            if self.fmt in ("json", "both"):
+                snapshot = {"job": self.job, "labels": job_labels, "timestamp": time.time(),
+                            "uptime_seconds": round(time.time() - self.started, 1), **registry.snapshot()}
+                write_atomic(os.path.join(self.directory, f"{self.name}.json"), json.dumps(snapshot, indent=1))
+        except Exception as e:
+            print(f"⚠️ Failed to export metrics: {e}", flush=True)
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            self.export()
+
+    def stop(self):
+        if self.stopped.is_set():
+            return
+        self.stopped.set()
+        self.export()
+
+# === Sampling profiler ===
+# Every 1/hz seconds, records the stack of every other thread. Written as
+# folded stacks ("frame;frame;frame count" per line), the input format of
+# flamegraph.pl and speedscope, next to the metrics files. Only this process
+# is sampled; inference workers are not.
+class SamplingProfiler:
+    def __init__(self, path, hz=PROFILE_HZ):
+        self.path = path
+        self.interval = 1.0 / hz
+        self.stacks = Counter()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        own = threading.get_ident()
+        while not self.stopped.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                    frame = frame.f_back
+                stack.append(names.get(ident, "thread"))
+                self.stacks[";".join(reversed(stack))] += 1
+            registry.inc("profiler_samples_total")
+
+    def write(self):
+        lines = [f"{stack} {count}" for stack, count in self.stacks.most_common()]
+        write_atomic(self.path, "\n".join(lines) + "\n")
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        self.write()
+
+exporter = None
+profiler = None
+
+# Called once by each script's entry point. Exports every METRICS_INTERVAL
+# and once more at exit; with PROFILE_HZ (or `profile_hz`) also samples stacks.
+def start(job, profile_hz=PROFILE_HZ, **labels):
+    global exporter, profiler
+    if exporter is not None or METRICS_FORMAT == "off":
+        return
+    job_labels.update({"process": job, "host": socket.gethostname(), **labels})
+    exporter = Exporter(job)
+    if profile_hz:
+        profiler = SamplingProfiler(os.path.join(exporter.directory, f"{exporter.name}.folded"), profile_hz)
+    atexit.register(stop)
+
+def stop():
+    if profiler is not None:
+        profiler.stop()
+    if exporter is not None:
+        exporter.stop()
@@ -0,0 +1,174 @@
+# onnx_backend.py
+
+import os
+import glob
+import torch
+import numpy as np
+import onnxruntime as ort
+from PIL import Image
+from ultralytics import YOLO
+from onnxruntime.quantization import CalibrationDataReader, QuantFormat, QuantType, quantize_dynamic, quantize_static
+from inference import (
+    DETECTOR_WEIGHTS, DETECT_SIZE, PERSON_CLASS_ID, SEGMENT_SIZE,
+    bucket_by_size, load_segmenter, prepare_segment_input
+)
+
+# === ONNX Settings ===
+ONNX_MODEL_DIR = os.getenv("ONNX_MODEL_DIR", ".cache/onnx")
+CALIBRATION_DIR = os.getenv(
+    "ONNX_CALIBRATION_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "temp")
+)
+CALIBRATION_LIMIT = 32
+OPSET = 17
+LETTERBOX_FILL = 114
+DETECT_CONFIDENCE = 0.25  # ultralytics' default predict threshold
+
+# === Export ===
+# DeepLabV3 wrapped so the graph returns per-pixel class ids rather than
+# 21-channel logits; height and width stay dynamic for the size buckets.
+class SegmentationClasses(torch.nn.Module):
+    def __init__(self, segmenter):
+        super().__init__()
+        self.segmenter = segmenter
+
+    def forward(self, x):
+        return self.segmenter(x)["out"].argmax(1).to(torch.uint8)
+
+def export_segmenter(segment_model, path):
+    dummy = torch.zeros(1, 3, SEGMENT_SIZE, SEGMENT_SIZE)
+    torch.onnx.export(
+        SegmentationClasses(load_segmenter(segment_model)),
+        dummy,
+        path,
+        input_names=["input"],
+        output_names=["classes"],
+        dynamic_axes={"input": {0: "batch", 2: "height", 3: "width"}, "classes": {0: "batch", 1: "height", 2: "width"}},
+        opset_version=OPSET
+    )
+
+def export_detector(path):
+    exported = YOLO(DETECTOR_WEIGHTS).export(format="onnx", dynamic=True, imgsz=DETECT_SIZE, opset=OPSET)
+    os.replace(exported, path)
+
+# === Preprocessing ===
+# Aspect-preserving resize into a DETECT_SIZE square padded with grey, as
+# ultralytics' own letterbox; returns a CHW float32 array in [0, 1]
+def letterbox(image):
+    width, height = image.size
+    scale = DETECT_SIZE / max(width, height)
+    resized = image.resize((max(1, round(width * scale)), max(1, round(height * scale))), Image.BILINEAR)
+    canvas = np.full((DETECT_SIZE, DETECT_SIZE, 3), LETTERBOX_FILL, dtype=np.uint8)
+    top = (DETECT_SIZE - resized.height) // 2
+    left = (DETECT_SIZE - resized.width) // 2
+    canvas[top:top + resized.height, left:left + resized.width] = np.asarray(resized)
+    tensor = canvas.transpose(2, 0, 1).astype(np.float32)
+    tensor *= 1 / 255.0
+    return tensor
+
+# === Static quantization calibration ===
+def load_calibration_images(directory=CALIBRATION_DIR, limit=CALIBRATION_LIMIT):
+    images = []
+    for path in sorted(glob.glob(os.path.join(directory, "*"))):
+        try:
+            images.append(Image.open(path).convert("RGB"))
+        except Exception:
+            continue
+        if len(images) >= limit:
+            break
+    if not images:
+        raise RuntimeError(f"Static quantization needs calibration images in {directory}")
+    return images
+
+def segment_calibration(images):
+    for padded_shape, members in bucket_by_size(images).items():
+        for i, resized in members:
+            yield prepare_segment_input(images[i], resized, padded_shape)[None]
+
+def detect_calibration(images):
+    for image in images:
+        yield letterbox(image)[None]
+
+class CalibrationInputs(CalibrationDataReader):
+    def __init__(self, input_name, batches):
+        self.input_name = input_name
+        self.batches = iter(batches)
+
+    def get_next(self):
+        batch = next(self.batches, None)
+        return None if batch is None else {self.input_name: batch}
+
+# Exports the fp32 graph once, then (optionally) its int8 variant; both are
+# cached on disk so workers only pay for this on first start
+def prepare_model(name, export, quantize=None, calibration=None):
+    os.makedirs(ONNX_MODEL_DIR, exist_ok=True)
+    path = os.path.join(ONNX_MODEL_DIR, f"{name}.onnx")
+    if not os.path.exists(path):
+        print(f"📦 Exporting {name} to ONNX")
+        export(path)
+    if not quantize:
+        return path
+
+    quantized_path = os.path.join(ONNX_MODEL_DIR, f"{name}.{quantize}.onnx")
+    if os.path.exists(quantized_path):
+        return quantized_path
+    print(f"📦 Quantizing {name} ({quantize} int8)")
+    if quantize == "dynamic":
+        quantize_dynamic(path, quantized_path, weight_type=QuantType.QUInt8)
+    elif quantize == "static":
+        input_name = ort.InferenceSession(path, providers=["CPUExecutionProvider"]).get_inputs()[0].name
+        quantize_static(
+            path,
+            quantized_path,
+            CalibrationInputs(input_name, calibration(load_calibration_images())),
+            quant_format=QuantFormat.QDQ,
+            per_channel=True,
+            activation_type=QuantType.QUInt8,
+            weight_type=QuantType.QInt8
+        )
+    else:
+        raise ValueError(f"Unknown quantization mode: {quantize}")
+    return quantized_path
+
+# === ONNX Runtime backend ===
+# Same interface as inference.TorchBackend. Sessions are created on first use,
+# so a forked inference worker builds its own thread pool after
+# `set_num_threads` rather than inheriting one from the parent.
+class OnnxBackend:
+    def __init__(self, segment_model, quantize=None):
+        self.name = f"onnx:{quantize}" if quantize else "onnx"
+        self.device = torch.device("cpu")
+        self.threads = 0  # 0 lets ONNX Runtime use every physical core
+        self.segmenter_path = prepare_model(
+            f"deeplabv3_{segment_model}", lambda path: export_segmenter(segment_model, path), quantize, segment_calibration
+        )
+        self.detector_path = prepare_model(
+            os.path.splitext(DETECTOR_WEIGHTS)[0], export_detector, quantize, detect_calibration
+        )
+        self.sessions = {}
+
+    def set_num_threads(self, threads):
+        self.threads = threads
+        torch.set_num_threads(threads)
+
+    def session(self, path):
+        if path not in self.sessions:
+            options = ort.SessionOptions()
+            options.intra_op_num_threads = self.threads
+            options.inter_op_num_threads = 1
+            options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+            self.sessions[path] = ort.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+        return self.sessions[path]
+
+    def run(self, path, batch):
+        session = self.session(path)
+        return session.run(None, {session.get_inputs()[0].name: batch})[0]
+
+    # YOLOv8 output is (N, 4 + classes, anchors) with class scores already
+    # sigmoid-activated; any person anchor above the threshold counts, which
+    # is what NMS would keep at least one of
+    def detect(self, images):
+        predictions = self.run(self.detector_path, np.stack([letterbox(image) for image in images]))
+        return [bool(found) for found in (predictions[:, 4 + PERSON_CLASS_ID, :] > DETECT_CONFIDENCE).any(axis=1)]
+
+    def segment(self, batch):
+        return self.run(self.segmenter_path, batch)
@@ -0,0 +1,428 @@
+# pipeline_runner.py
+
+import os
+import json
+import time
+import asyncio
+import argparse
+import importlib
+import statistics
+from collections import defaultdict
+import aiohttp
+from dotenv import load_dotenv
+import metrics
+from catalog_scanner import take_batch
+from connections import get_conn, close_all
+from write_buffer import WriteBehindBuffer, install_shutdown_handlers
+from job_state import JobState, parse_shard, item_ids
+from work_claims import WorkSource
+
+# === Load ENV ===
+load_dotenv()
+SUPABASE_EMBEDDING_TABLE = os.getenv("SUPABASE_EMBEDDING_TABLE", "product_embeddings")
+STAGE = "runner"
+
+# === Runner Settings ===
+DOWNLOAD_WORKERS = int(os.getenv("RUNNER_DOWNLOAD_WORKERS", 16))  # products downloading/uploading at once
+BACKGROUND_WORKERS = int(os.getenv("RUNNER_BACKGROUND_WORKERS", 1))  # inference processes
+LABEL_WORKERS = int(os.getenv("RUNNER_LABEL_WORKERS", 4))  # labeling requests in flight
+EMBED_WORKERS = int(os.getenv("RUNNER_EMBED_WORKERS", 2))  # embedding requests in flight
+BACKGROUND_BATCH_SIZE = int(os.getenv("INFERENCE_BATCH_SIZE", 8))
+LABEL_BATCH_SIZE = 25
+EMBED_BATCH_SIZE = 100
+STAGE_QUEUE_SIZE = int(os.getenv("RUNNER_QUEUE_SIZE", 64))  # products buffered in front of each stage
+POLL_INTERVAL = float(os.getenv("RUNNER_POLL_INTERVAL", 5))  # seconds between polls for new products (--follow)
+MAX_ATTEMPTS = int(os.getenv("RUNNER_MAX_ATTEMPTS", 3))  # per product and stage, counting the first try (--retry-failed)
+SCAN_PAGE_SIZE = 200
+
+STAGES = ["download", "background", "label", "embed"]
+CATALOG_COLUMNS = [
+    "parent_sku", "image_url", "additional_images", "hosted_image_url", "transparent_image_url",
+    "title", "description", "brand", "color", "category", "description_ai"
+]
+
+# A product is picked up when any enabled stage still has work for it
+PENDING = {
+    "download": "hosted_image_url IS NULL AND image_url IS NOT NULL",
+    "background": "transparent_image_url IS NULL",
+    "label": "description_ai IS NULL",
+    "embed": f"NOT EXISTS (SELECT 1 FROM {SUPABASE_EMBEDDING_TABLE} e WHERE e.product_id = product_catalog.id)"
+}
+
+# ...unless that stage's job state already settled it: skipped (e.g. no
+# suitable image) or failed. Failures are only picked up again with
+# --retry-failed, and then only until they have had MAX_ATTEMPTS. Stage
+# modules record items under their own STAGE name, keyed by catalog id except
+# for labeling, which keys by parent_sku.
+JOB_STAGES = {"download": "download", "background": "transparent", "label": "label", "embed": "embed"}
+JOB_KEYS = {"download": "id", "background": "id", "label": "parent_sku", "embed": "id"}
+
+# === Lazily loaded stages ===
+# A stage module (and whatever it pulls in: torch and the models, API clients,
+# write buffers) is imported and set up the first time a product actually
+# needs that stage, off the event loop. A run with nothing to do never loads
+# any of them.
+class LazyStage:
+    def __init__(self, module_name, setup):
+        self.module_name = module_name
+        self.setup = setup
+        self.loaded = None
+        self.lock = asyncio.Lock()
+
+    async def load(self):
+        async with self.lock:
+            if self.loaded is None:
+                began = time.monotonic()
+                self.loaded = await asyncio.get_running_loop().run_in_executor(None, self._load)
+                print(f"📦 Loaded {self.module_name} in {time.monotonic() - began:.1f}s", flush=True)
+        return self.loaded
+
+    def _load(self):
+        module = importlib.import_module(self.module_name)
+        return module, self.setup(module)
+
+# === Per-product pipeline ===
+# Each product flows download → background removal → labeling → embedding,
+# entering a stage as soon as it leaves the one before. Stages are joined by
+# bounded queues, so a slow stage holds back the poller rather than buffering
+# the catalog. A stage with nothing to do for a product (already hosted,
+# already labeled, embedding up to date) passes it straight on; a product a
+# stage fails on still continues to the stages that do not depend on it, and
+# the failure is recorded in that stage's job state for --retry-failed.
+# `source` decides which products this runner owns when several run at once.
+class PipelineRunner:
+    def __init__(self, stages=STAGES, workers=None, queue_size=STAGE_QUEUE_SIZE, source=None,
+                 retry_failed=False, max_attempts=MAX_ATTEMPTS):
+        self.enabled = set(stages)
+        self.source = source or WorkSource(STAGE)
+        self.job_state = JobState()
+        self.retry_failed = retry_failed
+        self.max_attempts = max_attempts
+        self.workers = {
+            "download": DOWNLOAD_WORKERS,
+            "background": BACKGROUND_WORKERS,
+            "label": LABEL_WORKERS,
+            "embed": EMBED_WORKERS,
+            **(workers or {})
+        }
+        self.batch_sizes = {"download": 1, "background": BACKGROUND_BATCH_SIZE, "label": LABEL_BATCH_SIZE, "embed": EMBED_BATCH_SIZE}
+        self.queue_size = queue_size
+        self.loaders = {
+            "download": LazyStage("download_images", self.setup_download),
+            "background": LazyStage("remove_background", self.setup_background),
+            "label": LazyStage("label_with_gpt", self.setup_label),
+            "embed": LazyStage("vectorize_and_index", self.setup_embed)
+        }
+        self.handlers = {
+            "download": self.download,
+            "background": self.remove_background,
+            "label": self.label,
+            "embed": self.embed
+        }
+        self.session = None
+        self.host_slots = None
+        self.embed_db = asyncio.Lock()
+        self.closers = []
+        self.latencies = []
+        self.stage_seconds = defaultdict(float)
+        self.stats = {"queued": 0, "finished": 0, "embedding_tokens": 0}
+
+    # === Stage setup (runs once, in a worker thread) ===
+    def setup_download(self, module):
+        url_buffer = WriteBehindBuffer(
+            ["hosted_image_url"],
+            on_flush=lambda ids: module.job_state.mark_done(module.STAGE, *ids),
+            stage=module.STAGE
+        )
+        self.closers.append(url_buffer.close)
+        return url_buffer
+
+    # Spawned inference workers: the runner already has threads, so forking is
+    # not safe here; each worker loads the models on its first batch
+    def setup_background(self, module):
+        module.ensure_meta_column()
+        tracker = module.ProductTracker(None, checkpoint=False)
+        pool = module.start_inference_pool(self.workers["background"], context="spawn")
+        self.closers.append(tracker.close)
+        self.closers.append(pool.shutdown)
+        return tracker, pool
+
+    def setup_label(self, module):
+        skus = {}
+        label_buffer = WriteBehindBuffer(
+            list(module.LABEL_FIELDS),
+            on_flush=lambda ids: module.job_state.mark_done(module.STAGE, *(skus.pop(i, i) for i in ids)),
+            casts={field: "jsonb" for field in module.LABEL_FIELDS if field != "description_ai"},
+            stage=module.STAGE
+        )
+        self.closers.append(label_buffer.close)
+        return label_buffer, skus
+
+    def setup_embed(self, module):
+        module.ensure_hash_column()
+        # Retries are owned by the module's shared limiter
+        return module.openai.AsyncOpenAI(api_key=module.openai.api_key, max_retries=0)
+
+    # === Stage handlers ===
+    # Each takes a batch of product dicts and updates them in place, so later
+    # stages see the new URLs and labels without reading them back
+    async def download(self, batch):
+        todo = [product for product in batch if not product["hosted_image_url"] and product["image_url"]]
+        if not todo:
+            return
+        module, url_buffer = await self.loaders["download"].load()
+        if self.host_slots is None:
+            self.host_slots = defaultdict(lambda: asyncio.Semaphore(module.PER_HOST_LIMIT))
+        for product in todo:
+            hosted_image_url = await module.process_product(self.session, self.host_slots, product, url_buffer)
+            if hosted_image_url:
+                product["hosted_image_url"] = hosted_image_url
+
+    async def remove_background(self, batch):
+        todo = [product for product in batch if not product["transparent_image_url"] and product["hosted_image_url"]]
+        if not todo:
+            return
+        loop = asyncio.get_running_loop()
+        module, (tracker, pool) = await self.loaders["background"].load()
+        products, candidates = [], []
+        for product in todo:
+            tracker.start(product["id"])
+            try:
+                candidates.append(module.parse_candidates(product["hosted_image_url"], product["additional_images"]))
+            except Exception as e:
+                tracker.failed(product["id"], product["parent_sku"], e)
+                continue
+            products.append(product)
+
+        # Bring the first candidates into the image cache the workers read from
+        await asyncio.gather(*(
+            module.prefetch_image(self.session, url)
+            for urls in candidates for url in urls[:module.PREFETCH_CANDIDATES]
+        ), return_exceptions=True)
+        try:
+            results, savings, worker_metrics = await loop.run_in_executor(pool, module.infer_in_worker, candidates)
+        except Exception as e:
+            for product in products:
+                tracker.failed(product["id"], product["parent_sku"], e)
+            return
+        metrics.merge(worker_metrics)
+        tracker.add_savings(savings)
+
+        for product, result in zip(products, results):
+            if not tracker.inferred(product["id"], product["parent_sku"], result):
+                if result and result["reused"]:
+                    product["transparent_image_url"] = result["reused"]["url"]
+                continue
+            try:
+                public_url = await loop.run_in_executor(None, module.upload_cutout, product["parent_sku"], result["cutout"])
+            except Exception as e:
+                tracker.failed(product["id"], product["parent_sku"], e)
+                continue
+            tracker.uploaded(product["id"], public_url, result)
+            product["transparent_image_url"] = public_url
+
+    # Labels catalog rows that arrived without them (label_with_gpt.py labels
+    # CSV rows before inserting them, so this is mostly a pass-through)
+    async def label(self, batch):
+        todo = [product for product in batch if not product["description_ai"] and (product["title"] or product["description"])]
+        if not todo:
+            return
+        loop = asyncio.get_running_loop()
+        module, (label_buffer, skus) = await self.loaders["label"].load()
+        rows = [{"parent_sku": p["parent_sku"], "title": p["title"], "description": p["description"]} for p in todo]
+        labels = await module.label_texts(self.session, rows, list(range(len(rows))), f"Labeling {len(rows)} products")
+        for i, product in enumerate(todo):
+            result = labels.get(i)
+            if result is None:
+                continue  # already logged and marked failed
+            skus[product["id"]] = product["parent_sku"]
+            values = [result.get(field) if field == "description_ai" else json.dumps(result.get(field))
+                      for field in module.LABEL_FIELDS]
+            await loop.run_in_executor(None, label_buffer.add, product["id"], *values)
+            product["description_ai"] = result.get("description_ai")
+
+    # Embeds products whose text hash differs from the stored one and upserts
+    # them right away, so they are searchable as soon as this returns
+    async def embed(self, batch):
+        loop = asyncio.get_running_loop()
+        module, client = await self.loaders["embed"].load()
+        items = [
+            module.embedding_item(p["id"], p["parent_sku"], p["title"], p["brand"], p["color"], p["category"], p["description"])
+            for p in batch
+        ]
+        async with self.embed_db:
+            stored = await loop.run_in_executor(None, module.fetch_stored_hashes, [item["product_id"] for item in items])
+        items = [item for item in items if stored.get(item["product_id"]) != item["content_hash"]]
+        if not items:
+            return
+
+        estimated_tokens = sum(module.estimate_tokens(item["text_input"]) for item in items)
+        embeddings, tokens_used = await module.get_embeddings(client, [item["text_input"] for item in items], estimated_tokens)
+        self.stats["embedding_tokens"] += tokens_used
+        if embeddings is None or len(embeddings) != len(items):
+            for item in items:
+                module.job_state.mark_failed(module.STAGE, item["product_id"], "embedding request failed")
+            return
+        async with self.embed_db:
+            indexed = await loop.run_in_executor(None, module.upsert_embeddings, items, embeddings)
+        if indexed:
+            module.job_state.mark_done(module.STAGE, *(item["product_id"] for item in items))
+        else:
+            for item in items:
+                module.job_state.mark_failed(module.STAGE, item["product_id"], "embedding upsert failed")
+
+    # === Wiring ===
+    async def run_stage(self, name, inbox, outbox):
+        async def worker():
+            while True:
+                batch = await take_batch(inbox, self.batch_sizes[name])
+                if batch is None:
+                    return
+                todo = [product for product in batch if name not in product["settled"]]
+                if name in self.enabled and todo:
+                    began = time.monotonic()
+                    try:
+                        await self.handlers[name](todo)
+                    except Exception as e:
+                        print(f"❌ {name} failed for {len(batch)} products: {e}", flush=True)
+                    self.stage_seconds[name] += time.monotonic() - began
+                for product in batch:
+                    if outbox is None:
+                        self.finish(product)
+                    else:
+                        await outbox.put(product)
+
+        await asyncio.gather(*(worker() for _ in range(max(1, self.workers[name]))))
+        if outbox is not None:
+            await outbox.put(None)
+
+    def finish(self, product):
+        latency = time.monotonic() - product["queued_at"]
+        self.latencies.append(latency)
+        metrics.observe("pipeline_product_seconds", latency, stage=STAGE)
+        self.stats["finished"] += 1
+        self.source.release(product["id"])
+        print(f"🏁 [{product['parent_sku']}] through the pipeline in {latency:.1f}s", flush=True)
+
+    # Streams pending products into the first stage. With `follow`, keeps
+    # polling for ids above the last one seen (or, when claiming, past the
+    # shared cursor), so newly inserted SKUs enter the pipeline within
+    # POLL_INTERVAL.
+    async def poll(self, inbox, follow, poll_interval):
+        loop = asyncio.get_running_loop()
+        last_id = None
+        while True:
+            settled = await loop.run_in_executor(None, self.settled_keys)
+            where, params = self.pending_filter(settled)
+            rows = self.source.rows(get_conn(STAGE), CATALOG_COLUMNS, where=where, params=params,
+                                    page_size=SCAN_PAGE_SIZE, start_after=last_id)
+            while True:
+                row = await loop.run_in_executor(None, next, rows, None)
+                if row is None:
+                    break
+                product = dict(zip(["id", *CATALOG_COLUMNS], row))
+                product["settled"] = {name for name, keys in settled.items() if str(product[JOB_KEYS[name]]) in keys}
+                product["queued_at"] = time.monotonic()
+                last_id = product["id"]
+                self.stats["queued"] += 1
+                await inbox.put(product)
+            if not follow:
+                break
+            await asyncio.sleep(poll_interval)
+        await inbox.put(None)
+
+    # {stage: item keys its job state has settled}, re-read on every poll
+    def settled_keys(self):
+        return {
+            name: self.job_state.settled_keys(JOB_STAGES[name], self.retry_failed, self.max_attempts)
+            for name in STAGES if name in self.enabled
+        }
+
+    def pending_filter(self, settled):
+        clauses, params = [], []
+        for name in STAGES:
+            if name not in self.enabled:
+                continue
+            if not settled[name]:
+                clauses.append(f"({PENDING[name]})")
+                continue
+            column = JOB_KEYS[name]
+            keys = [key for key in item_ids(settled[name]) if isinstance(key, int)] if column == "id" else list(settled[name])
+            clauses.append(f"({PENDING[name]} AND NOT ({column} = ANY(%s)))")
+            params.append(keys)
+        return " OR ".join(clauses), tuple(params)
+
+    async def run(self, follow=False, poll_interval=POLL_INTERVAL):
+        queues = [asyncio.Queue(self.queue_size) for _ in STAGES]
+        for name, queue in zip(STAGES, queues):
+            metrics.watch("pipeline_queue_depth", queue.qsize, stage=STAGE, queue=name)
+        async with aiohttp.ClientSession() as session:
+            self.session = session
+            try:
+                await asyncio.gather(
+                    self.poll(queues[0], follow, poll_interval),
+                    *(self.run_stage(name, queues[i], queues[i + 1] if i + 1 < len(STAGES) else None)
+                      for i, name in enumerate(STAGES))
+                )
+            finally:
+                for close in reversed(self.closers):
+                    close()
+                self.source.close()
+
+    def summary(self):
+        summary = dict(self.stats)
+        if self.latencies:
+            summary["p50_seconds"] = round(statistics.median(self.latencies), 2)
+            summary["max_seconds"] = round(max(self.latencies), 2)
+        summary["stage_seconds"] = {name: round(seconds, 1) for name, seconds in self.stage_seconds.items()}
+        return summary
+
+async def main(stages=STAGES, follow=False, poll_interval=POLL_INTERVAL, queue_size=STAGE_QUEUE_SIZE, workers=None,
+               shard=None, claim=False, retry_failed=False, max_attempts=MAX_ATTEMPTS):
+    install_shutdown_handlers()
+    started = time.monotonic()
+    runner = PipelineRunner(stages, workers, queue_size, WorkSource(STAGE, shard=shard, claim=claim),
+                            retry_failed=retry_failed, max_attempts=max_attempts)
+    try:
+        await runner.run(follow, poll_interval)
+    finally:
+        close_all()
+    print(f"📊 {STAGE}: {runner.summary()} in {time.monotonic() - started:.1f}s", flush=True)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Stream each product through download → background removal → labeling → embedding")
+    parser.add_argument("--follow", action="store_true", help="keep polling for new products instead of exiting when done")
+    parser.add_argument("--poll-interval", type=float, default=POLL_INTERVAL)
+    parser.add_argument("--stages", default=",".join(STAGES), help="comma-separated stages to run; others pass products through")
+    parser.add_argument("--download-workers", type=int, default=DOWNLOAD_WORKERS)
+    parser.add_argument("--background-workers", type=int, default=BACKGROUND_WORKERS, help="inference processes")
+    parser.add_argument("--label-workers", type=int, default=LABEL_WORKERS)
+    parser.add_argument("--embed-workers", type=int, default=EMBED_WORKERS)
+    parser.add_argument("--queue-size", type=int, default=STAGE_QUEUE_SIZE)
+    parser.add_argument("--shard", type=parse_shard, help="only process the INDEX/COUNT static slice of the catalog")
+    parser.add_argument("--claim", action="store_true", help="lease batches from a shared table so any number of runners can run")
+    parser.add_argument("--retry-failed", action="store_true", help="also pick up products a stage failed on in earlier runs")
+    parser.add_argument("--max-attempts", type=int, default=MAX_ATTEMPTS, help="attempts per product and stage with --retry-failed")
+    args = parser.parse_args()
+    metrics.start(STAGE)
+
+    stages = [name.strip() for name in args.stages.split(",") if name.strip()]
+    unknown = set(stages) - set(STAGES)
+    if unknown:
+        parser.error(f"unknown stages: {', '.join(sorted(unknown))}")
+    asyncio.run(main(
+        stages=stages,
+        follow=args.follow,
+        poll_interval=args.poll_interval,
+        queue_size=args.queue_size,
+        shard=args.shard,
+        claim=args.claim,
+        retry_failed=args.retry_failed,
+        max_attempts=args.max_attempts,
+        workers={
+            "download": args.download_workers,
+            "background": args.background_workers,
+            "label": args.label_workers,
+            "embed": args.embed_workers
+        }
+    ))
@@ -0,0 +1,241 @@
+# rate_limiter.py
+
+import re
+import time
+import random
+import asyncio
+import metrics
+
+# === Errors raised by wrapped calls ===
+# A call passed to RateLimiter.run raises RateLimited on HTTP 429 and
+# TransientError on timeouts / 5xx; anything else propagates unchanged.
+class RateLimited(Exception):
+    def __init__(self, message, retry_after=None, headers=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+        self.headers = headers or {}
+
+class TransientError(Exception):
+    pass
+
+# === Header parsing ===
+_DURATION_PART = re.compile(r"(\d+(?:\.\d+)?)(ms|h|m|s)")
+
+# OpenAI reset headers look like "1s", "6m0s" or "20ms"
+def parse_duration(value):
+    if value is None:
+        return None
+    value = str(value).strip()
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    parts = _DURATION_PART.findall(value)
+    if not parts:
+        return None
+    scale = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+    return sum(float(number) * scale[unit] for number, unit in parts)
+
+def parse_retry_after(headers):
+    if not headers:
+        return None
+    retry_after_ms = headers.get("retry-after-ms")
+    if retry_after_ms is not None:
+        try:
+            return float(retry_after_ms) / 1000
+        except ValueError:
+            pass
+    return parse_duration(headers.get("retry-after"))
+
+def _header_int(headers, name):
+    try:
+        return int(headers.get(name))
+    except (TypeError, ValueError):
+        return None
+
+# === Token bucket ===
+# Refills continuously at capacity/60 per second, so a full bucket is one
+# minute of budget. `level` may go negative when a call used more than it
+# reserved; later callers then wait for the debt to be repaid. After
+# `schedule_reset`, the bucket instead refills at whatever rate makes it full
+# when the server says the limit resets, then falls back to capacity/60.
+class TokenBucket:
+    def __init__(self, per_minute):
+        self.capacity = float(per_minute)
+        self.level = float(per_minute)
+        self.updated = time.monotonic()
+        self.reset_at = None
+        self.reset_rate = 0.0
+
+    @property
+    def rate(self):
+        return self.capacity / 60
+
+    def refill(self, now=None):
+        now = time.monotonic() if now is None else now
+        if self.reset_at is not None:
+            until = min(now, self.reset_at)
+            self.level = min(self.capacity, self.level + max(0.0, until - self.updated) * self.reset_rate)
+            self.updated = max(self.updated, until)
+            if now >= self.reset_at:
+                self.reset_at = None
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount):
+        self.refill()
+        amount = min(amount, self.capacity)
+        short = amount - self.level
+        if short <= 0:
+            return 0.0
+        if self.reset_at is not None:
+            window = self.reset_at - self.updated
+            if short <= window * self.reset_rate:
+                return short / self.reset_rate
+            return window + (short - window * self.reset_rate) / self.rate
+        return short / self.rate
+
+    def take(self, amount):
+        self.refill()
+        self.level -= amount
+
+    def give(self, amount):
+        self.refill()
+        self.level = min(self.capacity, self.level + amount)
+
+    def set_capacity(self, per_minute):
+        self.refill()
+        self.capacity = float(per_minute)
+        self.level = min(self.level, self.capacity)
+
+    def clamp_to(self, remaining):
+        self.refill()
+        self.level = min(self.level, float(remaining))
+
+    def schedule_reset(self, seconds):
+        self.refill()
+        deficit = self.capacity - self.level
+        if seconds <= 0 or deficit <= 0:
+            self.reset_at = None
+            return
+        self.reset_rate = deficit / seconds
+        self.reset_at = self.updated + seconds
+
+# === Shared limiter ===
+# One instance per process is shared by every concurrent batch. Tokens are
+# reserved from an estimate before each call and settled against the real
+# usage afterwards (a call that fails in any way, or is cancelled, gives its
+# reservation back); x-ratelimit-* headers keep the local buckets in line with
+# the server's view, including when it will have refilled them, and
+# Retry-After pauses every caller, not just the one that was throttled.
+class RateLimiter:
+    def __init__(self, tpm, rpm, safety_margin=0.02, max_retries=6,
+                 base_delay=1.0, max_delay=60.0, name="openai"):
+        self.safety_margin = safety_margin
+        self.tokens = TokenBucket(tpm * (1 - safety_margin))
+        self.requests = TokenBucket(rpm * (1 - safety_margin))
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.name = name
+        self.paused_until = 0.0
+        self.lock = asyncio.Lock()
+        self.stats = {"calls": 0, "retries": 0, "rate_limited": 0, "tokens": 0}
+
+    async def acquire(self, estimated_tokens):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                wait = max(
+                    self.paused_until - now,
+                    self.tokens.wait_time(estimated_tokens),
+                    self.requests.wait_time(1)
+                )
+                if wait <= 0:
+                    self.tokens.take(estimated_tokens)
+                    self.requests.take(1)
+                    return
+                await asyncio.sleep(wait)
+
+    def settle(self, estimated_tokens, actual_tokens):
+        if actual_tokens is None:
+            return
+        self.stats["tokens"] += actual_tokens
+        delta = estimated_tokens - actual_tokens
+        if delta > 0:
+            self.tokens.give(delta)
+        elif delta < 0:
+            self.tokens.take(-delta)
+
+    def update_from_headers(self, headers):
+        if not headers:
+            return
+        limit_tokens = _header_int(headers, "x-ratelimit-limit-tokens")
+        limit_requests = _header_int(headers, "x-ratelimit-limit-requests")
+        remaining_tokens = _header_int(headers, "x-ratelimit-remaining-tokens")
+        remaining_requests = _header_int(headers, "x-ratelimit-remaining-requests")
+        reset_tokens = parse_duration(headers.get("x-ratelimit-reset-tokens"))
+        reset_requests = parse_duration(headers.get("x-ratelimit-reset-requests"))
+
+        if limit_tokens:
+            target = limit_tokens * (1 - self.safety_margin)
+            if abs(target - self.tokens.capacity) > 1:
+                self.tokens.set_capacity(target)
+        if limit_requests:
+            target = limit_requests * (1 - self.safety_margin)
+            if abs(target - self.requests.capacity) > 1:
+                self.requests.set_capacity(target)
+        if remaining_tokens is not None:
+            self.tokens.clamp_to(remaining_tokens)
+        if remaining_requests is not None:
+            self.requests.clamp_to(remaining_requests)
+        if reset_tokens is not None:
+            self.tokens.schedule_reset(reset_tokens)
+        if reset_requests is not None:
+            self.requests.schedule_reset(reset_requests)
+
+    def pause(self, seconds):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def backoff(self, attempt):
+        # Full jitter: uniform in [0, min(max_delay, base * 2^attempt)]
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+
+    # `call` is a zero-argument coroutine function returning
+    # (result, actual_tokens, headers); actual_tokens may be None.
+    async def run(self, call, estimated_tokens):
+        last_error = None
+        for attempt in range(self.max_retries + 1):
+            await self.acquire(estimated_tokens)
+            self.stats["calls"] += 1
+            try:
+                try:
+                    result, actual_tokens, headers = await call()
+                except BaseException:
+                    self.settle(estimated_tokens, 0)
+                    raise
+            except RateLimited as e:
+                self.update_from_headers(e.headers)
+                self.stats["rate_limited"] += 1
+                metrics.inc("openai_requests_total", limiter=self.name, outcome="rate_limited")
+                delay = e.retry_after if e.retry_after is not None else self.backoff(attempt)
+                delay += random.uniform(0, self.base_delay)
+                self.pause(delay)
+                print(f"⏳ [{self.name}] Rate limited, pausing all callers for {delay:.1f}s", flush=True)
+                last_error = e
+            except TransientError as e:
+                metrics.inc("openai_requests_total", limiter=self.name, outcome="transient_error")
+                delay = self.backoff(attempt)
+                print(f"⚠️ [{self.name}] Transient error ({e}), retrying in {delay:.1f}s", flush=True)
+                await asyncio.sleep(delay)
+                last_error = e
+            except Exception:
+                metrics.inc("openai_requests_total", limiter=self.name, outcome="error")
+                raise
+            else:
+                self.settle(estimated_tokens, actual_tokens)
+                self.update_from_headers(headers)
+                metrics.inc("openai_requests_total", limiter=self.name, outcome="ok")
+                return result
+            self.stats["retries"] += 1
+        raise last_error
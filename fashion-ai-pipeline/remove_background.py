@@ -1,169 +1,621 @@
 # background_removal.py
 
 import os
-import requests
-import cv2
-import torch
 import numpy as np
-import supervision as sv
 from PIL import Image
 from io import BytesIO
 from dotenv import load_dotenv
-from ultralytics import YOLO
-import psycopg2
 import json
-from torchvision.models.segmentation import deeplabv3_resnet101
-from torchvision import transforms
-from torchvision.transforms.functional import to_pil_image
-from supabase import create_client, Client
+import asyncio
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import aiohttp
+import metrics
+from catalog_scanner import iter_pages, take_batch
+from connections import get_conn, get_supabase, close_conn
+from inference import detect_persons, segment_images, set_num_threads, get_backend, default_device, DETECT_SIZE
+from image_cache import ImageCache, FETCH_TIMEOUT
+from image_hashes import DuplicateIndex, HammingIndex, image_keys
+from job_state import JobState, Watermark, add_job_args, item_ids
+from work_claims import WorkSource
+from write_buffer import WriteBehindBuffer, install_shutdown_handlers
 
 # === Load ENV ===
 load_dotenv()
 
-DB_HOST = os.getenv("SUPABASE_DB_HOST")
-DB_NAME = os.getenv("SUPABASE_DB_NAME")
-DB_USER = os.getenv("SUPABASE_DB_USER")
-DB_PASSWORD = os.getenv("SUPABASE_DB_PASSWORD")
-DB_PORT = int(os.getenv("SUPABASE_DB_PORT", 5432))
 SUPABASE_URL = os.getenv("SUPABASE_URL")
 SUPABASE_KEY = os.getenv("SUPABASE_KEY")
 SUPABASE_BUCKET = os.getenv("SUPABASE_STORAGE_BUCKET")
+INFERENCE_BATCH_SIZE = int(os.getenv("INFERENCE_BATCH_SIZE", 8))  # products per batched inference round
+SCREEN_WORKERS = int(os.getenv("SCREEN_WORKERS", 8))  # candidate images fetched and decoded at once
 
-# === Connect to Supabase ===
-supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
-
-# === Connect to Supabase Postgres ===
-conn = psycopg2.connect(
-    host=DB_HOST,
-    dbname=DB_NAME,
-    user=DB_USER,
-    password=DB_PASSWORD,
-    port=DB_PORT,
-    sslmode="require"
-)
-cursor = conn.cursor()
-
-# === Setup YOLO for person detection ===
-yolo_model = YOLO("yolov8n.pt")
-
-# === Setup DeepLabV3 model for background removal ===
-device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-model = deeplabv3_resnet101(pretrained=True).to(device).eval()
-
-# === Define helper to detect people in image ===
-def detect_person_in_image(image_bytes):
+# === Cutout Settings ===
+CUTOUT_FORMAT = os.getenv("CUTOUT_FORMAT", "webp")  # webp (lossless) | png
+CUTOUT_MARGIN = float(os.getenv("CUTOUT_MARGIN", 0.03))  # crop margin, fraction of the bbox's longer side
+PNG_COMPRESS_LEVEL = int(os.getenv("PNG_COMPRESS_LEVEL", 3))  # zlib level 0-9; Pillow defaults to 6, lower is faster
+WEBP_EFFORT = int(os.getenv("WEBP_EFFORT", 50))  # lossless "quality" is compression effort, 0-100
+WEBP_METHOD = int(os.getenv("WEBP_METHOD", 4))  # 0 (fast) - 6 (smallest)
+CUTOUT_CONTENT_TYPES = {"webp": "image/webp", "png": "image/png"}
+if CUTOUT_FORMAT not in CUTOUT_CONTENT_TYPES:
+    raise ValueError(f"CUTOUT_FORMAT must be one of {sorted(CUTOUT_CONTENT_TYPES)}, got {CUTOUT_FORMAT!r}")
+
+# === Pipeline Settings (--pipeline) ===
+DOWNLOAD_CONCURRENCY = int(os.getenv("DOWNLOAD_CONCURRENCY", 16))  # products downloading at once
+PREFETCH_CANDIDATES = int(os.getenv("PREFETCH_CANDIDATES", 2))  # candidate images fetched ahead per product
+INFER_WORKERS = int(os.getenv("INFER_WORKERS", max(1, (os.cpu_count() or 1) // 4)))
+UPLOAD_WORKERS = int(os.getenv("UPLOAD_WORKERS", 8))
+PIPELINE_QUEUE_SIZE = int(os.getenv("PIPELINE_QUEUE_SIZE", 32))  # products buffered between stages
+
+# === Job state ===
+# Postgres and Supabase clients are opened on first use (see connections.py)
+STAGE = "transparent"
+job_state = JobState()
+
+# === Image cache ===
+image_cache = ImageCache()
+
+# === Near-duplicate indexes ===
+# Colour and size variants often reuse one photo under different URLs; person
+# screening results and uploaded cutouts are looked up by perceptual hash so
+# each such photo is screened and segmented once. A person in the photo does
+# not depend on its colours, but a cutout does: cutouts are only shared
+# between images whose colour signatures match too.
+screen_index = DuplicateIndex("screen")
+cutout_index = DuplicateIndex(STAGE, match_color=True)
+
+# === Fetch and decode one candidate for screening ===
+# Fetched at most once per run through the on-disk cache. Only detector
+# resolution is needed here: JPEGs are decoded straight at a reduced DCT scale
+# and other formats are reduced right after decoding. The full-resolution
+# decode happens only for the image that gets selected.
+def fetch_screening_image(url):
+    with metrics.step(STAGE, "fetch"):
+        content = image_cache.fetch(url)
+    image = Image.open(content)
+    image.thumbnail((DETECT_SIZE, DETECT_SIZE), Image.BILINEAR, reducing_gap=2.0)
+    return content, as_rgb(image)
+
+def as_rgb(image):
+    return image if image.mode == "RGB" else image.convert("RGB")
+
+# Candidate fetch + decode runs on a thread pool, created on first use so a
+# forked inference worker starts its own
+screen_pool = None
+
+def get_screen_pool():
+    global screen_pool
+    if screen_pool is None:
+        screen_pool = ThreadPoolExecutor(max_workers=SCREEN_WORKERS)
+    return screen_pool
+
+# === Select valid product images for a batch ===
+# `candidates` holds one list of image URLs per product, in preference order.
+# Every candidate is fetched and decoded concurrently, most-preferred first.
+# Screening runs in rounds: each unresolved product's next candidate goes into
+# one batched person-detection pass, and once a product has its first
+# person-free image, its remaining fetches are cancelled. Images screened
+# before (or near-duplicates of them) reuse the stored result instead of
+# going through detection. Returns (url, bytes, full-resolution image,
+# perceptual hash key) or None per product, and the number of reused screenings.
+def select_images(candidates):
+    pool = get_screen_pool()
+    futures = [[] for _ in candidates]
+    for position in range(max((len(urls) for urls in candidates), default=0)):
+        for p, urls in enumerate(candidates):
+            if position < len(urls):
+                futures[p].append(pool.submit(fetch_screening_image, urls[position]))
+
+    selected = [None] * len(candidates)
+    positions = [0] * len(candidates)
+    pending = list(range(len(candidates)))
+    screenings_reused = 0
+
+    while pending:
+        round_items = []
+        for p in pending:
+            while positions[p] < len(candidates[p]):
+                url = candidates[p][positions[p]]
+                future = futures[p][positions[p]]
+                positions[p] += 1
+                try:
+                    content, image = future.result()
+                    round_items.append((p, url, content, image))
+                    break
+                except Exception as e:
+                    print(f"⚠️ Failed to fetch or process {url}: {e}")
+        if not round_items:
+            break
+
+        keys = image_keys([image for _, _, _, image in round_items])
+        known = screen_index.find_many(keys)
+        has_person = [entry["person"] if entry else False for entry in known]
+        unknown = [i for i, entry in enumerate(known) if entry is None]
+        screenings_reused += len(round_items) - len(unknown)
+        if unknown:
+            try:
+                with metrics.step(STAGE, "detect"):
+                    detected = detect_persons([round_items[i][3] for i in unknown])
+            except Exception as e:
+                print(f"❌ Error checking images: {e}")
+            else:
+                for i, person in zip(unknown, detected):
+                    has_person[i] = person
+                screen_index.add_many([(keys[i], {"person": person}) for i, person in zip(unknown, detected)])
+
+        pending = []
+        for (p, url, content, image), key, person in zip(round_items, keys, has_person):
+            if not person:
+                try:
+                    selected[p] = (url, content, as_rgb(Image.open(content)), key)
+                except Exception as e:
+                    print(f"⚠️ Failed to fetch or process {url}: {e}")
+                else:
+                    for future in futures[p][positions[p]:]:
+                        future.cancel()
+                    continue
+            if positions[p] < len(candidates[p]):
+                pending.append(p)
+    return selected, screenings_reused
+
+# === Apply mask and encode cutout ===
+# The cutout is cropped to the mask's bounding box plus CUTOUT_MARGIN (a
+# fraction of the box's longer side) and colour under fully transparent
+# pixels is zeroed so it compresses away. Returns (bytes, metadata) with the
+# format, bbox in source pixels, the tight alpha box within the cutout
+# (`trim`), mask coverage and sizes, or None when the mask is empty.
+def encode_cutout(image, mask):
+    rows = np.flatnonzero(mask.any(axis=1))
+    cols = np.flatnonzero(mask.any(axis=0))
+    if not len(rows):
+        return None
+    top, bottom, left, right = int(rows[0]), int(rows[-1]) + 1, int(cols[0]), int(cols[-1]) + 1
+    trim_size = [right - left, bottom - top]
+    margin = int(round(CUTOUT_MARGIN * max(bottom - top, right - left)))
+    trim_offset = [min(left, margin), min(top, margin)]
+    top, left = max(0, top - margin), max(0, left - margin)
+    bottom, right = min(mask.shape[0], bottom + margin), min(mask.shape[1], right + margin)
+
+    alpha = mask[top:bottom, left:right]
+    image_rgba = np.dstack((np.asarray(image.crop((left, top, right, bottom))), alpha))
+    image_rgba[alpha == 0, :3] = 0
+
+    output = BytesIO()
+    if CUTOUT_FORMAT == "webp":
+        Image.fromarray(image_rgba).save(output, format="WEBP", lossless=True, quality=WEBP_EFFORT, method=WEBP_METHOD)
+    else:
+        Image.fromarray(image_rgba).save(output, format="PNG", compress_level=PNG_COMPRESS_LEVEL)
+    data = output.getvalue()
+
+    meta = {
+        "format": CUTOUT_FORMAT,
+        "bbox": [left, top, right - left, bottom - top],
+        "trim": trim_offset + trim_size,
+        "coverage": round(float(np.count_nonzero(mask)) / mask.size, 4),
+        "source_size": list(image.size),
+        "bytes": len(data)
+    }
+    return data, meta
+
+# === Background removal using DeepLabV3 ===
+# Segments every selected image in batched forward passes. Returns
+# (bytes, metadata) per image, or None when segmentation or encoding failed
+# or nothing was segmented; the original image is never uploaded in its place.
+def remove_backgrounds(selected):
     try:
-        image = Image.open(BytesIO(image_bytes)).convert("RGB")
-        frame = cv2.cvtColor(np.array(image), cv2.COLOR_RGB2BGR)
-        results = yolo_model(frame, verbose=False)[0]
-        detections = sv.Detections.from_ultralytics(results)
-        person_labels = detections.class_id == 0
-        return person_labels.any()
+        with metrics.step(STAGE, "segment"):
+            masks = segment_images([image for _, _, image, _ in selected])
     except Exception as e:
-        print(f"❌ Error checking image: {e}")
-        return False
+        print(f"❌ Background removal failed for batch of {len(selected)}: {e}")
+        return [None] * len(selected)
 
-# === Select valid product image ===
-def get_best_image_for_bg_removal(primary_image, additional_images):
-    image_sources = []
-    if primary_image:
-        image_sources.append(("primary", primary_image))
-    image_sources += [("additional", url) for url in additional_images]
-
-    for source, url in image_sources:
+    outputs = []
+    for (url, _, image, _), mask in zip(selected, masks):
         try:
-            response = requests.get(url, timeout=10)
-            response.raise_for_status()
-            has_person = detect_person_in_image(response.content)
-            if not has_person:
-                return url
+            with metrics.step(STAGE, "encode"):
+                cutout = encode_cutout(image, mask)
+            if cutout is None:
+                print(f"❌ Background removal found no foreground in {url}")
+            outputs.append(cutout)
         except Exception as e:
-            print(f"⚠️ Failed to fetch or process {url}: {e}")
-    return None
+            print(f"❌ Background removal failed: {e}")
+            outputs.append(None)
+    return outputs
 
-# === Background removal using DeepLabV3 ===
-def remove_background(image_bytes):
-    try:
-        image = Image.open(BytesIO(image_bytes)).convert("RGB")
-        transform = transforms.Compose([
-            transforms.Resize(520),
-            transforms.ToTensor(),
-            transforms.Normalize(mean=[0.485, 0.456, 0.406],
-                                 std=[0.229, 0.224, 0.225])
-        ])
-        input_tensor = transform(image).unsqueeze(0).to(device)
-
-        with torch.no_grad():
-            output = model(input_tensor)['out'][0]
-        output_predictions = output.argmax(0).byte().cpu().numpy()
-
-        mask = (output_predictions != 0).astype(np.uint8) * 255
-        mask = cv2.resize(mask, image.size)
-
-        image_np = np.array(image)
-        image_rgba = np.dstack((image_np, mask))
-        result_image = Image.fromarray(image_rgba)
-
-        output = BytesIO()
-        result_image.save(output, format="PNG")
-        output.seek(0)
-        return output.read()
+# === Select and cut out one batch of products ===
+# Returns one result per product, None when no suitable image was found, and
+# the near-duplicate savings. A result is a dict with the selected `source`
+# URL, its hash `key`, and either `reused` (URL and metadata of an uploaded
+# cutout of the same photo) or `cutout` ((bytes, metadata), or None if
+# background removal failed). Near-duplicates within the batch are segmented
+# once and share the cutout.
+def infer_products(candidates):
+    selections, screenings_reused = select_images(candidates)
+    results = [None] * len(selections)
+    chosen = [i for i, selection in enumerate(selections) if selection]
+    to_segment = []
+    for i, reused in zip(chosen, cutout_index.find_many([selections[i][3] for i in chosen])):
+        results[i] = {"source": selections[i][0], "key": selections[i][3], "reused": reused, "cutout": None}
+        if not reused:
+            to_segment.append(i)
 
-    except Exception as e:
-        print(f"❌ Background removal failed: {e}")
-        return image_bytes
-
-# === Process rows in batches ===
-def process_images_from_supabase(batch_size=50):
-    offset = 0
-    while True:
-        cursor.execute('SELECT id, parent_sku, additional_images, hosted_image_url FROM product_catalog OFFSET %s LIMIT %s', (offset, batch_size))
-        rows = cursor.fetchall()
-        if not rows:
-            break
+    batch_index = HammingIndex(match_color=True)
+    representatives, owners = [], {}
+    for i in to_segment:
+        phash, dhash, color = selections[i][3]
+        match = batch_index.search([phash], [dhash], [color])[0]
+        if match >= 0:
+            owners[i] = representatives[match]
+        else:
+            batch_index.add_many([phash], [dhash], [color])
+            representatives.append(i)
+            owners[i] = i
+
+    if representatives:
+        cutouts = dict(zip(representatives, remove_backgrounds([selections[i] for i in representatives])))
+        for i in to_segment:
+            results[i]["cutout"] = cutouts[owners[i]]
+
+    savings = {"screenings_reused": screenings_reused, "segmentations_shared": len(to_segment) - len(representatives)}
+    return results, savings
+
+# infer_products for a pool worker; also hands back the metrics the worker
+# recorded (None when it ran in this process)
+def infer_in_worker(candidates):
+    results, savings = infer_products(candidates)
+    return results, savings, metrics.drain()
+
+# additional_images is a text[] column (psycopg2 returns a list); JSON text is
+# accepted too
+def parse_candidates(primary_image, additional_images_json):
+    additional_images = additional_images_json or []
+    if isinstance(additional_images, str):
+        additional_images = json.loads(additional_images)
+    return ([primary_image] if primary_image else []) + list(additional_images)
+
+# === Upload to Supabase Storage ===
+def upload_cutout(parent_sku, cutout):
+    data, meta = cutout
+    file_path = f"transparent/{parent_sku}.{meta['format']}"
+    with metrics.step(STAGE, "upload"):
+        get_supabase().storage.from_(SUPABASE_BUCKET).upload(
+            path=file_path,
+            file=data,
+            file_options={"content-type": CUTOUT_CONTENT_TYPES[meta["format"]]},
+            upsert=True
+        )
+    return f"{SUPABASE_URL}/storage/v1/object/public/{SUPABASE_BUCKET}/{file_path}"
+
+# Cutout metadata (format, bbox, mask coverage) lives next to the URL
+def ensure_meta_column():
+    conn = get_conn(STAGE)
+    with conn.cursor() as cursor:
+        cursor.execute("ALTER TABLE product_catalog ADD COLUMN IF NOT EXISTS transparent_image_meta JSONB")
+    conn.commit()
 
-        for row in rows:
+# === Per-product bookkeeping ===
+# Products count as done, and the checkpoint moves past them, only once their
+# URL has been flushed to product_catalog. Shared by the batched and pipelined
+# modes and pipeline_runner; safe to call from the buffer's flush thread.
+# `checkpoint` is off for runs that must not move this stage's checkpoint
+# (retries, or the runner, which only sees a subset of products). With a
+# `source`, finished products also give back their lease.
+class ProductTracker:
+    def __init__(self, start_after, checkpoint=True, source=None):
+        self.watermark = Watermark(start_after)
+        self.checkpoint = checkpoint
+        self.source = source
+        self.checkpoint_stage = source.checkpoint_stage if source else STAGE
+        self.savings = {"screenings_reused": 0, "segmentations_shared": 0, "cutouts_reused": 0, "upload_bytes_saved": 0}
+        self.url_buffer = WriteBehindBuffer(
+            ["transparent_image_url", "transparent_image_meta"],
+            on_flush=self.on_flush,
+            casts={"transparent_image_meta": "jsonb"},
+            stage=STAGE
+        )
+
+    def start(self, product_id):
+        self.watermark.start(product_id)
+
+    def finish(self, *product_ids):
+        for finished_id in product_ids:
+            self.watermark.finish(finished_id)
+        if self.source:
+            self.source.release(*product_ids)
+        if self.checkpoint:
+            job_state.set_checkpoint(self.checkpoint_stage, self.watermark.value)
+
+    def on_flush(self, product_ids):
+        job_state.mark_done(STAGE, *product_ids)
+        self.finish(*product_ids)
+
+    def skipped(self, product_id, parent_sku):
+        print(f"🚫 [{parent_sku}] No suitable image found for background removal.")
+        job_state.mark_skipped(STAGE, product_id, "no suitable image")
+        self.finish(product_id)
+
+    def failed(self, product_id, parent_sku, error):
+        print(f"❌ [{parent_sku}] Error: {error}")
+        job_state.mark_failed(STAGE, product_id, error)
+        self.finish(product_id)
+
+    def add_savings(self, savings):
+        for name, count in savings.items():
+            self.savings[name] += count
+
+    # Settles products that need no upload; returns True when the product's
+    # cutout still has to be uploaded
+    def inferred(self, product_id, parent_sku, result):
+        if not result:
+            self.skipped(product_id, parent_sku)
+            return False
+        print(f"✅ [{parent_sku}] Selected for background removal: {result['source']}")
+        reused = result["reused"]
+        if reused:
+            print(f"♻️ [{parent_sku}] Near-duplicate of an uploaded cutout: {reused['url']}")
+            self.savings["cutouts_reused"] += 1
+            self.savings["upload_bytes_saved"] += reused["meta"].get("bytes", 0)
+            self.url_buffer.add(product_id, reused["url"], json.dumps(reused["meta"]))
+            return False
+        if result["cutout"] is None:
+            self.failed(product_id, parent_sku, "background removal failed")
+            return False
+        return True
+
+    # Queue transparent image URL and cutout metadata for batched write-back
+    # to product_catalog; later near-duplicates of the source reuse the upload
+    def uploaded(self, product_id, public_url, result):
+        meta = result["cutout"][1]
+        self.url_buffer.add(product_id, public_url, json.dumps(meta))
+        cutout_index.add(result["key"], {"url": public_url, "meta": meta})
+        print(f"🖼️  Uploaded transparent: {public_url}")
+
+    def close(self):
+        self.url_buffer.close()
+
+# === Batched mode ===
+# Fetch, infer and upload one batch after another in this process
+def process_batches(rows, tracker):
+    for batch in iter_pages(rows, INFERENCE_BATCH_SIZE):
+        products, candidates = [], []
+        for product_id, parent_sku, additional_images_json, primary_image in batch:
+            tracker.start(product_id)
+            try:
+                candidates.append(parse_candidates(primary_image, additional_images_json))
+            except Exception as e:
+                tracker.failed(product_id, parent_sku, e)
+                continue
+            products.append((product_id, parent_sku))
+
+        results, savings = infer_products(candidates)
+        tracker.add_savings(savings)
+        for (product_id, parent_sku), result in zip(products, results):
+            if not tracker.inferred(product_id, parent_sku, result):
+                continue
+            try:
+                tracker.uploaded(product_id, upload_cutout(parent_sku, result["cutout"]), result)
+            except Exception as e:
+                tracker.failed(product_id, parent_sku, e)
+
+# === Pipelined mode ===
+# fetch → infer → upload as three stages joined by bounded queues, so network
+# time overlaps with compute and a slow stage holds back the ones before it:
+#   - downloads run on one pooled aiohttp session and land in the image cache
+#   - inference runs in a process pool; the models loaded before forking are
+#     inherited by each worker (ONNX sessions are opened in the worker),
+#     which reads images back from the cache
+#   - uploads run in a thread pool
+def init_inference_worker(threads):
+    global image_cache, screen_index, cutout_index
+    set_num_threads(threads)
+    metrics.reset()
+    # SQLite handles must not be shared across fork; open fresh ones
+    image_cache = ImageCache()
+    screen_index = DuplicateIndex("screen")
+    cutout_index = DuplicateIndex(STAGE, match_color=True)
+
+# With "fork", the models are loaded once and every worker is forked up front,
+# before any database connection, lease heartbeat, write buffer, scanner or
+# upload thread exists. "spawn" suits a
+# caller that already runs threads (pipeline_runner): each worker imports this
+# module fresh and loads the models on its first batch. CUDA cannot be used
+# from a forked child, so on a GPU the batches run one at a time in a single
+# thread instead.
+def start_inference_pool(workers, context="fork"):
+    if default_device().type == "cuda":
+        return ThreadPoolExecutor(max_workers=1)
+    if context == "fork":
+        get_backend()
+    threads = max(1, (os.cpu_count() or 1) // workers)
+    pool = ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=multiprocessing.get_context(context),
+        initializer=init_inference_worker,
+        initargs=(threads,)
+    )
+    pool.submit(os.getpid).result()
+    return pool
+
+# Brings `url` into the on-disk cache (or revalidates it) so the inference
+# worker finds it there
+async def prefetch_image(session, url):
+    sha, headers = image_cache.lookup(url)
+    if headers is None:
+        return
+    with metrics.step(STAGE, "fetch"):
+        async with session.get(url, headers=headers) as response:
+            if sha and response.status == 304:
+                image_cache.revalidated(url, sha)
+                return
+            response.raise_for_status()
+            content = await response.read()
+            etag = response.headers.get("ETag")
+            last_modified = response.headers.get("Last-Modified")
+    await asyncio.get_running_loop().run_in_executor(None, image_cache.store, url, content, etag, last_modified)
+
+async def run_pipeline(rows, tracker, inference_pool, infer_workers, download_concurrency=DOWNLOAD_CONCURRENCY,
+                       upload_workers=UPLOAD_WORKERS, queue_size=PIPELINE_QUEUE_SIZE):
+    loop = asyncio.get_running_loop()
+    fetched = asyncio.Queue(queue_size)
+    processed = asyncio.Queue(queue_size)
+    upload_pool = ThreadPoolExecutor(max_workers=upload_workers)
+    downloading = asyncio.Semaphore(download_concurrency)
+    metrics.watch("pipeline_queue_depth", fetched.qsize, stage=STAGE, queue="fetched")
+    metrics.watch("pipeline_queue_depth", processed.qsize, stage=STAGE, queue="processed")
+
+    async def download(product_id, parent_sku, candidates):
+        # The slot is held until the product is queued, so a full queue stops new downloads
+        try:
+            for url in candidates[:PREFETCH_CANDIDATES]:
+                try:
+                    await prefetch_image(session, url)
+                except Exception as e:
+                    print(f"⚠️ Failed to fetch {url}: {e}")
+            await fetched.put((product_id, parent_sku, candidates))
+        finally:
+            downloading.release()
+
+    async def fetch_stage():
+        downloads = []
+        scan = iter(rows)
+        while True:
+            row = await loop.run_in_executor(None, next, scan, None)
+            if row is None:
+                break
             product_id, parent_sku, additional_images_json, primary_image = row
+            tracker.start(product_id)
+            try:
+                candidates = parse_candidates(primary_image, additional_images_json)
+            except Exception as e:
+                tracker.failed(product_id, parent_sku, e)
+                continue
+            await downloading.acquire()
+            downloads = [task for task in downloads if not task.done()]
+            downloads.append(asyncio.create_task(download(product_id, parent_sku, candidates)))
+        await asyncio.gather(*downloads)
+        await fetched.put(None)
 
+    async def infer_stage():
+        while True:
+            batch = await take_batch(fetched, INFERENCE_BATCH_SIZE)
+            if batch is None:
+                return
             try:
-                additional_images = json.loads(additional_images_json or "[]")
-                selected_url = get_best_image_for_bg_removal(primary_image, additional_images)
-
-                if selected_url:
-                    print(f"✅ [{parent_sku}] Selected for background removal: {selected_url}")
-                    img_response = requests.get(selected_url)
-                    processed_img = remove_background(img_response.content)
-
-                    # Upload to Supabase Storage
-                    file_path = f"transparent/{parent_sku}.png"
-                    supabase.storage.from_(SUPABASE_BUCKET).upload(
-                        path=file_path,
-                        file=processed_img,
-                        file_options={"content-type": "image/png"},
-                        upsert=True
-                    )
-
-                    public_url = f"{SUPABASE_URL}/storage/v1/object/public/{SUPABASE_BUCKET}/{file_path}"
-
-                    # Write transparent image URL back to product_catalog
-                    cursor.execute(
-                        """
-                        UPDATE product_catalog
-                        SET transparent_image_url = %s
-                        WHERE id = %s
-                        """,
-                        (public_url, product_id)
-                    )
-                    conn.commit()
-                    print(f"🖼️  Uploaded transparent: {public_url}")
-                else:
-                    print(f"🚫 [{parent_sku}] No suitable image found for background removal.")
+                results, savings, worker_metrics = await loop.run_in_executor(
+                    inference_pool, infer_in_worker, [c for _, _, c in batch]
+                )
             except Exception as e:
-                print(f"❌ [{parent_sku}] Error: {e}")
+                for product_id, parent_sku, _ in batch:
+                    tracker.failed(product_id, parent_sku, e)
+                continue
+            metrics.merge(worker_metrics)
+            tracker.add_savings(savings)
+            for (product_id, parent_sku, _), result in zip(batch, results):
+                if tracker.inferred(product_id, parent_sku, result):
+                    await processed.put((product_id, parent_sku, result))
+
+    async def upload_stage():
+        while True:
+            item = await processed.get()
+            if item is None:
+                return
+            product_id, parent_sku, result = item
+            try:
+                public_url = await loop.run_in_executor(upload_pool, upload_cutout, parent_sku, result["cutout"])
+            except Exception as e:
+                tracker.failed(product_id, parent_sku, e)
+                continue
+            tracker.uploaded(product_id, public_url, result)
+
+    connector = aiohttp.TCPConnector(limit=download_concurrency)
+    timeout = aiohttp.ClientTimeout(total=FETCH_TIMEOUT)
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        inferers = [asyncio.create_task(infer_stage()) for _ in range(infer_workers)]
+        uploaders = [asyncio.create_task(upload_stage()) for _ in range(upload_workers)]
+        try:
+            await fetch_stage()
+            await asyncio.gather(*inferers)
+            for _ in uploaders:
+                await processed.put(None)
+            await asyncio.gather(*uploaders)
+        finally:
+            for task in inferers + uploaders:
+                task.cancel()
+            upload_pool.shutdown()
+
+# === Process rows ===
+def process_images_from_supabase(batch_size=50, resume=False, retry_failed=False, pipeline=False,
+                                 infer_workers=INFER_WORKERS, shard=None, claim=False, **pipeline_options):
+    install_shutdown_handlers()
+    # Forked first, while this process has no Postgres connection, lease
+    # heartbeat or metrics exporter thread for the workers to inherit
+    inference_pool = start_inference_pool(infer_workers) if pipeline else None
+    metrics.start(STAGE)
+    ensure_meta_column()
+    source = WorkSource(STAGE, shard=shard, claim=claim)
+    checkpoints = source.checkpoints and not retry_failed
+    start_after = job_state.get_checkpoint(source.checkpoint_stage) if resume and checkpoints else None
+    tracker = ProductTracker(start_after, checkpoint=checkpoints, source=source)
+
+    where = "transparent_image_url IS NULL"
+    params = ()
+    if retry_failed:
+        failed_ids = item_ids(job_state.failed_keys(STAGE))
+        print(f"🔁 Retrying {len(failed_ids)} failed products")
+        where += " AND id = ANY(%s)"
+        params = (failed_ids,)
+    elif start_after is not None:
+        print(f"⏯️ Resuming after id {start_after}")
+
+    rows = source.rows(
+        get_conn(STAGE),
+        ["parent_sku", "additional_images", "hosted_image_url"],
+        where=where,
+        params=params,
+        page_size=batch_size,
+        start_after=start_after
+    )
+    if pipeline:
+        try:
+            asyncio.run(run_pipeline(rows, tracker, inference_pool, infer_workers, **pipeline_options))
+        finally:
+            inference_pool.shutdown()
+    else:
+        process_batches(rows, tracker)
 
-        offset += batch_size
+    tracker.close()
+    source.close()
+    print(f"🗄️ Image cache: {image_cache.stats}")
+    print(f"♻️ Near-duplicate savings: {tracker.savings}")
+    image_cache.close()
+    screen_index.close()
+    cutout_index.close()
 
-    conn.close()
+    # A completed scan starts from the top next time
+    if checkpoints:
+        job_state.set_checkpoint(source.checkpoint_stage, None)
+    print(f"📊 {STAGE}: {job_state.summary(STAGE)}")
+    job_state.close()
+    close_conn(STAGE)
 
 if __name__ == "__main__":
-    process_images_from_supabase(batch_size=50)
+    parser = add_job_args(argparse.ArgumentParser())
+    parser.add_argument("--pipeline", action="store_true",
+                        help="overlap downloads, inference and uploads in separate stages")
+    parser.add_argument("--download-concurrency", type=int, default=DOWNLOAD_CONCURRENCY)
+    parser.add_argument("--infer-workers", type=int, default=INFER_WORKERS, help="inference processes")
+    parser.add_argument("--upload-workers", type=int, default=UPLOAD_WORKERS)
+    parser.add_argument("--queue-size", type=int, default=PIPELINE_QUEUE_SIZE)
+    args = parser.parse_args()
+    process_images_from_supabase(
+        batch_size=50,
+        resume=args.resume,
+        retry_failed=args.retry_failed,
+        pipeline=args.pipeline,
+        infer_workers=args.infer_workers,
+        shard=args.shard,
+        claim=args.claim,
+        download_concurrency=args.download_concurrency,
+        upload_workers=args.upload_workers,
+        queue_size=args.queue_size
+    )
@@ -0,0 +1,576 @@
+# vector_search.py
+
+import os
+import json
+import time
+import argparse
+from collections import OrderedDict
+import numpy as np
+from dotenv import load_dotenv
+from catalog_scanner import scan_catalog
+from connections import get_conn, close_conn
+
+# === Load ENV ===
+load_dotenv()
+SUPABASE_EMBEDDING_TABLE = os.getenv("SUPABASE_EMBEDDING_TABLE", "product_embeddings")
+EMBEDDING_MODEL = "text-embedding-3-small"
+
+# === Index Settings ===
+VECTOR_INDEX_DIR = os.getenv("VECTOR_INDEX_DIR", ".cache/vector_index")
+VECTOR_DTYPE = os.getenv("VECTOR_DTYPE", "float16")  # float16 | float32 on disk; scoring is always float32
+FILTER_COLUMNS = ["category", "brand", "color"]
+MAX_BITMAP_VALUES = 256  # columns with more distinct values build their bitmaps on first use
+BITMAP_CACHE_SIZE = 1024
+SCORE_CHUNK_ROWS = 32768  # rows upcast and scored per matmul
+EXPORT_PAGE_SIZE = 1000
+COMPACT_RATIO = 0.2  # rewrite the vector file once this share of rows is dead
+IVF_TRAIN_SAMPLE = 65536
+IVF_ITERATIONS = 12
+DEFAULT_NPROBE = 8
+
+# === Helpers ===
+# pgvector columns come back as "[0.1,0.2,...]" text, float8[] as lists
+def parse_embedding(value):
+    if isinstance(value, str):
+        return np.array(value.strip("[]").split(","), dtype=np.float32)
+    return np.asarray(value, dtype=np.float32)
+
+def normalize(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+# Filter values are matched case- and whitespace-insensitively
+def normalize_value(value):
+    if value is None:
+        return None
+    value = str(value).strip().lower()
+    return value or None
+
+# Merge a (Q, n) block of scores into running (Q, k) top-k arrays
+def merge_top_k(best_scores, best_rows, scores, rows, k):
+    scores = np.concatenate([best_scores, scores], axis=1)
+    rows = np.concatenate([best_rows, np.broadcast_to(rows, (len(scores), len(rows)))], axis=1)
+    if scores.shape[1] > k:
+        keep = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        scores = np.take_along_axis(scores, keep, axis=1)
+        rows = np.take_along_axis(rows, keep, axis=1)
+    return scores, rows
+
+# === Export from Postgres ===
+# Embeddings and metadata for every row of the embedding table, or only for
+# `product_ids`; yields (product_id, vector, metadata, content_hash)
+def fetch_embeddings(conn, product_ids=None):
+    where, params = None, ()
+    if product_ids is not None:
+        where, params = "product_id = ANY(%s)", (list(product_ids),)
+    rows = scan_catalog(
+        conn,
+        ["embedding", "metadata", "content_hash"],
+        where=where,
+        params=params,
+        page_size=EXPORT_PAGE_SIZE,
+        table=SUPABASE_EMBEDDING_TABLE,
+        key="product_id"
+    )
+    for product_id, embedding, metadata, digest in rows:
+        if isinstance(metadata, str):
+            metadata = json.loads(metadata)
+        yield product_id, parse_embedding(embedding), metadata or {}, digest or ""
+
+# {product_id: content_hash} for the whole embedding table, without vectors
+def fetch_hashes(conn):
+    rows = scan_catalog(conn, ["content_hash"], page_size=EXPORT_PAGE_SIZE * 10,
+                        table=SUPABASE_EMBEDDING_TABLE, key="product_id")
+    return {product_id: digest or "" for product_id, digest in rows}
+
+# Price is not part of the embedding metadata; it is read from product_catalog
+def fetch_prices(conn):
+    rows = scan_catalog(conn, ["price"], where="price IS NOT NULL", page_size=EXPORT_PAGE_SIZE * 10)
+    return {row_id: float(price) for row_id, price in rows}
+
+# === Index ===
+# On-disk layout under `directory`:
+#   vectors-<n>.bin    (rows, dim) L2-normalized vectors, memory-mapped read-only
+#   columns-<n>.npz    ids, content hashes, parent_sku, price, alive flags and
+#                      one int32 code array per filter column (-1 = missing)
+#   vocab-<n>.json     code -> value for each filter column
+#   ivf-<n>.npz        optional coarse quantizer: centroids and row assignments
+#   manifest.json      dim, dtype, row count, and which of the files above make
+#                      up the index
+# Every save writes its files under a new generation number <n> and then
+# swaps the manifest in with one atomic replace, so a crash at any point
+# leaves the previous index readable; files the new manifest no longer names
+# are removed afterwards. Rows are only ever appended (in place: readers stop
+# at the manifest's row count); a changed or deleted product's old row is
+# marked dead and skipped until the next compaction, which writes a new
+# vectors file. A rebuild goes through the same swap: it writes a new
+# generation next to the current one. Indexes saved before generations
+# existed use the unnumbered names until their next save.
+LEGACY_FILES = {"vectors": "vectors.bin", "columns": "columns.npz", "vocab": "vocab.json", "ivf": "ivf.npz"}
+
+class VectorIndex:
+    def __init__(self, directory=VECTOR_INDEX_DIR):
+        self.directory = directory
+        with open(self.path("manifest.json")) as f:
+            manifest = json.load(f)
+        self.dim = manifest["dim"]
+        self.dtype = np.dtype(manifest["dtype"])
+        self.rows = manifest["rows"]
+        self.generation = manifest.get("generation", 0)
+        self.files = dict(manifest.get("files") or LEGACY_FILES)
+        self.saved_files = dict(self.files)
+
+        columns = np.load(self.path(self.files["columns"]))
+        self.ids = columns["ids"]
+        self.hashes = columns["hashes"]
+        self.skus = columns["skus"]
+        self.price = columns["price"]
+        self.alive = columns["alive"]
+        self.codes = {column: columns[f"code_{column}"] for column in FILTER_COLUMNS}
+        with open(self.path(self.files["vocab"])) as f:
+            self.vocab = json.load(f)
+
+        self.centroids = self.assignments = None
+        if manifest.get("ivf") and self.files.get("ivf") and os.path.exists(self.path(self.files["ivf"])):
+            ivf = np.load(self.path(self.files["ivf"]))
+            self.centroids, self.assignments = ivf["centroids"], ivf["assignments"]
+        self.load_vectors()
+        self.build_lookups()
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    # Empty index; rows come from `append` or `build`. A directory that
+    # already holds an index is only accepted with `replace`: the new index
+    # then takes the next generation, and the current one stays on disk (and
+    # is what readers open) until the new one is saved.
+    @classmethod
+    def create(cls, directory=VECTOR_INDEX_DIR, dim=1536, dtype=VECTOR_DTYPE, replace=False):
+        index = cls.__new__(cls)
+        index.directory = directory
+        index.generation = 0
+        index.saved_files = {}
+        if os.path.exists(index.path("manifest.json")):
+            if not replace:
+                raise FileExistsError(f"{directory} already holds an index; build replaces it")
+            with open(index.path("manifest.json")) as f:
+                manifest = json.load(f)
+            index.generation = manifest.get("generation", 0)
+            index.saved_files = dict(manifest.get("files") or LEGACY_FILES)
+        os.makedirs(directory, exist_ok=True)
+        index.files = {"vectors": f"vectors-{index.generation + 1}.bin"}
+        open(index.path(index.files["vectors"]), "wb").close()
+        index.dim = dim
+        index.dtype = np.dtype(dtype)
+        index.rows = 0
+        index.ids = np.zeros(0, dtype=np.int64)
+        index.hashes = np.zeros(0, dtype="U64")
+        index.skus = np.zeros(0, dtype="U64")
+        index.price = np.zeros(0, dtype=np.float32)
+        index.alive = np.zeros(0, dtype=bool)
+        index.codes = {column: np.zeros(0, dtype=np.int32) for column in FILTER_COLUMNS}
+        index.vocab = {column: [] for column in FILTER_COLUMNS}
+        index.centroids = index.assignments = None
+        index.load_vectors()
+        index.build_lookups()
+        return index
+
+    # Full export from Postgres into a fresh index. It is written as the next
+    # generation of whatever index `directory` holds, so the switch is the
+    # manifest replace in `save`: until then readers keep the current index,
+    # and a failed build only leaves its unreferenced vectors file behind
+    # (removed here when it can be).
+    @classmethod
+    def build(cls, conn, directory=VECTOR_INDEX_DIR, dtype=VECTOR_DTYPE, ivf=False, nlist=None):
+        index = None
+        try:
+            prices = fetch_prices(conn)
+            chunk = []
+            for row in fetch_embeddings(conn):
+                if index is None:
+                    index = cls.create(directory, len(row[1]), dtype, replace=True)
+                chunk.append(row)
+                if len(chunk) >= EXPORT_PAGE_SIZE * 10:
+                    index.append(chunk, prices)
+                    chunk = []
+            if index is None:
+                raise RuntimeError(f"{SUPABASE_EMBEDDING_TABLE} is empty")
+            if chunk:
+                index.append(chunk, prices)
+            if ivf:
+                index.train_ivf(nlist)
+            index.save()
+        except BaseException:
+            if index is not None and index.files["vectors"] not in index.saved_files.values():
+                try:
+                    os.remove(index.path(index.files["vectors"]))
+                except FileNotFoundError:
+                    pass
+            raise
+        return index
+
+    def load_vectors(self):
+        if self.rows:
+            self.vectors = np.memmap(self.path(self.files["vectors"]), dtype=self.dtype, mode="r", shape=(self.rows, self.dim))
+        else:
+            self.vectors = np.zeros((0, self.dim), dtype=self.dtype)
+
+    # Row position of each live product, vocab reverse maps, IVF inverted
+    # lists and the bitmaps for small-vocabulary columns (the rest are built
+    # on first use and kept in a small LRU). Appends only mark these stale;
+    # they are rebuilt once, on the next query.
+    def build_lookups(self):
+        self.stale = False
+        live = np.flatnonzero(self.alive)
+        self.positions = dict(zip(self.ids[live].tolist(), live.tolist()))
+        self.vocab_codes = {column: {value: code for code, value in enumerate(values)} for column, values in self.vocab.items()}
+        self.alive_bitmap = np.packbits(self.alive)
+        self.bitmaps = {}
+        self.lazy_bitmaps = OrderedDict()
+        for column in FILTER_COLUMNS:
+            if len(self.vocab[column]) <= MAX_BITMAP_VALUES:
+                codes = self.codes[column]
+                for code in range(len(self.vocab[column])):
+                    self.bitmaps[column, code] = np.packbits(codes == code)
+        self.lists = None
+        if self.assignments is not None:
+            order = np.argsort(self.assignments, kind="stable")
+            bounds = np.cumsum(np.bincount(self.assignments, minlength=len(self.centroids)))[:-1]
+            self.lists = np.split(order, bounds)
+
+    def ensure_lookups(self):
+        if self.stale:
+            self.build_lookups()
+
+    def __len__(self):
+        self.ensure_lookups()
+        return len(self.positions)
+
+    def code(self, column, value):
+        value = normalize_value(value)
+        if value is None:
+            return -1
+        codes = self.vocab_codes[column]
+        if value not in codes:
+            codes[value] = len(self.vocab[column])
+            self.vocab[column].append(value)
+        return codes[value]
+
+    # Append (product_id, vector, metadata, content_hash) rows; the vector
+    # file is cut back to the saved row count first in case an earlier append
+    # was never saved
+    def append(self, rows, prices):
+        if not rows:
+            return
+        vectors = normalize(np.stack([row[1] for row in rows]))
+        if vectors.shape[1] != self.dim:
+            raise ValueError(f"Expected {self.dim}-dimension embeddings, got {vectors.shape[1]}")
+        with open(self.path(self.files["vectors"]), "r+b") as f:
+            f.truncate(self.rows * self.dim * self.dtype.itemsize)
+            f.seek(0, os.SEEK_END)
+            f.write(vectors.astype(self.dtype).tobytes())
+
+        ids = np.array([row[0] for row in rows], dtype=np.int64)
+        self.ids = np.concatenate([self.ids, ids])
+        self.hashes = np.concatenate([self.hashes, np.array([row[3] for row in rows], dtype="U64")])
+        self.skus = np.concatenate([self.skus, np.array([str(row[2].get("parent_sku") or "") for row in rows], dtype="U64")])
+        self.price = np.concatenate([self.price, np.array([prices.get(i, np.nan) for i in ids.tolist()], dtype=np.float32)])
+        self.alive = np.concatenate([self.alive, np.ones(len(rows), dtype=bool)])
+        for column in FILTER_COLUMNS:
+            codes = np.array([self.code(column, row[2].get(column)) for row in rows], dtype=np.int32)
+            self.codes[column] = np.concatenate([self.codes[column], codes])
+        if self.centroids is not None:
+            self.assignments = np.concatenate([self.assignments, self.assign(vectors)])
+
+        self.rows += len(rows)
+        self.load_vectors()
+        self.stale = True
+
+    def save(self):
+        def replace(name, write):
+            temp = self.path(f"{name}.tmp")
+            with open(temp, "wb") as f:
+                write(f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp, self.path(name))
+
+        generation = self.generation + 1
+        files = {
+            "vectors": self.files["vectors"],
+            "columns": f"columns-{generation}.npz",
+            "vocab": f"vocab-{generation}.json",
+            "ivf": f"ivf-{generation}.npz" if self.centroids is not None else None
+        }
+        with open(self.path(files["vectors"]), "r+b") as f:
+            os.fsync(f.fileno())
+        replace(files["columns"], lambda f: np.savez(
+            f, ids=self.ids, hashes=self.hashes, skus=self.skus, price=self.price, alive=self.alive,
+            **{f"code_{column}": codes for column, codes in self.codes.items()}
+        ))
+        replace(files["vocab"], lambda f: f.write(json.dumps(self.vocab).encode("utf-8")))
+        if files["ivf"]:
+            replace(files["ivf"], lambda f: np.savez(f, centroids=self.centroids, assignments=self.assignments))
+        manifest = {
+            "dim": self.dim,
+            "dtype": self.dtype.name,
+            "rows": self.rows,
+            "ivf": self.centroids is not None,
+            "generation": generation,
+            "files": files,
+            "saved_at": time.time()
+        }
+        replace("manifest.json", lambda f: f.write(json.dumps(manifest).encode("utf-8")))
+
+        for name in set(self.saved_files.values()) - set(files.values()) - {None}:
+            try:
+                os.remove(self.path(name))
+            except FileNotFoundError:
+                pass
+        self.generation = generation
+        self.files = files
+        self.saved_files = dict(files)
+
+    # === Incremental refresh ===
+    # Only rows whose content_hash changed (or that are new) have their
+    # vectors re-exported; deleted products are marked dead, prices are
+    # re-read for everything since they change without re-embedding.
+    def refresh(self, conn):
+        self.ensure_lookups()
+        current = fetch_hashes(conn)
+        changed = [product_id for product_id, digest in current.items()
+                   if product_id not in self.positions or self.hashes[self.positions[product_id]] != digest]
+        updated = [product_id for product_id in changed if product_id in self.positions]
+        removed = [product_id for product_id in self.positions if product_id not in current]
+        self.alive[[self.positions[product_id] for product_id in updated + removed]] = False
+
+        prices = fetch_prices(conn)
+        self.price = np.array([prices.get(i, np.nan) for i in self.ids.tolist()], dtype=np.float32)
+        for start in range(0, len(changed), EXPORT_PAGE_SIZE * 10):
+            self.append(list(fetch_embeddings(conn, changed[start:start + EXPORT_PAGE_SIZE * 10])), prices)
+
+        if self.rows and 1 - self.alive.mean() > COMPACT_RATIO:
+            self.compact()
+        self.build_lookups()
+        self.save()
+        return {"added": len(changed) - len(updated), "updated": len(updated), "removed": len(removed)}
+
+    # Write the live rows to a new vector file and save columns to match; the
+    # old vector file stays in use until the new manifest replaces it
+    def compact(self):
+        live = np.flatnonzero(self.alive)
+        name = f"vectors-{self.generation + 1}.bin"
+        with open(self.path(name), "wb") as f:
+            for start in range(0, len(live), SCORE_CHUNK_ROWS):
+                f.write(np.ascontiguousarray(self.vectors[live[start:start + SCORE_CHUNK_ROWS]]).tobytes())
+        self.files["vectors"] = name
+
+        self.ids, self.hashes, self.skus, self.price = (a[live] for a in (self.ids, self.hashes, self.skus, self.price))
+        self.codes = {column: codes[live] for column, codes in self.codes.items()}
+        if self.assignments is not None:
+            self.assignments = self.assignments[live]
+        self.alive = np.ones(len(live), dtype=bool)
+        self.rows = len(live)
+        self.load_vectors()
+        self.build_lookups()
+        self.save()
+
+    # === IVF coarse index ===
+    # Spherical k-means on a sample of live rows; every row is then filed
+    # under its nearest centroid. Rows appended later are assigned to the
+    # existing centroids, so retrain after the catalog has shifted a lot.
+    def train_ivf(self, nlist=None, seed=0):
+        live = np.flatnonzero(self.alive)
+        if not len(live):
+            raise RuntimeError(f"{self.directory} has no live rows to train IVF lists on")
+        nlist = min(nlist or max(1, int(np.sqrt(len(live)))), len(live))
+        rng = np.random.default_rng(seed)
+        sample = np.sort(rng.choice(live, min(len(live), max(IVF_TRAIN_SAMPLE, nlist)), replace=False))
+        data = np.asarray(self.vectors[sample], dtype=np.float32)
+        centroids = data[rng.choice(len(data), nlist, replace=False)]
+        for _ in range(IVF_ITERATIONS):
+            labels = (data @ centroids.T).argmax(axis=1)
+            counts = np.bincount(labels, minlength=nlist)
+            order = np.argsort(labels, kind="stable")
+            filled = counts > 0
+            starts = np.concatenate([[0], np.cumsum(counts)[:-1]])[filled]
+            centroids[filled] = normalize(np.add.reduceat(data[order], starts, axis=0))
+            # Empty clusters restart from random sample points
+            centroids[~filled] = data[rng.choice(len(data), int((~filled).sum()), replace=False)]
+        self.centroids = centroids
+        self.assignments = np.concatenate([
+            self.assign(self.vectors[start:start + SCORE_CHUNK_ROWS]) for start in range(0, self.rows, SCORE_CHUNK_ROWS)
+        ]).astype(np.int32)
+        self.build_lookups()
+
+    def assign(self, vectors):
+        return (np.asarray(vectors, dtype=np.float32) @ self.centroids.T).argmax(axis=1).astype(np.int32)
+
+    # === Pre-filters ===
+    def bitmap(self, column, code):
+        key = (column, code)
+        if key in self.bitmaps:
+            return self.bitmaps[key]
+        if key in self.lazy_bitmaps:
+            self.lazy_bitmaps.move_to_end(key)
+        else:
+            if len(self.lazy_bitmaps) >= BITMAP_CACHE_SIZE:
+                self.lazy_bitmaps.popitem(last=False)
+            self.lazy_bitmaps[key] = np.packbits(self.codes[column] == code)
+        return self.lazy_bitmaps[key]
+
+    # Boolean row mask for `filters`, e.g. {"category": ["dress", "skirt"],
+    # "brand": "Zara", "price": (None, 80)}: values within a column are ORed,
+    # columns are ANDed, price is an inclusive (low, high) range with None
+    # for an open end. Dead rows are always excluded.
+    def filter_mask(self, filters=None):
+        self.ensure_lookups()
+        packed = self.alive_bitmap.copy()
+        for column, wanted in (filters or {}).items():
+            if column == "price":
+                low, high = wanted
+                in_range = ~np.isnan(self.price)
+                if low is not None:
+                    in_range &= self.price >= low
+                if high is not None:
+                    in_range &= self.price <= high
+                packed &= np.packbits(in_range)
+                continue
+            if column not in self.codes:
+                raise ValueError(f"Unknown filter column: {column}")
+            values = [wanted] if isinstance(wanted, str) else wanted
+            either = np.zeros_like(packed)
+            for value in values:
+                code = self.vocab_codes[column].get(normalize_value(value))
+                if code is not None:
+                    either |= self.bitmap(column, code)
+            packed &= either
+        return np.unpackbits(packed, count=self.rows).astype(bool)
+
+    # === Search ===
+    # Exact top-k cosine over `rows` (all rows when None) for a (Q, dim)
+    # block of normalized queries, scoring SCORE_CHUNK_ROWS rows per matmul
+    def scan(self, queries, rows, k):
+        best_scores = np.full((len(queries), 0), -np.inf, dtype=np.float32)
+        best_rows = np.zeros((len(queries), 0), dtype=np.int64)
+        total = self.rows if rows is None else len(rows)
+        for start in range(0, total, SCORE_CHUNK_ROWS):
+            if rows is None:
+                chunk_rows = np.arange(start, min(start + SCORE_CHUNK_ROWS, total))
+                block = self.vectors[start:start + SCORE_CHUNK_ROWS]
+            else:
+                chunk_rows = rows[start:start + SCORE_CHUNK_ROWS]
+                block = self.vectors[chunk_rows]
+            scores = queries @ np.asarray(block, dtype=np.float32).T
+            best_scores, best_rows = merge_top_k(best_scores, best_rows, scores, chunk_rows, k)
+        return best_scores, best_rows
+
+    # Top-k products for each query vector. Returns (ids, scores), both
+    # (Q, k), best first; slots beyond the matching rows hold id -1 and
+    # score -inf. IVF is used when trained, unless `exact`.
+    def search(self, queries, k=10, filters=None, nprobe=DEFAULT_NPROBE, exact=False):
+        queries = normalize(np.atleast_2d(queries))
+        mask = self.filter_mask(filters)  # also brings lookups up to date
+        if exact or self.lists is None:
+            rows = None if not filters and self.alive.all() else np.flatnonzero(mask)
+            scores, rows = self.scan(queries, rows, k)
+        else:
+            nprobe = min(nprobe, len(self.centroids))
+            probes = np.argpartition(-(queries @ self.centroids.T), nprobe - 1, axis=1)[:, :nprobe]
+            scores = np.full((len(queries), k), -np.inf, dtype=np.float32)
+            rows = np.full((len(queries), k), -1, dtype=np.int64)
+            for q, lists in enumerate(probes):
+                candidates = np.concatenate([self.lists[c] for c in lists])
+                candidates = np.sort(candidates[mask[candidates]])
+                found_scores, found_rows = self.scan(queries[q:q + 1], candidates, k)
+                scores[q, :found_scores.shape[1]] = found_scores[0]
+                rows[q, :found_rows.shape[1]] = found_rows[0]
+
+        # Pad to k and order best first
+        if scores.shape[1] < k:
+            pad = k - scores.shape[1]
+            scores = np.pad(scores, ((0, 0), (0, pad)), constant_values=-np.inf)
+            rows = np.pad(rows, ((0, 0), (0, pad)), constant_values=-1)
+        order = np.argsort(-scores, axis=1, kind="stable")
+        scores = np.take_along_axis(scores, order, axis=1)
+        rows = np.take_along_axis(rows, order, axis=1)
+        ids = np.where(rows >= 0, self.ids[np.maximum(rows, 0)], -1)
+        return ids, scores
+
+def open_index(directory=VECTOR_INDEX_DIR):
+    if not os.path.exists(os.path.join(directory, "manifest.json")):
+        return None
+    return VectorIndex(directory)
+
+# === Query embedding ===
+def embed_query(text):
+    import openai
+    client = openai.OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+    return np.array(client.embeddings.create(input=[text], model=EMBEDDING_MODEL).data[0].embedding, dtype=np.float32)
+
+def parse_filters(args):
+    filters = {}
+    for column in FILTER_COLUMNS:
+        values = getattr(args, column)
+        if values:
+            filters[column] = values.split(",")
+    if args.min_price is not None or args.max_price is not None:
+        filters["price"] = (args.min_price, args.max_price)
+    return filters
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local similarity search over product_embeddings")
+    parser.add_argument("--dir", default=VECTOR_INDEX_DIR, help="index directory")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    build = commands.add_parser("build", help="export every embedding into a fresh index")
+    build.add_argument("--dtype", default=VECTOR_DTYPE, choices=["float16", "float32"])
+    build.add_argument("--ivf", action="store_true", help="also train an IVF coarse index")
+    build.add_argument("--nlist", type=int, default=None, help="IVF lists (default: sqrt(rows))")
+
+    commands.add_parser("refresh", help="pull new, changed and deleted embeddings into the index")
+
+    train = commands.add_parser("train-ivf", help="(re)train the IVF coarse index")
+    train.add_argument("--nlist", type=int, default=None)
+
+    query = commands.add_parser("query", help="search by free text")
+    query.add_argument("text")
+    query.add_argument("--k", type=int, default=10)
+    query.add_argument("--nprobe", type=int, default=DEFAULT_NPROBE)
+    query.add_argument("--exact", action="store_true", help="brute force even when an IVF index exists")
+    for column in FILTER_COLUMNS:
+        query.add_argument(f"--{column}", help=f"comma-separated {column} values to keep")
+    query.add_argument("--min-price", type=float, default=None)
+    query.add_argument("--max-price", type=float, default=None)
+    args = parser.parse_args()
+
+    if args.command == "build":
+        conn = get_conn("vector_search")
+        started = time.time()
+        index = VectorIndex.build(conn, args.dir, args.dtype, ivf=args.ivf, nlist=args.nlist)
+        close_conn("vector_search")
+        print(f"✅ Indexed {len(index)} embeddings in {time.time() - started:.1f}s → {args.dir}")
+    elif args.command == "refresh":
+        index = open_index(args.dir)
+        if index is None:
+            print(f"🚫 No index in {args.dir}; run `build` first")
+        else:
+            conn = get_conn("vector_search")
+            stats = index.refresh(conn)
+            close_conn("vector_search")
+            print(f"🔄 Refreshed: {stats}, {len(index)} live rows")
+    elif args.command == "train-ivf":
+        index = VectorIndex(args.dir)
+        index.train_ivf(args.nlist)
+        index.save()
+        print(f"✅ Trained {len(index.centroids)} IVF lists over {len(index)} rows")
+    else:
+        index = VectorIndex(args.dir)
+        ids, scores = index.search(embed_query(args.text), k=args.k, filters=parse_filters(args),
+                                   nprobe=args.nprobe, exact=args.exact)
+        positions = index.positions
+        for product_id, score in zip(ids[0], scores[0]):
+            if product_id < 0:
+                break
+            print(f"{score:.4f}  {product_id}  {index.skus[positions[product_id]]}")
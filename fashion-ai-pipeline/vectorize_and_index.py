@@ -3,126 +3,305 @@
 import os
 import json
 import time
+import asyncio
+import hashlib
+import argparse
 import openai
-import psycopg2
+from psycopg2.extras import execute_values
 from dotenv import load_dotenv
-from supabase import create_client, Client
+import metrics
+from catalog_scanner import iter_pages
+from connections import get_conn, close_conn
+from job_state import JobState, Watermark, add_job_args, item_ids
+from work_claims import WorkSource
+from rate_limiter import RateLimiter, RateLimited, TransientError, parse_retry_after
 
 # === Load ENV ===
 load_dotenv()
 
-DB_HOST = os.getenv("SUPABASE_DB_HOST")
-DB_NAME = os.getenv("SUPABASE_DB_NAME")
-DB_USER = os.getenv("SUPABASE_DB_USER")
-DB_PASSWORD = os.getenv("SUPABASE_DB_PASSWORD")
-DB_PORT = int(os.getenv("SUPABASE_DB_PORT", 5432))
-SUPABASE_URL = os.getenv("SUPABASE_URL")
-SUPABASE_KEY = os.getenv("SUPABASE_KEY")
 SUPABASE_EMBEDDING_TABLE = os.getenv("SUPABASE_EMBEDDING_TABLE", "product_embeddings")
 
 openai.api_key = os.getenv("OPENAI_API_KEY")
 
-# === Connect to Supabase ===
-supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
-
-# === Connect to Supabase Postgres ===
-conn = psycopg2.connect(
-    host=DB_HOST,
-    dbname=DB_NAME,
-    user=DB_USER,
-    password=DB_PASSWORD,
-    port=DB_PORT,
-    sslmode="require"
-)
-cursor = conn.cursor()
+# === Job state ===
+# The Postgres connection is opened on first use (see connections.py)
+STAGE = "embed"
+job_state = JobState()
 
 # === Rate Limit Settings ===
 TPM_LIMIT = 800_000
+RPM_LIMIT = int(os.getenv("OPENAI_RPM_LIMIT", 5_000))
 SAFETY_BUFFER = 10_000
 
-# === Get Embedding Function ===
-def get_embedding(text, model="text-embedding-3-small"):
+# === Batching Settings ===
+EMBEDDING_MODEL = "text-embedding-3-small"
+MAX_BATCH_TOKENS = int(os.getenv("EMBEDDING_MAX_BATCH_TOKENS", 100_000))  # API hard limit is 300k per request
+MAX_BATCH_INPUTS = 2048  # API hard limit on inputs per request
+CONCURRENCY = int(os.getenv("EMBEDDING_CONCURRENCY", 4))
+
+# === Helpers ===
+def build_text_input(title, brand, color, category, description):
+    return f"Title: {title}\nBrand: {brand}\nColor: {color}\nCategory: {category}\nDescription: {description}"
+
+def content_hash(text_input, model=EMBEDDING_MODEL):
+    return hashlib.sha256(f"{model}\n{text_input}".encode("utf-8")).hexdigest()
+
+def estimate_tokens(text):
+    # ~4 characters per token for English text; errs on the high side for short strings
+    return len(text) // 4 + 1
+
+# Greedily pack items into request-sized batches by estimated token count, preserving order
+def pack_batches(items, max_tokens=MAX_BATCH_TOKENS, max_inputs=MAX_BATCH_INPUTS):
+    batch, batch_tokens = [], 0
+    for item in items:
+        tokens = estimate_tokens(item["text_input"])
+        if batch and (batch_tokens + tokens > max_tokens or len(batch) >= max_inputs):
+            yield batch, batch_tokens
+            batch, batch_tokens = [], 0
+        batch.append(item)
+        batch_tokens += tokens
+    if batch:
+        yield batch, batch_tokens
+
+# === Shared Rate Limiter ===
+# One budget for every concurrent batch in this process
+limiter = RateLimiter(
+    tpm=TPM_LIMIT,
+    rpm=RPM_LIMIT,
+    safety_margin=SAFETY_BUFFER / TPM_LIMIT,
+    name="embeddings"
+)
+
+# === Get Embeddings Function ===
+async def get_embeddings(client, texts, estimated_tokens, model=EMBEDDING_MODEL):
+    async def request():
+        try:
+            raw = await client.embeddings.with_raw_response.create(
+                input=texts,
+                model=model
+            )
+        except openai.RateLimitError as e:
+            headers = e.response.headers
+            raise RateLimited(str(e), parse_retry_after(headers), headers) from e
+        except (openai.APIConnectionError, openai.InternalServerError) as e:
+            raise TransientError(str(e)) from e
+        response = raw.parse()
+        return response, response.usage.total_tokens, raw.headers
+
     try:
-        response = openai.embeddings.create(
-            input=text,
-            model=model
-        )
-        return response.data[0].embedding, response.usage.total_tokens
+        with metrics.step(STAGE, "embed_call"):
+            response = await limiter.run(request, estimated_tokens)
+        metrics.record_usage(STAGE, model, response.usage.model_dump())
+        embeddings = [item.embedding for item in sorted(response.data, key=lambda d: d.index)]
+        return embeddings, response.usage.total_tokens
     except Exception as e:
-        print(f"❌ Failed to get embedding: {e}")
+        print(f"❌ Failed to get embeddings for {len(texts)} inputs: {e}")
         return None, 0
 
+# === Schema ===
+def ensure_hash_column():
+    conn = get_conn(STAGE)
+    with conn.cursor() as cursor:
+        cursor.execute(f'ALTER TABLE {SUPABASE_EMBEDDING_TABLE} ADD COLUMN IF NOT EXISTS content_hash TEXT')
+    conn.commit()
+
+# === Bulk Upsert ===
+def upsert_embeddings(items, embeddings):
+    values = [
+        (
+            item["product_id"],
+            json.dumps(item["metadata"]),
+            embedding,
+            item["content_hash"]
+        )
+        for item, embedding in zip(items, embeddings)
+    ]
+    conn = get_conn(STAGE)
+    try:
+        with metrics.step(STAGE, "db_write"):
+            with conn.cursor() as cursor:
+                execute_values(cursor, f'''
+                    INSERT INTO {SUPABASE_EMBEDDING_TABLE} (product_id, metadata, embedding, content_hash)
+                    VALUES %s
+                    ON CONFLICT (product_id) DO UPDATE SET
+                        metadata = EXCLUDED.metadata,
+                        embedding = EXCLUDED.embedding,
+                        content_hash = EXCLUDED.content_hash
+                ''', values, page_size=len(values))
+            conn.commit()
+        return len(values)
+    except Exception as e:
+        print(f"❌ Failed to upsert {len(values)} embeddings: {e}")
+        conn.rollback()
+        return 0
+
+# === Stored Hashes ===
+def fetch_stored_hashes(product_ids):
+    conn = get_conn(STAGE)
+    with conn.cursor() as cursor:
+        cursor.execute(
+            f'SELECT product_id, content_hash FROM {SUPABASE_EMBEDDING_TABLE} WHERE product_id = ANY(%s)',
+            (list(product_ids),)
+        )
+        stored = dict(cursor.fetchall())
+    conn.commit()
+    return stored
+
+# What gets embedded and upserted for one catalog row
+def embedding_item(product_id, parent_sku, title, brand, color, category, description):
+    text_input = build_text_input(title, brand, color, category, description)
+    return {
+        "product_id": product_id,
+        "parent_sku": parent_sku,
+        "text_input": text_input,
+        "content_hash": content_hash(text_input),
+        "metadata": {
+            "parent_sku": parent_sku,
+            "title": title,
+            "brand": brand,
+            "color": color,
+            "category": category,
+            "description": description
+        }
+    }
+
+# === Catalog Reader ===
+# Yields only products whose text_input/model hash differs from the stored one,
+# unless full=True. `stats` counts what was scanned and skipped; every yielded
+# or skipped id is registered with `watermark` so checkpoints stay ordered,
+# and skipped ids hand their lease straight back to `source`.
+def iter_products(source, page_size, stats, watermark, full=False, start_after=None, only_ids=None):
+    where, params = None, ()
+    if only_ids is not None:
+        where, params = "id = ANY(%s)", (only_ids,)
+    rows = source.rows(
+        get_conn(STAGE),
+        ["parent_sku", "title", "brand", "color", "category", "description"],
+        where=where,
+        params=params,
+        page_size=page_size,
+        start_after=start_after
+    )
+    for page in iter_pages(rows, page_size):
+        stored = {} if full else fetch_stored_hashes(row[0] for row in page)
+        for product_id, parent_sku, title, brand, color, category, description in page:
+            stats["scanned"] += 1
+            watermark.start(product_id)
+            item = embedding_item(product_id, parent_sku, title, brand, color, category, description)
+            if stored.get(product_id) == item["content_hash"]:
+                stats["skipped"] += 1
+                stats["skipped_tokens"] += estimate_tokens(item["text_input"])
+                watermark.finish(product_id)
+                source.release(product_id)
+                continue
+            yield item
+
 # === Process and Index in Batches ===
-def vectorize_products(batch_size=50):
-    offset = 0
-    total_tokens = 0
-    tpm_window_start = time.time()
-    tpm_tokens_used = 0
+async def vectorize_products(batch_size=500, concurrency=CONCURRENCY, full=False, resume=False, retry_failed=False,
+                             shard=None, claim=False):
+    ensure_hash_column()
+    source = WorkSource(STAGE, shard=shard, claim=claim)
+    checkpoint_stage = source.checkpoint_stage
+    start_after = job_state.get_checkpoint(checkpoint_stage) if resume and source.checkpoints else None
+    only_ids = item_ids(job_state.failed_keys(STAGE)) if retry_failed else None
+    checkpoints = only_ids is None and source.checkpoints
+    if only_ids is not None:
+        print(f"🔁 Retrying {len(only_ids)} failed products")
+    elif start_after is not None:
+        print(f"⏯️ Resuming after id {start_after}")
+    watermark = Watermark(start_after)
+    # Retries are owned by the shared limiter so every caller sees Retry-After
+    client = openai.AsyncOpenAI(api_key=openai.api_key, max_retries=0)
+    queue = asyncio.Queue(maxsize=concurrency * 2)
+    metrics.watch("pipeline_queue_depth", queue.qsize, stage=STAGE, queue="batches")
+    stats = {"scanned": 0, "skipped": 0, "skipped_tokens": 0, "rows": 0, "indexed": 0, "failed": 0, "tokens": 0}
     start_time = time.time()
+    # Catalog reads and upserts run off the event loop so they overlap with
+    # embedding requests; they share get_conn(STAGE), so one at a time
+    loop = asyncio.get_running_loop()
+    stage_db = asyncio.Lock()
 
-    while True:
-        cursor.execute('''
-            SELECT id, parent_sku, title, brand, color, category, description
-            FROM product_catalog
-            OFFSET %s LIMIT %s
-        ''', (offset, batch_size))
-
-        rows = cursor.fetchall()
-        if not rows:
-            break
-
-        for row in rows:
-            product_id, parent_sku, title, brand, color, category, description = row
-            text_input = f"Title: {title}\nBrand: {brand}\nColor: {color}\nCategory: {category}\nDescription: {description}"
+    async def worker():
+        while True:
+            job = await queue.get()
+            if job is None:
+                queue.task_done()
+                return
+            items, estimated_tokens = job
+            try:
+                embeddings, tokens_used = await get_embeddings(
+                    client,
+                    [item["text_input"] for item in items],
+                    estimated_tokens
+                )
+                stats["tokens"] += tokens_used
+                stats["rows"] += len(items)
 
-            embedding, tokens_used = get_embedding(text_input)
+                if embeddings is None or len(embeddings) != len(items):
+                    skus = ", ".join(str(item["parent_sku"]) for item in items[:5])
+                    print(f"🚫 Skipping batch of {len(items)} ({skus}, ...) due to failed embedding")
+                    stats["failed"] += len(items)
+                    for item in items:
+                        job_state.mark_failed(STAGE, item["product_id"], "embedding request failed")
+                    continue
 
-            # === TPM Rate Limiting ===
-            tpm_tokens_used += tokens_used
-            if tpm_tokens_used > (TPM_LIMIT - SAFETY_BUFFER):
-                elapsed = time.time() - tpm_window_start
-                sleep_time = 60 - elapsed
-                if sleep_time > 0:
-                    print(f"⏸️ Sleeping for {sleep_time:.2f}s to respect TPM limit")
-                    time.sleep(sleep_time)
-                tpm_window_start = time.time()
-                tpm_tokens_used = 0
+                async with stage_db:
+                    indexed = await loop.run_in_executor(None, upsert_embeddings, items, embeddings)
+                stats["indexed"] += indexed
+                stats["failed"] += len(items) - indexed
+                if indexed:
+                    job_state.mark_done(STAGE, *(item["product_id"] for item in items))
+                else:
+                    for item in items:
+                        job_state.mark_failed(STAGE, item["product_id"], "embedding upsert failed")
+                print(f"✅ Indexed {indexed} products")
 
-            total_tokens += tokens_used
+                elapsed = time.time() - start_time
+                cost_so_far = metrics.cost(STAGE)
+                print(f"⏳ Processed {stats['rows']} rows in {elapsed / 60:.2f} min — Cost so far: ${cost_so_far:.4f}")
+            finally:
+                for item in items:
+                    watermark.finish(item["product_id"])
+                source.release(*(item["product_id"] for item in items))
+                if checkpoints:
+                    job_state.set_checkpoint(checkpoint_stage, watermark.value)
+                queue.task_done()
 
-            if embedding is None:
-                print(f"🚫 Skipping {parent_sku} due to failed embedding")
-                continue
+    workers = [asyncio.create_task(worker()) for _ in range(concurrency)]
+    products = iter_products(source, batch_size, stats, watermark, full=full, start_after=start_after, only_ids=only_ids)
+    jobs = pack_batches(products)
+    while True:
+        async with stage_db:
+            job = await loop.run_in_executor(None, next, jobs, None)
+        if job is None:
+            break
+        await queue.put(job)
+    for _ in workers:
+        await queue.put(None)
+    await asyncio.gather(*workers)
 
-            try:
-                cursor.execute(f'''
-                    INSERT INTO {SUPABASE_EMBEDDING_TABLE} (product_id, metadata, embedding)
-                    VALUES (%s, %s, %s)
-                    ON CONFLICT (product_id) DO UPDATE SET metadata = EXCLUDED.metadata, embedding = EXCLUDED.embedding
-                ''', (
-                    product_id,
-                    json.dumps({
-                        "parent_sku": parent_sku,
-                        "title": title,
-                        "brand": brand,
-                        "color": color,
-                        "category": category,
-                        "description": description
-                    }),
-                    embedding
-                ))
-                conn.commit()
-                print(f"✅ Indexed {parent_sku}")
-            except Exception as e:
-                print(f"❌ Failed to insert embedding for {parent_sku}: {e}")
-                conn.rollback()
-
-        offset += batch_size
-        elapsed = time.time() - start_time
-        cost_so_far = (total_tokens / 1_000_000) * 0.1
-        print(f"⏳ Processed {offset} rows in {elapsed / 60:.2f} min — Cost so far: ${cost_so_far:.2f}")
-
-    conn.close()
+    # A completed scan starts from the top next time
+    if checkpoints:
+        job_state.set_checkpoint(checkpoint_stage, None)
+    source.close()
+    await client.close()
+    job_state.close()
+    close_conn(STAGE)
+    print(f"✅ Done — indexed {stats['indexed']}, failed {stats['failed']}, {stats['tokens']} tokens, ${metrics.cost(STAGE):.4f}")
+    skipped_cost = stats["skipped_tokens"] * metrics.OPENAI_PRICES[EMBEDDING_MODEL][0] / 1_000_000
+    print(f"⏩ Skipped {stats['skipped']} of {stats['scanned']} unchanged rows "
+          f"(~{stats['skipped_tokens']} tokens, ~${skipped_cost:.2f} saved)")
 
 if __name__ == "__main__":
-    vectorize_products(batch_size=50)
+    parser = add_job_args(argparse.ArgumentParser())
+    parser.add_argument("--full", action="store_true", help="re-embed every row, ignoring stored content hashes")
+    args = parser.parse_args()
+    metrics.start(STAGE)
+    asyncio.run(vectorize_products(
+        batch_size=500,
+        full=args.full,
+        resume=args.resume,
+        retry_failed=args.retry_failed,
+        shard=args.shard,
+        claim=args.claim
+    ))
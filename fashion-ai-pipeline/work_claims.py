@@ -0,0 +1,270 @@
+# work_claims.py
+
+import os
+import zlib
+import uuid
+import socket
+import threading
+from psycopg2 import sql
+from catalog_scanner import scan_catalog
+from connections import get_conn, close_conn
+
+# === Claim Settings ===
+LEASE_TABLE = "pipeline_leases"
+CURSOR_TABLE = "pipeline_claim_cursors"
+LEASE_SECONDS = int(os.getenv("LEASE_SECONDS", 300))  # a crashed worker's products become claimable after this
+HEARTBEAT_SECONDS = LEASE_SECONDS / 5  # leases are extended (and finished ones released) this often
+RELEASE_BATCH = 200
+
+def worker_name():
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+
+# === Work source for one stage worker ===
+# Decides which catalog rows this worker processes, so several copies of a
+# stage can run side by side without repeating each other's work:
+#   - default: every pending row, in id order (scan_catalog)
+#   - shard (i, n): only rows with id % n == i; a static split with no
+#     coordination, where a crashed worker's slice waits for its restart
+#   - claim: workers lease batches of rows from a Postgres lease table. A
+#     shared per-stage cursor hands out id ranges in order, so a row finished
+#     (or skipped, or failed) by one worker is never picked up again by
+#     another in the same pass. A heartbeat thread keeps this worker's leases
+#     alive; a crashed worker's leases expire and are swept up by whichever
+#     workers run out of fresh rows first, locking candidates FOR UPDATE SKIP
+#     LOCKED so concurrent sweepers take disjoint batches.
+# Both can be combined. Callers pass finished ids to `release`.
+class WorkSource:
+    def __init__(self, stage, shard=None, claim=False, lease_seconds=LEASE_SECONDS):
+        self.stage = stage
+        self.shard = shard
+        self.claim = claim
+        self.lease_seconds = lease_seconds
+        self.worker = worker_name()
+        self.lock = threading.Lock()
+        self.releases = set()
+        self.stats = {"claimed": 0, "reclaimed": 0, "released": 0}
+        self.heartbeat = None
+        self.stopped = threading.Event()
+        if claim:
+            self.conn_name = f"{stage}-leases"
+            self.claim_stage = self.checkpoint_stage
+            self.ensure_tables()
+            self.start_pass()
+            self.heartbeat = threading.Thread(target=self._beat, daemon=True)
+            self.heartbeat.start()
+
+    # Checkpoints only make sense for a worker that owns a fixed set of rows:
+    # each shard keeps its own, claiming workers keep none
+    @property
+    def checkpoints(self):
+        return not self.claim
+
+    @property
+    def checkpoint_stage(self):
+        return f"{self.stage}[{self.shard[0]}/{self.shard[1]}]" if self.shard else self.stage
+
+    # For items that are not catalog rows (label's CSV), sharded by a stable hash
+    def owns(self, key):
+        return self.shard is None or zlib.crc32(str(key).encode()) % self.shard[1] == self.shard[0]
+
+    def execute(self, statements):
+        with self.lock:
+            conn = get_conn(self.conn_name)
+            try:
+                with conn.cursor() as cursor:
+                    result = statements(cursor)
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+        return result
+
+    # Workers starting together would race on CREATE TABLE IF NOT EXISTS;
+    # the advisory lock lets one of them create the tables
+    def ensure_tables(self):
+        def create(cursor):
+            cursor.execute("SELECT pg_advisory_xact_lock(hashtext(%s))", (LEASE_TABLE,))
+            cursor.execute(f"""
+                CREATE TABLE IF NOT EXISTS {LEASE_TABLE} (
+                    stage TEXT NOT NULL,
+                    product_id BIGINT NOT NULL,
+                    worker TEXT NOT NULL,
+                    expires_at TIMESTAMPTZ NOT NULL,
+                    PRIMARY KEY (stage, product_id)
+                )
+            """)
+            cursor.execute(f"CREATE INDEX IF NOT EXISTS {LEASE_TABLE}_worker ON {LEASE_TABLE} (stage, worker)")
+            cursor.execute(f"""
+                CREATE TABLE IF NOT EXISTS {CURSOR_TABLE} (
+                    stage TEXT PRIMARY KEY,
+                    position BIGINT
+                )
+            """)
+        self.execute(create)
+
+    # Joins the pass in progress if any worker still holds a live lease;
+    # otherwise starts a new one from the top, dropping leases left behind by
+    # workers that died in an earlier pass
+    def start_pass(self):
+        def start(cursor):
+            cursor.execute(
+                f"INSERT INTO {CURSOR_TABLE} (stage, position) VALUES (%s, NULL) ON CONFLICT (stage) DO NOTHING",
+                (self.claim_stage,)
+            )
+            cursor.execute(f"SELECT position FROM {CURSOR_TABLE} WHERE stage = %s FOR UPDATE", (self.claim_stage,))
+            cursor.execute(
+                f"SELECT count(*) FROM {LEASE_TABLE} WHERE stage = %s AND expires_at > now()", (self.claim_stage,)
+            )
+            if cursor.fetchone()[0]:
+                return False
+            cursor.execute(f"UPDATE {CURSOR_TABLE} SET position = NULL WHERE stage = %s", (self.claim_stage,))
+            cursor.execute(f"DELETE FROM {LEASE_TABLE} WHERE stage = %s", (self.claim_stage,))
+            return True
+        if self.execute(start):
+            print(f"🆕 {self.stage}: starting a new claim pass as {self.worker}", flush=True)
+        else:
+            print(f"🤝 {self.stage}: joining the claim pass in progress as {self.worker}", flush=True)
+
+    # === Rows ===
+    # Same contract as scan_catalog: (id, *columns) tuples in id order within
+    # each batch. In claim mode `start_after` is ignored: the shared cursor
+    # decides where this worker's next batch begins.
+    def rows(self, conn, columns, where=None, params=(), page_size=500, start_after=None, table="product_catalog"):
+        if self.shard is not None:
+            shard_sql = f"mod(id, {int(self.shard[1])}) = {int(self.shard[0])}"
+            where = f"({where}) AND {shard_sql}" if where else shard_sql
+        if not self.claim:
+            yield from scan_catalog(conn, columns, where=where, params=params, page_size=page_size,
+                                    start_after=start_after, table=table)
+            return
+
+        while True:
+            rows = self.claim_batch(columns, where, params, page_size, table)
+            if not rows:
+                break
+            self.stats["claimed"] += len(rows)
+            yield from rows
+        while True:
+            rows = self.claim_batch(columns, where, params, page_size, table, expired=True)
+            if not rows:
+                break
+            self.stats["reclaimed"] += len(rows)
+            yield from rows
+
+    # Leases up to `limit` pending rows past the shared cursor and moves the
+    # cursor past them; with `expired`, takes over rows whose lease ran out.
+    # ON CONFLICT only replaces a lease that has expired, so a row is never
+    # held by two workers at once.
+    def claim_batch(self, columns, where, params, limit, table="product_catalog", expired=False):
+        projection = sql.SQL(", ").join(sql.Identifier(c) for c in ["id", *columns])
+        predicate = sql.SQL(where) if where else sql.SQL("TRUE")
+        lease = sql.SQL(
+            "EXISTS (SELECT 1 FROM {leases} l WHERE l.stage = %s AND l.product_id = {table}.id AND l.expires_at <= now())"
+            if expired else
+            "(%s IS NULL OR id > %s) AND NOT EXISTS "
+            "(SELECT 1 FROM {leases} l WHERE l.stage = %s AND l.product_id = {table}.id AND l.expires_at > now())"
+        ).format(leases=sql.Identifier(LEASE_TABLE), table=sql.Identifier(table))
+        query = sql.SQL("""
+            WITH candidates AS (
+                SELECT id FROM {table}
+                WHERE ({predicate}) AND {lease}
+                ORDER BY id
+                LIMIT %s
+                FOR UPDATE SKIP LOCKED
+            ), claimed AS (
+                INSERT INTO {leases} (stage, product_id, worker, expires_at)
+                SELECT %s, id, %s, now() + %s * interval '1 second' FROM candidates
+                ON CONFLICT (stage, product_id) DO UPDATE
+                    SET worker = EXCLUDED.worker, expires_at = EXCLUDED.expires_at
+                    WHERE {leases}.expires_at <= now()
+                RETURNING product_id
+            )
+            SELECT {projection} FROM {table} JOIN claimed ON claimed.product_id = {table}.id
+            ORDER BY id
+        """).format(
+            table=sql.Identifier(table), predicate=predicate, lease=lease,
+            leases=sql.Identifier(LEASE_TABLE), projection=projection
+        )
+        claim_params = (limit, self.claim_stage, self.worker, self.lease_seconds)
+
+        def claim(cursor):
+            if expired:
+                cursor.execute(query, (*params, self.claim_stage, *claim_params))
+                return cursor.fetchall()
+            # The cursor row lock serializes forward claims; each one is a
+            # single short statement, so workers barely wait on each other
+            cursor.execute(f"SELECT position FROM {CURSOR_TABLE} WHERE stage = %s FOR UPDATE", (self.claim_stage,))
+            after = cursor.fetchone()[0]
+            cursor.execute(query, (*params, after, after, self.claim_stage, *claim_params))
+            rows = cursor.fetchall()
+            if rows:
+                cursor.execute(f"UPDATE {CURSOR_TABLE} SET position = %s WHERE stage = %s", (rows[-1][0], self.claim_stage))
+            return rows
+        return self.execute(claim)
+
+    # === Leases ===
+    # Finished rows are released in batches by the heartbeat; until then
+    # their lease simply stays alive
+    def release(self, *product_ids):
+        if not self.claim:
+            return
+        with self.lock:
+            self.releases.update(product_ids)
+            full = len(self.releases) >= RELEASE_BATCH
+        if full:
+            self.flush_releases()
+
+    def flush_releases(self):
+        with self.lock:
+            product_ids, self.releases = list(self.releases), set()
+        if not product_ids:
+            return
+
+        def delete(cursor):
+            cursor.execute(
+                f"DELETE FROM {LEASE_TABLE} WHERE stage = %s AND worker = %s AND product_id = ANY(%s)",
+                (self.claim_stage, self.worker, product_ids)
+            )
+        try:
+            self.execute(delete)
+        except Exception as e:
+            print(f"⚠️ Failed to release {len(product_ids)} leases: {e}", flush=True)
+            with self.lock:
+                self.releases.update(product_ids)
+            return
+        self.stats["released"] += len(product_ids)
+
+    def extend(self):
+        def update(cursor):
+            cursor.execute(
+                f"UPDATE {LEASE_TABLE} SET expires_at = now() + %s * interval '1 second' WHERE stage = %s AND worker = %s",
+                (self.lease_seconds, self.claim_stage, self.worker)
+            )
+        try:
+            self.execute(update)
+        except Exception as e:
+            print(f"⚠️ Lease heartbeat failed: {e}", flush=True)
+
+    def _beat(self):
+        while not self.stopped.wait(HEARTBEAT_SECONDS):
+            self.flush_releases()
+            self.extend()
+
+    # Rows still leased here were claimed but never finished (an interrupted
+    # run); their leases are expired on the spot so a live worker's sweep
+    # takes them over instead of waiting out LEASE_SECONDS
+    def close(self):
+        if not self.claim or self.stopped.is_set():
+            return
+        self.stopped.set()
+        self.heartbeat.join()
+        self.flush_releases()
+
+        def expire(cursor):
+            cursor.execute(
+                f"UPDATE {LEASE_TABLE} SET expires_at = now() WHERE stage = %s AND worker = %s",
+                (self.claim_stage, self.worker)
+            )
+        self.execute(expire)
+        close_conn(self.conn_name)
+        print(f"🔖 {self.stage} leases: {self.stats}", flush=True)
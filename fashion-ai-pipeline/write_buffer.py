@@ -0,0 +1,139 @@
+# write_buffer.py
+
+import sys
+import time
+import atexit
+import signal
+import threading
+from psycopg2 import sql
+from psycopg2.extras import execute_values
+import metrics
+from connections import get_conn, close_conn
+
+# === Buffer Settings ===
+DEFAULT_MAX_ITEMS = 200
+DEFAULT_MAX_INTERVAL = 5.0  # seconds a pending write may wait before a timed flush
+
+# === Write-behind buffer for per-row column updates ===
+# Collects (id, value, ...) updates and writes them as a single
+# `UPDATE ... FROM (VALUES ...)` when `max_items` are pending, when the oldest
+# pending write is `max_interval` seconds old, and on close / interpreter exit.
+# Later updates to the same id replace earlier pending ones. `on_flush` is
+# called with the ids that were written, after the commit, so callers can mark
+# work done only once it is durable. `casts` maps a column to the SQL type its
+# values are cast to (VALUES columns are otherwise text), e.g. {"meta": "jsonb"}.
+# Flushes are timed as the `stage`'s db_write step (see metrics.py).
+#
+# The buffer writes through its own Postgres connection ("<stage>-writes" by
+# default), opened on the first flush, so rolling back a failed flush never
+# discards reads or writes in flight on the stage's other connection. The
+# pending lock is only held to swap the pending writes out; the write itself
+# runs under a separate flush lock, so `add` from other threads never waits on
+# the database. `add` and `close` can block on a flush: async callers run them
+# in an executor.
+class WriteBehindBuffer:
+    def __init__(self, columns, table="product_catalog", max_items=DEFAULT_MAX_ITEMS,
+                 max_interval=DEFAULT_MAX_INTERVAL, on_flush=None, casts=None, stage="unknown",
+                 conn_name=None):
+        self.conn_name = conn_name or f"{stage}-writes"
+        self.stage = stage
+        self.columns = list(columns)
+        self.max_items = max_items
+        self.max_interval = max_interval
+        self.on_flush = on_flush
+        self.pending = {}
+        self.oldest = None
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.closed = threading.Event()
+        self.stats = {"flushes": 0, "rows": 0}
+
+        casts = casts or {}
+        assignments = sql.SQL(", ").join(
+            sql.SQL("{column} = v.{column}{cast}").format(
+                column=sql.Identifier(column),
+                cast=sql.SQL(f"::{casts[column]}" if column in casts else "")
+            )
+            for column in self.columns
+        )
+        value_names = sql.SQL(", ").join(sql.Identifier(c) for c in ["id", *self.columns])
+        self.query = sql.SQL("""
+            UPDATE {table} AS p
+            SET {assignments}
+            FROM (VALUES %s) AS v({value_names})
+            WHERE p.id = v.id
+        """).format(table=sql.Identifier(table), assignments=assignments, value_names=value_names)
+
+        self.timer = threading.Thread(target=self._flush_periodically, daemon=True)
+        self.timer.start()
+        atexit.register(self.close)
+
+    def add(self, row_id, *values):
+        with self.lock:
+            if not self.pending:
+                self.oldest = time.monotonic()
+            self.pending[row_id] = values
+            full = len(self.pending) >= self.max_items
+        if full:
+            self.flush()
+
+    def flush(self):
+        with self.flush_lock:
+            with self.lock:
+                if not self.pending:
+                    return 0
+                items = self.pending
+                self.pending = {}
+                self.oldest = None
+            conn = None
+            try:
+                with metrics.step(self.stage, "db_write"):
+                    conn = get_conn(self.conn_name)
+                    with conn.cursor() as cur:
+                        query = self.query.as_string(cur)
+                        execute_values(cur, query, [(row_id, *values) for row_id, values in items.items()],
+                                       page_size=len(items))
+                    conn.commit()
+            except Exception as e:
+                if conn is not None and not conn.closed:
+                    conn.rollback()
+                # Keep the writes for the next flush; newer values for the same id win
+                with self.lock:
+                    items.update(self.pending)
+                    self.pending = items
+                    self.oldest = time.monotonic()
+                print(f"❌ Failed to flush {len(items)} buffered writes: {e}", flush=True)
+                return 0
+            self.stats["flushes"] += 1
+            self.stats["rows"] += len(items)
+        if self.on_flush:
+            self.on_flush(list(items))
+        return len(items)
+
+    def _flush_periodically(self):
+        while not self.closed.wait(min(1.0, self.max_interval)):
+            oldest = self.oldest
+            if oldest is not None and time.monotonic() - oldest >= self.max_interval:
+                self.flush()
+
+    def close(self):
+        if self.closed.is_set():
+            return
+        self.closed.set()
+        self.flush()
+        if self.pending:
+            print(f"⚠️ {len(self.pending)} buffered writes could not be flushed", flush=True)
+        close_conn(self.conn_name)
+
+# === Graceful shutdown ===
+# Render stops workers with SIGTERM; turning it into SystemExit lets `finally`
+# blocks and atexit hooks (including buffer flushes) run before the process ends.
+def install_shutdown_handlers():
+    if threading.current_thread() is not threading.main_thread():
+        return
+
+    def handle(signum, frame):
+        print(f"🛑 Received signal {signum}, flushing and exiting", flush=True)
+        sys.exit(128 + signum)
+
+    signal.signal(signal.SIGTERM, handle)